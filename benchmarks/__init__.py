@@ -0,0 +1,8 @@
+"""
+Benchmarks for django-ultimatethumb.
+
+The benchmarks run offline against generated fixtures using the test settings.
+Run the whole suite with ``python -m benchmarks`` (see ``benchmarks/__main__.py``
+for JSON output and comparing runs) or a single module with e.g.
+``python -m benchmarks.probe``.
+"""
@@ -0,0 +1,97 @@
+"""
+Run the benchmark suite, e.g.:
+
+    python -m benchmarks --json results.json
+    python -m benchmarks names tags --compare results.json
+
+The results are written as JSON (together with the versions they were measured
+with) and can be compared to an earlier run. Comparing exits with status 1 if a
+best timing got slower than the threshold.
+"""
+
+import argparse
+import importlib
+import json
+import sys
+
+from .utils import compare, get_environment, report, setup_django
+
+BENCHMARKS = (
+    'names',
+    'probe',
+    'tags',
+    'views',
+    'engines',
+    'formats',
+    'profiles',
+    'pngquant',
+    'inline',
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument(
+        'benchmarks', nargs='*', help='Benchmarks to run: {0}.'.format(', '.join(BENCHMARKS))
+    )
+    parser.add_argument('--json', help='File to write the results to.')
+    parser.add_argument('--compare', help='File with the results of an earlier run.')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='Relative slowdown of the best timing reported as regression, defaults to 0.1.',
+    )
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark {0}.'.format(name))
+
+    setup_django()
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = importlib.import_module('benchmarks.{0}'.format(name)).run()
+        report(name, results[name])
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(
+                {'environment': get_environment(), 'results': results}, json_file, indent=2
+            )
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare) as json_file:
+        baseline = json.load(json_file)
+
+    if baseline['environment'] != get_environment():
+        print(
+            'The baseline was measured in another environment: {0}'.format(
+                baseline['environment']
+            )
+        )
+
+    regressions = 0
+    print('Comparison with {0}'.format(args.compare))
+    for benchmark, name, base, best, ratio, regression in compare(
+        results, baseline['results'], args.threshold
+    ):
+        regressions += regression
+        print(
+            '  {0:<50} {1:>10.2f}us -> {2:>10.2f}us  {3:>6.2f}x{4}'.format(
+                '{0}: {1}'.format(benchmark, name),
+                base * 1e6,
+                best * 1e6,
+                ratio,
+                '  slower' if regression else '',
+            )
+        )
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Compare the thumbnail engines per image format.
+"""
+
+import os
+import shutil
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+FORMATS = ('jpg', 'png', 'gif')
+
+ENGINES = {
+    'gm': 'ultimatethumb.engines.GraphicsmagickEngine',
+    'pillow': 'ultimatethumb.engines.PillowEngine',
+}
+
+
+def get_engines():
+    """
+    Returns the available engines, gm is skipped if the binary is missing.
+    """
+    from django.conf import settings
+
+    engines = dict(ENGINES)
+    if not shutil.which(getattr(settings, 'ULTIMATETHUMB_GRAPHICSMAGICK_BINARY', 'gm')):
+        engines.pop('gm')
+    return engines
+
+
+def run(number=5):
+    from django.utils.module_loading import import_string
+
+    from ultimatethumb.thumbnail import Thumbnail
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in FORMATS:
+            source = create_image(directory, extension)
+            outfile = os.path.join(directory, 'out.{0}'.format(extension))
+
+            for size, crop in (('400', False), ('200', True)):
+                thumbnail = Thumbnail(source, {'size': [size, size], 'crop': crop})
+                for engine_name, engine_class in get_engines().items():
+                    engine = import_string(engine_class)()
+                    for factor in (1, 2):
+                        name = '{0} {1}x{1}{2} @{3}x {4}'.format(
+                            extension, size, ' crop' if crop else '', factor, engine_name
+                        )
+                        results[name] = measure(
+                            lambda: engine.generate(thumbnail, factor, outfile),
+                            number=number,
+                            repeat=3,
+                        )
+                        results[name]['bytes'] = os.path.getsize(outfile)
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Thumbnail engines', run())
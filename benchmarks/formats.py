@@ -0,0 +1,49 @@
+"""
+Compare the file size and encoding time of the thumbnail formats per source format.
+"""
+
+import os
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+SOURCES = ('jpg', 'png')
+
+
+def get_formats():
+    """
+    Returns the output formats to compare, avif is skipped if Pillow can't write it.
+    """
+    from PIL import features
+
+    formats = ['webp']
+    if features.check('avif'):
+        formats.append('avif')
+    return formats
+
+
+def run(number=3):
+    from ultimatethumb.engines import PillowEngine
+    from ultimatethumb.thumbnail import Thumbnail
+
+    engine = PillowEngine()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in SOURCES:
+            source = create_image(directory, extension)
+            thumbnail = Thumbnail(source, {'size': ['400', '400']})
+
+            for image_format in [extension] + get_formats():
+                outfile = os.path.join(directory, 'out.{0}'.format(image_format))
+                name = '{0} -> {1}'.format(extension, image_format)
+                results[name] = measure(
+                    lambda: engine.generate(thumbnail, 1, outfile), number=number, repeat=3
+                )
+                results[name]['bytes'] = os.path.getsize(outfile)
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Thumbnail formats', run())
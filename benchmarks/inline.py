@@ -0,0 +1,39 @@
+"""
+Compare reading base64 inline images from the sidecar file and the in-process cache.
+"""
+
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+
+def run(number=1000):
+    from django.test import override_settings
+
+    from ultimatethumb.thumbnail import Thumbnail
+    from ultimatethumb.utils import base64_cache
+
+    def uncached():
+        base64_cache.clear()
+        return thumbnail.get_base64_content()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        source = create_image(directory, 'png', size=(64, 64))
+        thumbnail = Thumbnail(source, {'size': ['32', '32']})
+
+        with override_settings(ULTIMATETHUMB_ENGINE='ultimatethumb.engines.PillowEngine'):
+            thumbnail.get_base64_content()
+            results['sidecar file'] = measure(uncached, number=number)
+
+            with override_settings(ULTIMATETHUMB_BASE64_FILES=False):
+                results['encode thumbnail'] = measure(uncached, number=number)
+
+            results['in-process cache'] = measure(thumbnail.get_base64_content, number=number)
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Base64 inline images', run())
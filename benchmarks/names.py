@@ -0,0 +1,47 @@
+"""
+Measure the pure Python hot paths: thumbnail names, size parsing and the size estimation.
+"""
+
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+OPTIONS = (
+    ('fit', {'size': ['400', '0']}),
+    ('crop', {'size': ['400', '300'], 'crop': True}),
+    ('upscale', {'size': ['2000', '0'], 'upscale': True}),
+    ('percent', {'size': ['50%', '0']}),
+)
+
+
+def run(number=1000):
+    from ultimatethumb.thumbnail import Thumbnail
+    from ultimatethumb.utils import build_thumb_name, get_thumb_name, parse_sizes
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        source = create_image(directory, 'jpg')
+        options = {'size': ['400', '0'], 'upscale': False, 'quality': 90}
+
+        results['build_thumb_name'] = measure(
+            lambda: build_thumb_name(source, **options), number=number
+        )
+        results['get_thumb_name'] = measure(
+            lambda: get_thumb_name(source, **options), number=number
+        )
+        results['parse_sizes'] = measure(
+            lambda: parse_sizes('200x0,400x0:600x0,50%,800x600'), number=number
+        )
+
+        for name, thumbnail_options in OPTIONS:
+            results['get_estimated_size {0}'.format(name)] = measure(
+                lambda: Thumbnail(source, thumbnail_options).get_estimated_size(),
+                number=number,
+            )
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Names and sizes', run())
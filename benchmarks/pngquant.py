@@ -0,0 +1,40 @@
+"""
+Compare in-process PNG quantization with the pngquant subprocess.
+"""
+
+import os
+import shutil
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+
+def run(number=3, quality='60-80'):
+    from django.conf import settings
+    from django.test import override_settings
+
+    from ultimatethumb.thumbnail import Thumbnail, _generate_thumbnails
+
+    modes = {'in-process': False}
+    if shutil.which(getattr(settings, 'ULTIMATETHUMB_PNGQUANT_BINARY', 'pngquant')):
+        modes['external'] = True
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        source = create_image(directory, 'png')
+        thumbnail = Thumbnail(source, {'size': ['400', '400'], 'pngquant': quality})
+
+        with override_settings(ULTIMATETHUMB_ENGINE='ultimatethumb.engines.PillowEngine'):
+            for name, external in modes.items():
+                with override_settings(ULTIMATETHUMB_PNGQUANT_EXTERNAL=external):
+                    results[name] = measure(
+                        lambda: _generate_thumbnails([(thumbnail, 1)]), number=number, repeat=3
+                    )
+                results[name]['bytes'] = os.path.getsize(thumbnail.get_storage_path())
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('PNG quantization', run())
@@ -0,0 +1,32 @@
+"""
+Compare the header based dimension probe with the Pillow based probe.
+"""
+
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+FORMATS = (('jpg', {}), ('png', {}), ('gif', {}), ('ico', {'sizes': [(16, 16), (64, 64)]}))
+
+
+def run():
+    from django.test import override_settings
+
+    from ultimatethumb.utils import probe_size_for_path
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for extension, kwargs in FORMATS:
+            path = create_image(directory, extension, **kwargs)
+            for probe in ('pillow', 'header'):
+                with override_settings(ULTIMATETHUMB_SIZE_PROBE=probe):
+                    results['{0} {1}'.format(extension, probe)] = measure(
+                        lambda: probe_size_for_path(path), number=1000
+                    )
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Dimension probe', run())
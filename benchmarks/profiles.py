@@ -0,0 +1,42 @@
+"""
+Compare the file size and encoding time of the thumbnails per encoder profile.
+"""
+
+import os
+import tempfile
+
+from .engines import get_engines
+from .utils import create_image, measure, report, setup_django
+
+SOURCES = ('jpg', 'png')
+
+PROFILES = ('default', 'web')
+
+
+def run(number=3):
+    from django.utils.module_loading import import_string
+
+    from ultimatethumb.thumbnail import Thumbnail
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in SOURCES:
+            source = create_image(directory, extension)
+            outfile = os.path.join(directory, 'out.{0}'.format(extension))
+
+            for engine_name, engine_class in get_engines().items():
+                engine = import_string(engine_class)()
+                for profile in PROFILES:
+                    thumbnail = Thumbnail(source, {'size': ['400', '400'], 'profile': profile})
+                    name = '{0} {1} {2}'.format(extension, profile, engine_name)
+                    results[name] = measure(
+                        lambda: engine.generate(thumbnail, 1, outfile), number=number, repeat=3
+                    )
+                    results[name]['bytes'] = os.path.getsize(outfile)
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Encoder profiles', run())
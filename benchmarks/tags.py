@@ -0,0 +1,55 @@
+"""
+Measure rendering the template tag for galleries of different sizes.
+"""
+
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+GALLERIES = (1, 10, 100)
+
+TEMPLATE = (
+    '{% load ultimatethumb_tags %}'
+    '{% for source in sources %}'
+    '{% ultimatethumb "img" source sizes="200x0,400x0:600x0" %}'
+    '<picture>{% for thumb in img %}'
+    '<source srcset="{{ thumb.url_2x }} 2x, {{ thumb.url }} 1x" />'
+    '{% endfor %}</picture>'
+    '{% endfor %}'
+)
+
+
+def run(number=10):
+    from django.core.cache import cache
+    from django.template import Context, Template
+
+    from ultimatethumb.utils import size_cache
+
+    def cold(context):
+        cache.clear()
+        size_cache.clear()
+        return template.render(context)
+
+    template = Template(TEMPLATE)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sources = [
+            create_image(directory, 'jpg', size=(400 + index, 300))
+            for index in range(max(GALLERIES))
+        ]
+
+        for gallery in GALLERIES:
+            context = Context({'sources': sources[:gallery]})
+            results['{0} images cold'.format(gallery)] = measure(
+                lambda: cold(context), number=number, repeat=3
+            )
+            results['{0} images warm'.format(gallery)] = measure(
+                lambda: template.render(context), number=number, repeat=3
+            )
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Template tag', run())
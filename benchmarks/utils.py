@@ -0,0 +1,110 @@
+import os
+import platform
+import statistics
+import timeit
+import tracemalloc
+
+from PIL import Image as PILImage
+
+
+def setup_django():
+    """
+    Configure Django using the test settings.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+    import django
+
+    django.setup()
+
+
+def create_image(directory, extension, size=(1600, 1200), **kwargs):
+    """
+    Create a fixture image with some structure to have realistic file sizes.
+    """
+    path = os.path.join(directory, 'fixture-{0}x{1}.{2}'.format(size[0], size[1], extension))
+    mode = 'RGBA' if extension in ('png', 'ico') else 'RGB'
+
+    image = PILImage.linear_gradient('L').resize(size).convert(mode)
+    image.paste(
+        PILImage.radial_gradient('L').resize((size[0] // 2, size[1] // 2)).convert(mode)
+    )
+    image.save(path, **kwargs)
+    return path
+
+
+def measure(func, number=100, repeat=5):
+    """
+    Time the given callable and return the timings per call in seconds. The peak
+    memory allocated by one call is measured using tracemalloc after timing.
+    """
+    timings = [t / number for t in timeit.repeat(func, number=number, repeat=repeat)]
+
+    tracemalloc.start()
+    try:
+        func()
+        memory_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best': min(timings),
+        'median': statistics.median(timings),
+        'memory_peak': memory_peak,
+    }
+
+
+def report(title, results):
+    """
+    Print a simple table of named timing results.
+    """
+    print(title)
+    for name, result in results.items():
+        line = '  {0:<40} best {1:>10.2f}us  median {2:>10.2f}us  peak {3:>8.1f}KiB'.format(
+            name, result['best'] * 1e6, result['median'] * 1e6, result['memory_peak'] / 1024
+        )
+        if 'bytes' in result:
+            line += '  {0:>8} bytes'.format(result['bytes'])
+        print(line)
+
+
+def get_environment():
+    """
+    Returns the versions the results were measured with, to judge comparisons.
+    """
+    import django
+    import PIL
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'django': django.get_version(),
+        'pillow': PIL.__version__,
+    }
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Compares the best timings of the results with a baseline (both mapping the
+    benchmark name to the named results), the best timing is the least affected
+    by other load. Returns a list of (benchmark, name, baseline timing, timing,
+    ratio, regression) tuples for the results present in both, regression is
+    True if the ratio exceeds 1 + threshold.
+    """
+    rows = []
+    for benchmark, benchmark_results in results.items():
+        for name, result in benchmark_results.items():
+            base = baseline.get(benchmark, {}).get(name)
+            if not base:
+                continue
+
+            ratio = result['best'] / base['best']
+            rows.append(
+                (benchmark, name, base['best'], result['best'], ratio, ratio > 1 + threshold)
+            )
+
+    return rows
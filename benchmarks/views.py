@@ -0,0 +1,89 @@
+"""
+Measure ThumbnailView responses for existing (warm) and missing (cold) thumbnails,
+also with admission control. The async view is measured generating a batch of
+thumbnails concurrently.
+"""
+
+import asyncio
+import tempfile
+
+from .utils import create_image, measure, report, setup_django
+
+
+def run(number=20):
+    from django.test import AsyncRequestFactory, Client, override_settings
+    from django.urls import resolve
+
+    from ultimatethumb.storage import thumbnail_storage
+    from ultimatethumb.thumbnail import Thumbnail
+    from ultimatethumb.views import AsyncThumbnailView
+
+    client = Client()
+    factory = AsyncRequestFactory()
+    async_view = AsyncThumbnailView.as_view()
+
+    def get(url, **headers):
+        response = client.get(url, **headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def cold(factor):
+        thumbnail_storage.delete(thumbnail.get_storage_name(factor))
+        return get(thumbnail.url if factor == 1 else thumbnail.url_2x)
+
+    def cold_batch():
+        for batch_thumbnail in batch:
+            thumbnail_storage.delete(batch_thumbnail.get_storage_name())
+        return [get(batch_thumbnail.url) for batch_thumbnail in batch]
+
+    def async_get(urls):
+        async def fetch():
+            return await asyncio.gather(
+                *[async_view(factory.get(url), **resolve(url).kwargs) for url in urls]
+            )
+
+        return asyncio.run(fetch())
+
+    def async_cold_batch():
+        for batch_thumbnail in batch:
+            thumbnail_storage.delete(batch_thumbnail.get_storage_name())
+        return async_get([batch_thumbnail.url for batch_thumbnail in batch])
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, override_settings(
+        ALLOWED_HOSTS=['testserver'],
+        ULTIMATETHUMB_ENGINE='ultimatethumb.engines.PillowEngine',
+        ULTIMATETHUMB_OFFLOAD='inline',
+    ):
+        source = create_image(directory, 'jpg')
+        thumbnail = Thumbnail(source, {'size': ['400', '0']})
+        etag = get(thumbnail.url)['ETag']
+
+        results['warm'] = measure(lambda: get(thumbnail.url), number=number * 10)
+        results['warm 2x'] = measure(lambda: get(thumbnail.url_2x), number=number * 10)
+        results['not modified'] = measure(
+            lambda: get(thumbnail.url, HTTP_IF_NONE_MATCH=etag), number=number * 10
+        )
+        results['cold'] = measure(lambda: cold(1), number=number, repeat=3)
+        results['cold 2x'] = measure(lambda: cold(2), number=number, repeat=3)
+        with override_settings(ULTIMATETHUMB_ADMISSION_CONTROL=True):
+            results['cold admission control'] = measure(
+                lambda: cold(1), number=number, repeat=3
+            )
+
+        batch = [
+            Thumbnail(source, {'size': [str(width), '0']}) for width in range(100, 500, 50)
+        ]
+        results['async warm'] = measure(lambda: async_get([thumbnail.url]), number=number * 10)
+        results['cold 8 sizes'] = measure(cold_batch, number=number // 4 or 1, repeat=3)
+        results['async cold 8 sizes'] = measure(
+            async_cold_batch, number=number // 4 or 1, repeat=3
+        )
+
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    report('Thumbnail view', run())
@@ -0,0 +1,27 @@
+import django
+import pytest
+
+from ultimatethumb.engines import get_pillow_format
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # asgiref is installed with Django 3.0 or newer.
+    async_to_sync = None
+
+try:
+    from django.test import AsyncRequestFactory
+except ImportError:
+    AsyncRequestFactory = None
+
+# Writing AVIF requires Pillow 11.2 or newer built with libavif.
+requires_avif = pytest.mark.skipif(
+    get_pillow_format('avif') is None, reason='Requires a Pillow AVIF encoder.'
+)
+
+requires_asgiref = pytest.mark.skipif(async_to_sync is None, reason='Requires asgiref.')
+
+# Async class based views require Django 4.1, the tests pass headers to the
+# AsyncRequestFactory which requires Django 4.2.
+requires_async_views = pytest.mark.skipif(
+    django.VERSION[:2] < (4, 2), reason='Requires Django 4.2 or newer.'
+)
@@ -0,0 +1,11 @@
+from ultimatethumb.engines import PillowEngine
+
+
+class AvifEngine(PillowEngine):
+    """
+    Pillow engine which claims to write AVIF even without an encoder, used by
+    tests which parse and negotiate formats but don't generate thumbnails.
+    """
+
+    def supports_format(self, image_format):
+        return image_format.lower() == 'avif' or super().supports_format(image_format)
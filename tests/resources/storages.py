@@ -0,0 +1,38 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.utils import timezone
+
+
+class RemoteStorage(Storage):
+    """
+    In-memory storage without local paths, behaves like a storage for an object
+    store. All instances share the files, like nodes sharing one bucket.
+    """
+
+    files = {}
+    calls = []
+
+    def _open(self, name, mode='rb'):
+        self.calls.append(('open', name))
+        return ContentFile(self.files[name][0], name=name)
+
+    def _save(self, name, content):
+        self.calls.append(('save', name))
+        self.files[name] = (b''.join(content.chunks()), timezone.now())
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        self.calls.append(('exists', name))
+        return name in self.files
+
+    def size(self, name):
+        return len(self.files[name][0])
+
+    def get_modified_time(self, name):
+        return self.files[name][1]
+
+    def url(self, name):
+        return 'https://cdn.example.com/{0}'.format(name)
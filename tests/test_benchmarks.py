@@ -0,0 +1,35 @@
+import json
+
+from benchmarks.__main__ import main
+from benchmarks.utils import compare, measure
+
+
+def test_measure():
+    result = measure(lambda: bytearray(1024 * 1024), number=1, repeat=1)
+
+    assert result['best'] == result['median']
+    assert result['memory_peak'] >= 1024 * 1024
+
+
+def test_compare():
+    baseline = {'names': {'a': {'best': 1.0}, 'b': {'best': 1.0}, 'c': {'best': 1.0}}}
+    results = {'names': {'a': {'best': 1.05}, 'b': {'best': 2.0}, 'd': {'best': 1.0}}}
+
+    assert compare(results, baseline) == [
+        ('names', 'a', 1.0, 1.05, 1.05, False),
+        ('names', 'b', 1.0, 2.0, 2.0, True),
+    ]
+
+
+def test_main(tmp_path, capsys):
+    results_file = str(tmp_path / 'results.json')
+    assert main(['names', '--json', results_file]) == 0
+
+    with open(results_file) as json_file:
+        results = json.load(json_file)
+
+    assert 'pillow' in results['environment']
+    assert 'build_thumb_name' in results['results']['names']
+
+    assert main(['names', '--compare', results_file, '--threshold', '100']) == 0
+    assert 'Comparison with' in capsys.readouterr().out
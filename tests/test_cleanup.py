@@ -0,0 +1,156 @@
+import hashlib
+import os
+
+import pytest
+
+from ultimatethumb.cleanup import ThumbnailCleanup, cleanup_thumbnails
+from ultimatethumb.storage import thumbnail_storage
+
+
+def get_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class TestThumbnailCleanup:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.root = str(tmp_path)
+
+    def create(self, path, size=100, access=1000):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(path, (access, access))
+        return path
+
+    def create_thumbnail(self, name, access=1000, retina=True, base64=False):
+        thumb_hash = get_hash(name)
+        self.create('{0}/{1}.jpg'.format(thumb_hash, name), access=access)
+        if retina:
+            self.create('2x/{0}/{1}.jpg'.format(thumb_hash, name), size=200, access=access)
+        if base64:
+            self.create('{0}/{1}.base64'.format(thumb_hash, name), size=50, access=access)
+        return thumb_hash
+
+    def exists(self, thumb_hash):
+        return os.path.exists(os.path.join(self.root, thumb_hash)) or os.path.exists(
+            os.path.join(self.root, '2x', thumb_hash)
+        )
+
+    def test_stats(self):
+        self.create_thumbnail('a', base64=True)
+        self.create_thumbnail('b', retina=False)
+        self.create('{0}.json'.format(get_hash('a')))
+
+        stats = ThumbnailCleanup(root=self.root).run()
+
+        assert stats['thumbnails'] == 2
+        assert stats['files'] == 4
+        assert stats['size'] == 450
+        assert stats['removed_thumbnails'] == 0
+
+    def test_remove_oldest_by_size(self):
+        old = self.create_thumbnail('old', access=1000)
+        older = self.create_thumbnail('older', access=500)
+        new = self.create_thumbnail('new', access=2000, base64=True)
+
+        stats = ThumbnailCleanup(max_size=400, root=self.root).run()
+
+        assert stats['removed_thumbnails'] == 2
+        assert stats['removed_files'] == 4
+        assert stats['removed_size'] == 600
+        assert self.exists(older) is False
+        assert self.exists(old) is False
+        assert self.exists(new) is True
+        assert os.path.isdir(os.path.join(self.root, '2x')) is True
+
+    def test_remove_oldest_by_files(self):
+        old = self.create_thumbnail('old', access=1000)
+        new = self.create_thumbnail('new', access=2000)
+
+        ThumbnailCleanup(max_files=3, root=self.root).run()
+
+        assert self.exists(old) is False
+        assert self.exists(new) is True
+
+    def test_access_time(self):
+        first = self.create_thumbnail('first', access=1000)
+        second = self.create_thumbnail('second', access=2000)
+        # The retina version of the first thumbnail was accessed recently.
+        os.utime(
+            os.path.join(self.root, '2x', first, 'first.jpg'),
+            (3000, 1000),
+        )
+
+        ThumbnailCleanup(max_size=300, root=self.root).run()
+
+        assert self.exists(first) is True
+        assert self.exists(second) is False
+
+    def test_retina_only(self):
+        thumb_hash = get_hash('retina')
+        self.create('2x/{0}/retina.jpg'.format(thumb_hash))
+
+        stats = ThumbnailCleanup(max_size=0, root=self.root).run()
+
+        assert stats['thumbnails'] == 1
+        assert self.exists(thumb_hash) is False
+
+    def test_orphaned_base64(self):
+        thumb_hash = get_hash('orphan')
+        self.create('{0}/orphan.base64'.format(thumb_hash))
+        kept = self.create_thumbnail('kept', base64=True)
+
+        stats = ThumbnailCleanup(root=self.root).run()
+
+        assert stats['orphans'] == 1
+        assert stats['thumbnails'] == 1
+        assert os.path.exists(os.path.join(self.root, thumb_hash)) is False
+        assert os.path.exists(os.path.join(self.root, kept, 'kept.base64')) is True
+
+    def test_dry_run(self):
+        old = self.create_thumbnail('old', access=1000)
+        thumb_hash = get_hash('orphan')
+        self.create('{0}/orphan.base64'.format(thumb_hash))
+
+        stats = ThumbnailCleanup(max_size=0, dry_run=True, root=self.root).run()
+
+        assert stats['orphans'] == 1
+        assert stats['removed_thumbnails'] == 1
+        assert stats['removed_size'] == 300
+        assert self.exists(old) is True
+        assert os.path.exists(os.path.join(self.root, thumb_hash, 'orphan.base64')) is True
+
+    def test_missing_root(self):
+        stats = ThumbnailCleanup(root=os.path.join(self.root, 'missing')).run()
+        assert stats['thumbnails'] == 0
+
+    def test_get_oldest_groups(self):
+        for i in range(10):
+            self.create_thumbnail(str(i), access=1000 + i, retina=False)
+
+        groups = ThumbnailCleanup(root=self.root).get_oldest_groups(250, 0)
+        assert [group.name for group in groups] == [get_hash(str(i)) for i in range(3)]
+
+    def test_settings(self, settings):
+        settings.ULTIMATETHUMB_CLEANUP_MAX_SIZE = 100
+        settings.ULTIMATETHUMB_CLEANUP_MAX_FILES = 10
+
+        cleanup = ThumbnailCleanup(root=self.root)
+        assert cleanup.max_size == 100
+        assert cleanup.max_files == 10
+
+    def test_cleanup_thumbnails(self, settings):
+        root = settings.ULTIMATETHUMB_ROOT
+        settings.ULTIMATETHUMB_ROOT = self.root
+        thumbnail_storage._setup()
+        old = self.create_thumbnail('old')
+
+        stats = cleanup_thumbnails(max_size=0)
+
+        assert stats['removed_thumbnails'] == 1
+        assert self.exists(old) is False
+
+        settings.ULTIMATETHUMB_ROOT = root
+        thumbnail_storage._setup()
@@ -1,6 +1,45 @@
 from collections import OrderedDict
 
-from ultimatethumb.commands import GraphicsmagickCommand, PngquantCommand
+import pytest
+from command_executor import Command, CommandExecutionError
+
+from tests.resources.compat import async_to_sync, requires_asgiref
+from ultimatethumb.commands import (
+    AsyncCommandMixin,
+    GraphicsmagickBatchCommand,
+    GraphicsmagickCommand,
+    PngquantCommand,
+)
+
+
+class CatCommand(AsyncCommandMixin, Command):
+    command = 'cat'
+    ignore_output = False
+
+
+@requires_asgiref
+class TestAsyncCommandMixin:
+    def test_aexecute(self):
+        cmd = CatCommand()
+
+        assert async_to_sync(cmd.aexecute)(stdin='test') == 'test'
+        assert cmd.process.returncode == 0
+        assert async_to_sync(cmd.aexecute)(ignore_output=True) is True
+
+    def test_aexecute_error(self):
+        cmd = CatCommand()
+        cmd.command = 'false'
+
+        with pytest.raises(CommandExecutionError):
+            async_to_sync(cmd.aexecute)()
+        assert async_to_sync(cmd.aexecute)(fail_silently=True) == ''
+
+    def test_aexecute_missing(self):
+        cmd = CatCommand()
+        cmd.command = 'ultimatethumb-missing-binary'
+
+        with pytest.raises(CommandExecutionError):
+            async_to_sync(cmd.aexecute)(fail_silently=True)
 
 
 class TestGraphicsmagickCommand:
@@ -23,6 +62,32 @@ class TestGraphicsmagickCommand:
             'out.jpg',
         ]
 
+    def test_get_batch_command(self):
+        cmd = GraphicsmagickCommand(
+            infile='in.jpg', outfile='out.jpg', options={'resize': '100x100'}
+        )
+
+        assert cmd.get_batch_command() == 'convert "in.jpg" -resize 100x100 "out.jpg"'
+
+
+class TestGraphicsmagickBatchCommand:
+    def test_get_command(self):
+        cmd = GraphicsmagickBatchCommand(commands=[])
+
+        assert cmd.get_command() == ['gm', 'batch', '-stop-on-error', 'on', '-']
+
+    def test_get_stdin(self):
+        cmd = GraphicsmagickBatchCommand(
+            commands=[
+                GraphicsmagickCommand(infile='in.jpg', outfile='out1.jpg'),
+                GraphicsmagickCommand(infile='in.jpg', outfile='out2.jpg'),
+            ]
+        )
+
+        assert cmd.get_stdin() == (
+            'convert "in.jpg" -noop "out1.jpg"\nconvert "in.jpg" -noop "out2.jpg"\n'
+        )
+
 
 class TestPngquantCommand:
     def test_get_command(self):
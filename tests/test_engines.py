@@ -0,0 +1,362 @@
+import os
+from unittest import mock
+
+import pytest
+from PIL import Image as PILImage
+
+from tests.factories.mockapp import ImageModelFactory
+from tests.resources.compat import async_to_sync, requires_asgiref
+from ultimatethumb.engines import (
+    QUANTIZE_FASTOCTREE,
+    QUANTIZE_LIBIMAGEQUANT,
+    QUANTIZE_MEDIANCUT,
+    GraphicsmagickEngine,
+    PillowEngine,
+    get_engine,
+    get_pillow_format,
+    get_quantize_colors,
+)
+from ultimatethumb.thumbnail import Size, Thumbnail
+
+
+@pytest.mark.parametrize(
+    'quality,expected',
+    [(100, 256), ('75-90', 147), ('-50', 16), ('50-', 256), (0, 2)],
+)
+def test_get_quantize_colors(quality, expected):
+    assert get_quantize_colors(quality) == expected
+
+
+@pytest.mark.skipif(not hasattr(PILImage, 'Quantize'), reason='Requires Pillow 9.1.')
+def test_quantize_methods():
+    assert QUANTIZE_MEDIANCUT == PILImage.Quantize.MEDIANCUT
+    assert QUANTIZE_FASTOCTREE == PILImage.Quantize.FASTOCTREE
+    assert QUANTIZE_LIBIMAGEQUANT == PILImage.Quantize.LIBIMAGEQUANT
+
+
+def test_get_engine(settings):
+    assert isinstance(get_engine(), GraphicsmagickEngine) is True
+
+    settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+    assert isinstance(get_engine(), PillowEngine) is True
+
+
+def test_supports_format():
+    assert GraphicsmagickEngine().supports_format('WEBP') is True
+    assert GraphicsmagickEngine().supports_format('avif') is False
+
+    assert PillowEngine().supports_format('png') is True
+    assert PillowEngine().supports_format('jxl') is False
+    assert PillowEngine().supports_format('avif') is (get_pillow_format('avif') == 'AVIF')
+
+
+def test_get_pillow_format():
+    assert get_pillow_format('JPG') == 'JPEG'
+    assert get_pillow_format('jxl') is None
+
+    with mock.patch.dict(PILImage.SAVE, clear=True):
+        assert get_pillow_format('png') is None
+
+
+@pytest.mark.django_db
+class TestGraphicsmagickEngine:
+    @mock.patch('ultimatethumb.engines.GraphicsmagickCommand')
+    def test_generate(self, command_mock):
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        GraphicsmagickEngine().generate(thumbnail, 2, '/tmp/out.jpg')
+
+        command_mock.assert_called_once_with(
+            infile=image.file.path, outfile='/tmp/out.jpg', options=thumbnail.get_gm_options(2)
+        )
+        assert command_mock.return_value.execute.called is True
+
+    @mock.patch('ultimatethumb.engines.GraphicsmagickBatchCommand')
+    def test_generate_many(self, command_mock):
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        GraphicsmagickEngine().generate_many(
+            [(thumbnail, 1, '/tmp/out.jpg'), (thumbnail, 2, '/tmp/out2x.jpg')]
+        )
+
+        commands = command_mock.call_args[1]['commands']
+        assert [command.parameters['outfile'] for command in commands] == [
+            '/tmp/out.jpg',
+            '/tmp/out2x.jpg',
+        ]
+        assert command_mock.return_value.execute.called is True
+
+    @mock.patch('ultimatethumb.engines.GraphicsmagickBatchCommand')
+    @mock.patch('ultimatethumb.engines.GraphicsmagickCommand.execute')
+    def test_generate_many_single(self, execute_mock, command_mock):
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        GraphicsmagickEngine().generate_many([(thumbnail, 1, '/tmp/out.jpg')])
+
+        assert execute_mock.called is True
+        assert command_mock.called is False
+
+    @requires_asgiref
+    @mock.patch('ultimatethumb.engines.GraphicsmagickBatchCommand')
+    def test_agenerate_many(self, command_mock):
+        command_mock.return_value.aexecute = mock.AsyncMock(return_value=True)
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        async_to_sync(GraphicsmagickEngine().agenerate_many)(
+            [(thumbnail, 1, '/tmp/out.jpg'), (thumbnail, 2, '/tmp/out2x.jpg')]
+        )
+
+        assert len(command_mock.call_args[1]['commands']) == 2
+        assert command_mock.return_value.aexecute.called is True
+        assert command_mock.return_value.execute.called is False
+
+    @requires_asgiref
+    @mock.patch('ultimatethumb.engines.GraphicsmagickCommand.aexecute', return_value=True)
+    def test_agenerate_many_single(self, aexecute_mock):
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        async_to_sync(GraphicsmagickEngine().agenerate_many)([(thumbnail, 1, '/tmp/out.jpg')])
+        async_to_sync(GraphicsmagickEngine().agenerate_many)([])
+
+        aexecute_mock.assert_called_once_with(fail_silently=True)
+
+
+@pytest.mark.django_db
+class TestPillowEngine:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.tmp_path = tmp_path
+
+    def generate(self, source, options, factor=1, extension=None):
+        thumbnail = Thumbnail(source, options)
+        outfile = str(self.tmp_path / 'out{0}'.format(extension or os.path.splitext(source)[1]))
+        PillowEngine().generate(thumbnail, factor, outfile)
+        return PILImage.open(outfile)
+
+    def test_generate_unsupported_format(self):
+        image = ImageModelFactory.create()
+
+        with pytest.raises(ValueError, match='no encoder for .jxl'):
+            self.generate(image.file.path, {'size': ['50', '50']}, extension='.jxl')
+
+    @pytest.mark.parametrize(
+        'input_size,thumb_size,upscale,crop',
+        [
+            ((100, 200), (600, 300), True, True),
+            ((100, 200), (600, 300), True, False),
+            ((100, 200), (600, 300), False, True),
+            ((200, 400), (100, 50), True, True),
+            ((200, 400), (100, 50), False, False),
+            ((200, 400), (50, 100), False, True),
+            ((100, 200), (600, 200), False, True),
+            ((100, 200), (200, 600), True, False),
+            ((100, 200), (0, 50), False, False),
+            ((100, 200), (50, 0), True, True),
+            ((1000, 2000), (50, 0), False, False),
+            ((1000, 2000), (50, 50), False, True),
+        ],
+    )
+    @pytest.mark.parametrize('factor', [1, 2])
+    def test_generate_size(self, input_size, thumb_size, upscale, crop, factor):
+        image = ImageModelFactory.create(file__width=input_size[0], file__height=input_size[1])
+        thumbnail = Thumbnail(
+            image.file.path,
+            {
+                'size': (str(thumb_size[0]), str(thumb_size[1])),
+                'upscale': upscale,
+                'crop': crop,
+            },
+        )
+
+        result = self.generate(thumbnail.source, thumbnail.options, factor)
+        expected = thumbnail.get_estimated_size()
+        assert result.size == (expected.width * factor, expected.height * factor)
+
+    @pytest.mark.parametrize(
+        'crop,expected',
+        [
+            ('N', (255, 0, 0)),
+            ('S', (0, 0, 255)),
+            ('C', (0, 255, 0)),
+        ],
+    )
+    def test_generate_crop_gravity(self, crop, expected):
+        source = str(self.tmp_path / 'source.png')
+        image = PILImage.new('RGB', (30, 90), (0, 255, 0))
+        image.paste((255, 0, 0), (0, 0, 30, 30))
+        image.paste((0, 0, 255), (0, 60, 30, 90))
+        image.save(source)
+
+        result = self.generate(source, {'size': ['30', '30'], 'crop': crop})
+        assert result.size == (30, 30)
+        assert result.convert('RGB').getpixel((15, 15)) == expected
+
+    def test_generate_strip_profile(self):
+        source = str(self.tmp_path / 'source.jpg')
+        PILImage.new('RGB', (100, 100)).save(source, icc_profile=b'\x00' * 128, exif=b'Exif')
+
+        result = self.generate(source, {'size': ['50', '50']})
+        assert 'icc_profile' not in result.info
+        assert 'exif' not in result.info
+
+    def test_generate_quality(self):
+        source = str(self.tmp_path / 'source.jpg')
+        PILImage.effect_mandelbrot((400, 400), (-2, -1.5, 1, 1.5), 100).convert('RGB').save(
+            source
+        )
+
+        low = os.path.getsize(
+            self.generate(source, {'size': ['200', '0'], 'quality': 10}).filename
+        )
+        high = os.path.getsize(
+            self.generate(
+                source, {'size': ['200', '0'], 'quality': 95}, extension='.jpeg'
+            ).filename
+        )
+        assert low < high
+
+    def test_generate_profile(self):
+        source = str(self.tmp_path / 'source.jpg')
+        PILImage.effect_mandelbrot((800, 800), (-2, -1.5, 1, 1.5), 100).convert('RGB').save(
+            source, quality=95, subsampling=0
+        )
+
+        default = self.generate(source, {'size': ['400', '0']}, extension='.jpeg')
+        optimized = self.generate(source, {'size': ['400', '0'], 'profile': 'web'})
+
+        assert 'progressive' not in default.info
+        assert optimized.info['progressive'] == 1
+        assert optimized.layer[0][1:3] == (2, 2)
+        assert os.path.getsize(optimized.filename) < os.path.getsize(
+            default.filename
+        ), 'default {0} bytes, web profile {1} bytes'.format(
+            os.path.getsize(default.filename), os.path.getsize(optimized.filename)
+        )
+
+    def test_generate_png_alpha(self):
+        source = str(self.tmp_path / 'source.png')
+        PILImage.new('RGBA', (100, 100), (255, 0, 0, 0)).save(source)
+
+        result = self.generate(source, {'size': ['50', '50']})
+        assert result.mode == 'RGBA'
+        assert result.getpixel((0, 0))[3] == 0
+
+    def test_generate_pngquant(self):
+        source = str(self.tmp_path / 'source.png')
+        PILImage.effect_mandelbrot((400, 400), (-2, -1.5, 1, 1.5), 100).convert('RGB').save(
+            source
+        )
+
+        default = self.generate(source, {'size': ['200', '0']})
+        quantized = self.generate(
+            source, {'size': ['200', '0'], 'pngquant': '60-80'}, extension='.PNG'
+        )
+
+        assert default.mode == 'RGB'
+        assert quantized.mode == 'P'
+        assert len(quantized.getcolors()) <= 84
+        assert os.path.getsize(quantized.filename) < os.path.getsize(default.filename)
+
+    def test_generate_pngquant_alpha(self):
+        source = str(self.tmp_path / 'source.png')
+        image = PILImage.new('RGBA', (100, 100), (255, 0, 0, 0))
+        image.paste((0, 0, 255, 255), (0, 0, 50, 100))
+        image.save(source)
+
+        result = self.generate(source, {'size': ['50', '50'], 'pngquant': 50})
+        assert result.mode == 'P'
+        assert result.convert('RGBA').getpixel((0, 0))[2:] > (250, 250)
+        assert result.convert('RGBA').getpixel((49, 0))[3] == 0
+
+    def test_generate_pngquant_external(self, settings):
+        settings.ULTIMATETHUMB_PNGQUANT_EXTERNAL = True
+        source = str(self.tmp_path / 'source.png')
+        PILImage.new('RGB', (100, 100), (255, 0, 0)).save(source)
+
+        result = self.generate(source, {'size': ['50', '50'], 'pngquant': 50})
+        assert result.mode == 'RGB'
+
+    def test_generate_png_palette(self):
+        source = str(self.tmp_path / 'source.png')
+        PILImage.new('RGB', (100, 100), (255, 0, 0)).convert('P').save(source)
+
+        result = self.generate(source, {'size': ['50', '50']})
+        assert result.size == (50, 50)
+
+    def test_generate_gif(self):
+        source = str(self.tmp_path / 'source.gif')
+        PILImage.new('RGB', (100, 100), (255, 0, 0)).save(source)
+
+        result = self.generate(source, {'size': ['50', '50']})
+        assert result.format == 'GIF'
+        assert result.size == (50, 50)
+
+    def test_generate_ico(self):
+        source = str(self.tmp_path / 'source.ico')
+        PILImage.new('RGBA', (64, 64), (255, 0, 0, 255)).save(source)
+
+        result = self.generate(source, {'size': ['50', '50']})
+        assert result.format == 'ICO'
+        assert result.size == (50, 50)
+
+    def test_generate_many(self):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        small = Thumbnail(image.file.path, {'size': ['100', '0']})
+        large = Thumbnail(image.file.path, {'size': ['200', '0']})
+        outfiles = [str(self.tmp_path / 'out{0}.jpg'.format(i)) for i in range(3)]
+        # Warm the size cache, only the decoding of the source should be counted.
+        small.get_estimated_size()
+
+        with mock.patch(
+            'ultimatethumb.engines.PILImage.open', wraps=PILImage.open
+        ) as open_mock:
+            PillowEngine().generate_many(
+                [(small, 1, outfiles[0]), (small, 2, outfiles[1]), (large, 1, outfiles[2])]
+            )
+
+        assert open_mock.call_count == 1
+        assert [PILImage.open(outfile).size for outfile in outfiles] == [
+            (100, 50),
+            (200, 100),
+            (200, 100),
+        ]
+
+    @requires_asgiref
+    def test_agenerate_many(self):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnail = Thumbnail(image.file.path, {'size': ['100', '0']})
+        outfile = str(self.tmp_path / 'out.jpg')
+
+        async_to_sync(PillowEngine().agenerate_many)([(thumbnail, 1, outfile)])
+
+        assert PILImage.open(outfile).size == (100, 50)
+
+    @mock.patch('ultimatethumb.engines.GraphicsmagickEngine.generate')
+    def test_generate_animated_fallback(self, generate_mock):
+        source = str(self.tmp_path / 'source.gif')
+        frames = [PILImage.new('RGB', (100, 100), color) for color in ('red', 'blue')]
+        frames[0].save(source, save_all=True, append_images=frames[1:])
+
+        thumbnail = Thumbnail(source, {'size': ['50', '50']})
+        PillowEngine().generate(thumbnail, 1, str(self.tmp_path / 'out.gif'))
+        generate_mock.assert_called_once_with(thumbnail, 1, str(self.tmp_path / 'out.gif'))
+
+    def test_get_resize_size(self):
+        engine = PillowEngine()
+        assert engine.get_resize_size((100, 200), Size(50, 50), '>') == (25, 50)
+        assert engine.get_resize_size((100, 200), Size(50, 50), '^') == (50, 100)
+        assert engine.get_resize_size((100, 200), Size(400, 400), '>') == (100, 200)
+        assert engine.get_resize_size((100, 200), Size(400, 400), '') == (200, 400)
+        assert engine.get_resize_size((100, 200), Size(0, 100), '') == (50, 100)
+        assert engine.get_resize_size((100, 200), Size(0, 0), '') == (100, 200)
+
+    @mock.patch('ultimatethumb.engines.PILImage.Image.reduce')
+    def test_resize_reduce(self, reduce_mock):
+        reduce_mock.return_value = PILImage.new('RGB', (250, 250))
+        PillowEngine().resize(PILImage.new('RGB', (1000, 1000)), (100, 100))
+        reduce_mock.assert_called_once_with(5)
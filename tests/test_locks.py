@@ -0,0 +1,461 @@
+import asyncio
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+
+from tests.factories.mockapp import ImageModelFactory
+from tests.resources.compat import async_to_sync, requires_asgiref
+from ultimatethumb.locks import (
+    CacheLock,
+    DummyLock,
+    FileLock,
+    GenerationLimiter,
+    GenerationRejected,
+    SlotLock,
+    get_available_cpus,
+    get_cgroup_cpu_quota,
+    get_generation_limiter,
+    get_generation_lock,
+    get_generation_semaphore,
+    lock_file,
+    unlock_file,
+)
+from ultimatethumb.storage import thumbnail_storage
+from ultimatethumb.thumbnail import Thumbnail, agenerate_thumbnails, generate_thumbnails
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def test_get_generation_lock(settings):
+    lock = get_generation_lock('abc/test.jpg')
+    assert isinstance(lock, FileLock) is True
+    assert lock.timeout == 30
+
+    settings.ULTIMATETHUMB_GENERATION_LOCK = 'ultimatethumb.locks.CacheLock'
+    settings.ULTIMATETHUMB_GENERATION_LOCK_TIMEOUT = 5
+    lock = get_generation_lock('abc/test.jpg')
+    assert isinstance(lock, CacheLock) is True
+    assert lock.timeout == 5
+
+
+def test_dummy_lock():
+    with DummyLock('abc/test.jpg') as lock:
+        assert lock.locked is True
+        assert DummyLock('abc/test.jpg').acquire() is True
+
+
+@pytest.mark.parametrize('lock_class', [FileLock, CacheLock])
+class TestLocks:
+    def test_acquire_release(self, lock_class):
+        lock = lock_class('abc/test.jpg', timeout=1)
+        other = lock_class('abc/test.jpg', timeout=1)
+
+        assert lock.acquire() is True
+        assert other.acquire(blocking=False) is False
+        assert lock_class('abc/other.jpg').acquire(blocking=False) is True
+
+        lock.release()
+        assert other.acquire(blocking=False) is True
+        other.release()
+
+    def test_acquire_timeout(self, lock_class):
+        lock = lock_class('abc/test.jpg', timeout=1)
+        other = lock_class('abc/test.jpg', timeout=0.2)
+
+        with lock:
+            start = time.monotonic()
+            assert other.acquire() is False
+            assert time.monotonic() - start >= 0.2
+
+    def test_acquire_wait(self, lock_class):
+        lock = lock_class('abc/test.jpg', timeout=1)
+        other = lock_class('abc/test.jpg', timeout=5)
+
+        lock.acquire()
+        threading.Timer(0.2, lock.release).start()
+        assert other.acquire() is True
+        other.release()
+
+    @requires_asgiref
+    def test_aacquire(self, lock_class):
+        lock = lock_class('abc/test.jpg', timeout=1)
+        other = lock_class('abc/test.jpg', timeout=5)
+
+        lock.acquire()
+        assert async_to_sync(other.aacquire)(blocking=False) is False
+
+        threading.Timer(0.2, lock.release).start()
+        assert async_to_sync(other.aacquire)() is True
+        assert lock.acquire(blocking=False) is False
+
+        async_to_sync(other.arelease)()
+        assert other.locked is False
+        assert lock.acquire(blocking=False) is True
+        lock.release()
+
+    def test_release_not_acquired(self, lock_class):
+        lock = lock_class('abc/test.jpg')
+        lock.release()
+        assert lock.locked is False
+
+
+class TestAvailableCpus:
+    def test_cgroup_v2(self, tmp_path):
+        (tmp_path / 'cpu.max').write_text('150000 100000\n')
+        assert get_cgroup_cpu_quota(str(tmp_path)) == 1.5
+
+        (tmp_path / 'cpu.max').write_text('max 100000\n')
+        assert get_cgroup_cpu_quota(str(tmp_path)) is None
+
+    def test_cgroup_v1(self, tmp_path):
+        (tmp_path / 'cpu').mkdir()
+        (tmp_path / 'cpu' / 'cpu.cfs_quota_us').write_text('200000\n')
+        (tmp_path / 'cpu' / 'cpu.cfs_period_us').write_text('100000\n')
+        assert get_cgroup_cpu_quota(str(tmp_path)) == 2
+
+        (tmp_path / 'cpu' / 'cpu.cfs_quota_us').write_text('-1\n')
+        assert get_cgroup_cpu_quota(str(tmp_path)) is None
+
+    def test_cgroup_missing(self, tmp_path):
+        assert get_cgroup_cpu_quota(str(tmp_path)) is None
+
+    @pytest.mark.parametrize('quota,expected', [(None, 8), (1.5, 2), (0.5, 1), (16, 8)])
+    def test_get_available_cpus(self, quota, expected):
+        with mock.patch(
+            'ultimatethumb.locks.os.sched_getaffinity', return_value=set(range(8)), create=True
+        ), mock.patch('ultimatethumb.locks.get_cgroup_cpu_quota', return_value=quota):
+            assert get_available_cpus() == expected
+
+
+def test_get_generation_semaphore(settings):
+    settings.ULTIMATETHUMB_ASYNC_GENERATION_CONCURRENCY = 2
+
+    async def get_semaphores():
+        return get_generation_semaphore(), get_generation_semaphore()
+
+    first, second = asyncio.run(get_semaphores())
+    assert first is second
+    assert first._value == 2
+
+    # Every event loop has its own semaphore.
+    assert asyncio.run(get_semaphores())[0] is not first
+
+
+def test_get_generation_limiter(settings):
+    assert get_generation_limiter().slots is None
+
+    settings.ULTIMATETHUMB_ADMISSION_CONTROL = True
+    limiter = get_generation_limiter()
+    assert limiter.slots == get_available_cpus()
+    assert limiter.queue_size == limiter.slots
+    assert limiter.global_slots is None
+
+    settings.ULTIMATETHUMB_GENERATION_SLOTS = 2
+    settings.ULTIMATETHUMB_GLOBAL_GENERATION_SLOTS = 10
+    settings.ULTIMATETHUMB_GENERATION_QUEUE_SIZE = 4
+    settings.ULTIMATETHUMB_GENERATION_QUEUE_TIMEOUT = 1
+    limiter = get_generation_limiter()
+    assert (limiter.slots, limiter.global_slots, limiter.queue_size) == (2, 10, 4)
+    assert limiter.queue_timeout == 1
+
+
+class TestGenerationLimiter:
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+
+    def test_slot_lock_path(self, settings, tmp_path):
+        path = SlotLock('slot-0').get_lock_path()
+        assert os.path.dirname(os.path.dirname(path)) == str(tmp_path)
+        assert os.path.basename(os.path.dirname(path)).startswith('ultimatethumb-slots-')
+        assert os.path.basename(path) == 'slot-0.lock'
+
+        # Projects don't share the slots.
+        settings.ULTIMATETHUMB_ROOT = str(tmp_path / 'other')
+        assert SlotLock('slot-0').get_lock_path() != path
+
+        settings.ULTIMATETHUMB_GENERATION_SLOTS_ROOT = str(tmp_path / 'slots')
+        assert SlotLock('slot-0').get_lock_path() == str(tmp_path / 'slots' / 'slot-0.lock')
+
+    def test_slot_lock_error(self, settings, tmp_path):
+        (tmp_path / 'slots').write_text('')
+        settings.ULTIMATETHUMB_GENERATION_SLOTS_ROOT = str(tmp_path / 'slots')
+
+        assert SlotLock('slot-0').acquire(blocking=False) is False
+        assert GenerationLimiter(slots=1).acquire() is False
+
+    def test_disabled(self):
+        limiters = [GenerationLimiter(slots=None) for i in range(3)]
+        assert all(limiter.acquire() for limiter in limiters) is True
+
+    def test_acquire_release(self):
+        limiter = GenerationLimiter(slots=2)
+        other = GenerationLimiter(slots=2)
+        rejected = GenerationLimiter(slots=2)
+
+        assert limiter.acquire() is True
+        assert other.acquire() is True
+        assert rejected.acquire() is False
+
+        limiter.release()
+        assert rejected.acquire() is True
+        other.release()
+        rejected.release()
+
+    def test_queue(self):
+        limiter = GenerationLimiter(slots=1)
+        queued = GenerationLimiter(slots=1, queue_size=1, queue_timeout=5)
+
+        limiter.acquire()
+        threading.Timer(0.2, limiter.release).start()
+        start = time.monotonic()
+        assert queued.acquire() is True
+        assert time.monotonic() - start >= 0.2
+        queued.release()
+
+    def test_queue_full(self):
+        limiter = GenerationLimiter(slots=1)
+        rejected = GenerationLimiter(slots=1, queue_size=1, queue_timeout=5)
+
+        limiter.acquire()
+        with SlotLock('queue-0'):
+            start = time.monotonic()
+            assert rejected.acquire() is False
+            assert time.monotonic() - start < 1
+        limiter.release()
+
+    def test_queue_timeout(self):
+        limiter = GenerationLimiter(slots=1)
+        queued = GenerationLimiter(slots=1, queue_size=1, queue_timeout=0.1)
+
+        limiter.acquire()
+        assert queued.acquire() is False
+        # The queue position is released.
+        assert SlotLock('queue-0').acquire(blocking=False) is True
+        limiter.release()
+
+    def test_global_slots(self):
+        cache.clear()
+        limiter = GenerationLimiter(slots=2, global_slots=1)
+        rejected = GenerationLimiter(slots=2, global_slots=1)
+
+        assert limiter.acquire() is True
+        assert rejected.acquire() is False
+        # The slot of the host is released if no global slot is free.
+        assert SlotLock('slot-1').acquire(blocking=False) is True
+
+        limiter.release()
+        assert cache.get(CacheLock('global-slot-0').cache_key) is None
+
+    @requires_asgiref
+    def test_aacquire(self):
+        assert async_to_sync(GenerationLimiter(slots=None).aacquire)() is True
+
+        limiter = GenerationLimiter(slots=1)
+        queued = GenerationLimiter(slots=1, queue_size=1, queue_timeout=5)
+        rejected = GenerationLimiter(slots=1)
+
+        assert async_to_sync(limiter.aacquire)() is True
+        assert async_to_sync(rejected.aacquire)() is False
+
+        threading.Timer(0.2, limiter.release).start()
+        assert async_to_sync(queued.aacquire)() is True
+        async_to_sync(queued.arelease)()
+        assert queued.locks == []
+
+
+def test_file_lock_other_fd():
+    lock = FileLock('abc/test.jpg')
+    lock_path = lock.get_lock_path()
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert lock.try_acquire() is False
+
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        assert lock.try_acquire() is True
+        lock.locked = True
+        lock.release()
+    finally:
+        os.close(fd)
+
+
+def test_lock_file(tmp_path):
+    fds = [os.open(str(tmp_path / 'test.lock'), os.O_RDWR | os.O_CREAT) for i in range(2)]
+    try:
+        assert lock_file(fds[0], blocking=False) is True
+        assert lock_file(fds[1], blocking=False) is False
+
+        unlock_file(fds[0])
+        assert lock_file(fds[1]) is True
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_file_lock_path():
+    assert FileLock('abc/test.jpg').get_lock_path() == os.path.join(
+        thumbnail_storage.path('abc'), '.test.jpg.lock'
+    )
+
+
+def test_file_lock_remove():
+    lock = FileLock('abc/test.jpg')
+    waiting = FileLock('abc/test.jpg')
+
+    assert lock.acquire(blocking=False) is True
+    assert waiting.acquire(blocking=False) is False
+    lock.release()
+    assert os.path.exists(lock.get_lock_path()) is False
+
+    # The waiting lock opened the removed file, it locks the new one.
+    other = FileLock('abc/test.jpg')
+    assert waiting.acquire(blocking=False) is True
+    assert other.acquire(blocking=False) is False
+    waiting.release()
+    other.release()
+
+
+@pytest.mark.django_db
+class TestGenerateThumbnails:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.image = ImageModelFactory.create(file__width=400, file__height=200)
+        self.thumbnails = [
+            Thumbnail(self.image.file.path, {'size': [str(width), '0']}) for width in (50, 100)
+        ]
+
+    @mock.patch('ultimatethumb.thumbnail._generate_thumbnails')
+    def test_skip_existing(self, generate_mock):
+        with mock.patch('ultimatethumb.thumbnail.Thumbnail.exists', side_effect=[True, False]):
+            generate_thumbnails([(self.thumbnails[0], 1), (self.thumbnails[1], 1)])
+
+        generate_mock.assert_called_once_with([(self.thumbnails[1], 1)])
+
+    @mock.patch('ultimatethumb.thumbnail._generate_thumbnails')
+    def test_skip_locked(self, generate_mock):
+        with FileLock(self.thumbnails[1].get_storage_name()):
+            generate_thumbnails([(self.thumbnails[0], 1), (self.thumbnails[1], 1)])
+
+        generate_mock.assert_called_once_with([(self.thumbnails[0], 1)])
+
+    @mock.patch('ultimatethumb.thumbnail._generate_thumbnails')
+    def test_wait_for_first(self, generate_mock, settings):
+        settings.ULTIMATETHUMB_GENERATION_LOCK_TIMEOUT = 5
+        lock = FileLock(self.thumbnails[0].get_storage_name())
+        lock.acquire()
+
+        # The thumbnail exists once the other process released the lock.
+        with mock.patch('ultimatethumb.thumbnail.Thumbnail.exists', return_value=True):
+            start = time.monotonic()
+            threading.Timer(0.2, lock.release).start()
+            generate_thumbnails([(self.thumbnails[0], 1)])
+
+        assert time.monotonic() - start >= 0.2
+        assert generate_mock.called is False
+
+    @mock.patch('ultimatethumb.thumbnail._generate_thumbnails')
+    def test_timeout(self, generate_mock, settings):
+        settings.ULTIMATETHUMB_GENERATION_LOCK_TIMEOUT = 0.1
+
+        with FileLock(self.thumbnails[0].get_storage_name()):
+            generate_thumbnails([(self.thumbnails[0], 1)])
+
+        generate_mock.assert_called_once_with([(self.thumbnails[0], 1)])
+
+    def test_limiter(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        limiter = GenerationLimiter(slots=1)
+
+        def generate(items):
+            # The slot is held while the engine runs.
+            assert GenerationLimiter(slots=1).acquire() is False
+
+        with mock.patch('ultimatethumb.thumbnail._generate_thumbnails', side_effect=generate):
+            generate_thumbnails([(self.thumbnails[0], 1)], limiter=limiter)
+
+        assert limiter.locks == []
+
+    @mock.patch('ultimatethumb.thumbnail._generate_thumbnails')
+    def test_limiter_rejected(self, generate_mock, monkeypatch, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        other = GenerationLimiter(slots=1)
+        other.acquire()
+
+        with pytest.raises(GenerationRejected):
+            generate_thumbnails([(self.thumbnails[0], 1)], limiter=GenerationLimiter(slots=1))
+
+        assert generate_mock.called is False
+        # The generation lock is released.
+        lock = FileLock(self.thumbnails[0].get_storage_name())
+        assert lock.acquire(blocking=False) is True
+        lock.release()
+
+        # Thumbnails generated by someone else don't need a slot.
+        with mock.patch('ultimatethumb.thumbnail.Thumbnail.exists', return_value=True):
+            generate_thumbnails([(self.thumbnails[0], 1)], limiter=GenerationLimiter(slots=1))
+        other.release()
+
+    @requires_asgiref
+    @mock.patch('ultimatethumb.thumbnail._agenerate_thumbnails')
+    def test_async_limiter_rejected(self, generate_mock, monkeypatch, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        other = GenerationLimiter(slots=1)
+        other.acquire()
+
+        with pytest.raises(GenerationRejected):
+            async_to_sync(agenerate_thumbnails)(
+                [(self.thumbnails[0], 1)], limiter=GenerationLimiter(slots=1)
+            )
+
+        other.release()
+        assert generate_mock.called is False
+
+    @requires_asgiref
+    @mock.patch('ultimatethumb.thumbnail._agenerate_thumbnails')
+    def test_async_skip_locked(self, generate_mock):
+        with FileLock(self.thumbnails[1].get_storage_name()):
+            async_to_sync(agenerate_thumbnails)(
+                [(self.thumbnails[0], 1), (self.thumbnails[1], 1)]
+            )
+
+        generate_mock.assert_called_once_with([(self.thumbnails[0], 1)])
+        # All locks are released.
+        assert FileLock(self.thumbnails[0].get_storage_name()).acquire(blocking=False) is True
+
+    @requires_asgiref
+    @mock.patch('ultimatethumb.thumbnail._store_thumbnails')
+    def test_async_concurrency(self, store_mock, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_ASYNC_GENERATION_CONCURRENCY = 1
+        running = []
+        peaks = []
+
+        async def generate_many(engine, items):
+            running.append(items)
+            peaks.append(len(running))
+            await asyncio.sleep(0.1)
+            running.remove(items)
+
+        async def generate():
+            await asyncio.gather(
+                *[agenerate_thumbnails([(thumbnail, 1)]) for thumbnail in self.thumbnails]
+            )
+
+        with mock.patch('ultimatethumb.engines.PillowEngine.agenerate_many', generate_many):
+            async_to_sync(generate)()
+
+        assert store_mock.call_count == 2
+        assert peaks == [1, 1]
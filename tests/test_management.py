@@ -0,0 +1,189 @@
+import os
+from io import StringIO
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from tests.factories.mockapp import ImageModelFactory
+from ultimatethumb.management.commands.ultimatethumb_cleanup import parse_size
+from ultimatethumb.storage import thumbnail_storage
+from ultimatethumb.thumbnail import ThumbnailSet
+
+
+@pytest.mark.django_db
+class TestWarmCommand:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings, tmp_path):
+        cache.clear()
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.MEDIA_ROOT = str(tmp_path / 'media')
+        self.tmp_path = tmp_path
+        self.images = [
+            ImageModelFactory.create(file__width=400, file__height=200) for i in range(2)
+        ]
+        yield
+        cache.clear()
+
+    def call(self, *args, **kwargs):
+        stdout = StringIO()
+        call_command('ultimatethumb_warm', *args, stdout=stdout, stderr=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_warm(self):
+        output = self.call('**/*.jpg', sizes='50x0,100x0', processes=1)
+
+        assert 'Warmed 2 sources' in output
+        assert '8 generated, 0 existing, 0 errors' in output
+
+        for image in self.images:
+            for thumbnail in ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails:
+                assert thumbnail.exists() is True
+                assert thumbnail.exists(factor=2) is True
+
+    def test_warm_existing(self):
+        self.call('**/*.jpg', sizes='50x0', processes=1)
+        output = self.call('**/*.jpg', sizes='50x0', processes=1)
+
+        assert '0 generated, 4 existing, 0 errors' in output
+
+    def test_warm_options(self):
+        output = self.call(
+            '**/*.jpg', sizes='50x50', crop='N', retina=False, quality=50, processes=1
+        )
+        assert '2 generated' in output
+
+        thumbnail_set = ThumbnailSet(
+            self.images[0].file.path,
+            '50x50',
+            {'upscale': False, 'factor2x': False, 'crop': 'N', 'quality': 50},
+        )
+        assert thumbnail_set.thumbnails[0].exists() is True
+
+    def test_warm_pngquant_range(self):
+        output = self.call('**/*.jpg', '--pngquant=60-80', sizes='50x0', processes=1)
+        assert '4 generated' in output
+
+        thumbnail_set = ThumbnailSet(self.images[0].file.path, '50x0', {'pngquant': '60-80'})
+        assert thumbnail_set.thumbnails[0].exists() is True
+
+    def test_warm_pool(self):
+        output = self.call('**/*.jpg', sizes='50x0', processes=2)
+
+        assert '4 generated, 0 existing, 0 errors' in output
+
+    def test_warm_verbose(self):
+        output = self.call('**/*.jpg', sizes='50x0', processes=1, verbosity=2)
+
+        assert '[1/2] {0}: 2 generated, 0 existing'.format(self.images[0].file.path) in output
+
+    def test_warm_static(self, settings):
+        settings.DEBUG = True
+        output = self.call('static:*.png', 'static:*.txt', sizes='20x0', processes=1)
+
+        assert 'Warmed 1 sources' in output
+        assert '2 generated' in output
+
+    def test_warm_file_list(self):
+        file_list = self.tmp_path / 'sources.txt'
+        file_list.write_text('{0}\n\n'.format(self.images[0].file.path))
+
+        output = self.call(sizes='50x0', file_list=str(file_list), processes=1)
+
+        assert 'Warmed 1 sources' in output
+
+    def test_warm_checkpoint(self):
+        checkpoint = str(self.tmp_path / 'checkpoint')
+
+        with mock.patch(
+            'ultimatethumb.management.commands.ultimatethumb_warm.warm_source',
+            side_effect=[(2, 0), OSError('failed')],
+        ):
+            output = self.call('**/*.jpg', sizes='50x0', processes=1, checkpoint=checkpoint)
+
+        assert '1 errors' in output
+        with open(checkpoint) as checkpoint_file:
+            assert checkpoint_file.read().splitlines()[1:] == [self.images[0].file.path]
+
+        output = self.call('**/*.jpg', sizes='50x0', processes=1, checkpoint=checkpoint)
+        assert 'Warmed 1 sources' in output
+
+        with open(checkpoint) as checkpoint_file:
+            assert len(checkpoint_file.read().splitlines()) == 3
+
+    def test_warm_checkpoint_other_options(self):
+        checkpoint = str(self.tmp_path / 'checkpoint')
+        self.call('**/*.jpg', sizes='50x0', processes=1, checkpoint=checkpoint)
+
+        with pytest.raises(CommandError):
+            self.call('**/*.jpg', sizes='60x0', processes=1, checkpoint=checkpoint)
+
+    def test_invalid_sizes(self):
+        with pytest.raises(CommandError):
+            self.call('**/*.jpg', sizes='foo', processes=1)
+
+    def test_no_sources(self):
+        with pytest.raises(CommandError):
+            self.call(sizes='50x0', processes=1)
+
+    def test_no_matches(self):
+        output = self.call(os.path.join(str(self.tmp_path), '*.png'), sizes='50x0')
+
+        assert 'Warmed 0 sources' in output
+
+
+@pytest.mark.django_db
+class TestCleanupCommand:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings, tmp_path):
+        cache.clear()
+        root = settings.ULTIMATETHUMB_ROOT
+        settings.ULTIMATETHUMB_ROOT = str(tmp_path)
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        thumbnail_storage._setup()
+
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        self.thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+        for thumbnail in self.thumbnails:
+            thumbnail.generate()
+            thumbnail.generate(factor=2)
+
+        yield
+        settings.ULTIMATETHUMB_ROOT = root
+        thumbnail_storage._setup()
+        cache.clear()
+
+    def call(self, *args, **kwargs):
+        stdout = StringIO()
+        call_command('ultimatethumb_cleanup', *args, stdout=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_cleanup(self):
+        output = self.call(max_files=0)
+
+        # Thumbnails and retina versions, the lock files are removed after generating.
+        assert 'Found 2 thumbnails (4 files' in output
+        assert 'Removed 2 thumbnails (4 files' in output
+        assert self.thumbnails[0].exists() is False
+
+    def test_cleanup_dry_run(self):
+        output = self.call(max_size='1M', dry_run=True)
+
+        assert 'Would remove 0 thumbnails' in output
+
+        output = self.call(max_size='0', dry_run=True)
+
+        assert 'Would remove 2 thumbnails' in output
+        assert self.thumbnails[0].exists() is True
+
+    def test_cleanup_invalid_size(self):
+        with pytest.raises(CommandError):
+            self.call(max_size='foo')
+
+    def test_parse_size(self):
+        assert parse_size('100') == 100
+        assert parse_size('2k') == 2048
+        assert parse_size('10M') == 10 * 1024**2
+        assert parse_size('1GB') == 1024**3
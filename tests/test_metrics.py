@@ -0,0 +1,238 @@
+import os
+import tempfile
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.http import Http404
+
+from tests.factories.mockapp import ImageModelFactory
+from ultimatethumb.locks import GenerationLimiter
+from ultimatethumb.metrics import (
+    MemoryMetrics,
+    NullMetrics,
+    collect_timings,
+    format_labels,
+    metrics,
+)
+from ultimatethumb.signals import thumbnail_generated, thumbnail_generation_failed
+from ultimatethumb.thumbnail import Thumbnail, get_source_sizes
+from ultimatethumb.views import MetricsView
+
+
+@pytest.fixture
+def memory_metrics(settings):
+    settings.ULTIMATETHUMB_METRICS = 'ultimatethumb.metrics.MemoryMetrics'
+    metrics._setup()
+    cache.clear()
+
+    yield metrics
+
+    del settings.ULTIMATETHUMB_METRICS
+    metrics._setup()
+    cache.clear()
+
+
+def test_format_labels():
+    assert format_labels(()) == ''
+    assert format_labels((('a', 1), ('b', 'x"y\\z\n'))) == '{a="1",b="x\\"y\\\\z\\n"}'
+
+
+def test_default_backend():
+    metrics._setup()
+    assert type(metrics._wrapped) is NullMetrics
+    assert metrics.enabled is False
+    assert MemoryMetrics().enabled is True
+
+
+def test_collect_timings():
+    backend = NullMetrics()
+    with backend.timer('duration_seconds', stage='outside'):
+        pass
+
+    with collect_timings() as timings:
+        with backend.timer('duration_seconds', stage='engine'):
+            with backend.timer('duration_seconds', stage='decode'):
+                pass
+        with backend.timer('duration_seconds'):
+            pass
+
+    assert [stage for stage, duration in timings] == ['decode', 'engine']
+    assert all(duration >= 0 for stage, duration in timings)
+
+
+class TestMemoryMetrics:
+    def test_increment(self):
+        backend = MemoryMetrics()
+        backend.increment('requests_total', status=200)
+        backend.increment('requests_total', 2, status=200)
+        backend.increment('requests_total', status=404)
+
+        assert backend.get_counter('requests_total', status=200) == 3
+        assert backend.get_counter('requests_total', status=404) == 1
+        assert backend.get_counter('requests_total', status=500) == 0
+
+    def test_observe(self):
+        backend = MemoryMetrics()
+        backend.observe('duration_seconds', 0.5, stage='engine')
+        backend.observe('duration_seconds', 1.5, stage='engine')
+
+        assert backend.get_summary('duration_seconds', stage='engine') == (2, 2.0)
+        assert backend.get_summary('duration_seconds', stage='save') == (0, 0)
+
+    def test_timer(self):
+        backend = MemoryMetrics()
+        with pytest.raises(ValueError):
+            with backend.timer('duration_seconds'):
+                raise ValueError
+
+        assert backend.get_summary('duration_seconds')[0] == 1
+
+    def test_render(self):
+        backend = MemoryMetrics()
+        backend.increment('b_total', stage='x')
+        backend.increment('a_total')
+        backend.observe('c_seconds', 0.25, stage='engine')
+        backend.observe('c_seconds', 0.5, stage='engine')
+
+        assert backend.render() == (
+            '# TYPE a_total counter\n'
+            'a_total 1\n'
+            '# TYPE b_total counter\n'
+            'b_total{stage="x"} 1\n'
+            '# TYPE c_seconds summary\n'
+            'c_seconds_count{stage="engine"} 2\n'
+            'c_seconds_sum{stage="engine"} 0.75\n'
+        )
+
+        backend.reset()
+        assert backend.render() == ''
+
+
+@pytest.mark.django_db
+class TestInstrumentation:
+    @pytest.fixture(autouse=True)
+    def setup(self, memory_metrics, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': ['50', '50']})
+
+    def test_generate(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        thumbnail_generated.connect(receiver)
+        try:
+            self.thumbnail.generate()
+        finally:
+            thumbnail_generated.disconnect(receiver)
+
+        size = os.path.getsize(self.thumbnail.get_storage_path(generate=False))
+        assert metrics.get_counter('ultimatethumb_generated_total', format='jpg') == 1
+        assert metrics.get_counter('ultimatethumb_output_bytes_total', format='jpg') == size
+        assert metrics.get_counter('ultimatethumb_source_bytes_total') == os.path.getsize(
+            self.image.file.path
+        )
+        for stage in ('lock', 'engine', 'decode', 'resize', 'encode', 'save'):
+            assert metrics.get_summary('ultimatethumb_stage_seconds', stage=stage)[0] == 1
+
+        assert len(received) == 1
+        assert received[0]['thumbnail'] is self.thumbnail
+        assert received[0]['factor'] == 1
+        assert received[0]['size'] == size
+
+    def test_source_sizes(self, settings):
+        other = Thumbnail(self.image.file.path, {'size': ['20', '20']})
+        items = [(self.thumbnail, 1), (self.thumbnail, 2), (other, 1)]
+
+        with mock.patch(
+            'ultimatethumb.thumbnail.get_source_path', side_effect=lambda source: source
+        ) as source_path_mock:
+            assert get_source_sizes(items) == {
+                self.image.file.path: os.path.getsize(self.image.file.path)
+            }
+        assert source_path_mock.call_count == 1
+
+        settings.ULTIMATETHUMB_METRICS = 'ultimatethumb.metrics.NullMetrics'
+        metrics._setup()
+        assert get_source_sizes(items) == {}
+
+    def test_generate_failure(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        thumbnail_generation_failed.connect(receiver)
+        try:
+            with mock.patch(
+                'ultimatethumb.engines.PillowEngine.generate_many', side_effect=OSError
+            ):
+                with pytest.raises(OSError):
+                    self.thumbnail.generate()
+        finally:
+            thumbnail_generation_failed.disconnect(receiver)
+
+        assert metrics.get_counter('ultimatethumb_generation_failures_total') == 1
+        assert metrics.get_counter('ultimatethumb_generated_total', format='jpg') == 0
+        assert received[0]['items'] == [(self.thumbnail, 1)]
+        assert isinstance(received[0]['exception'], OSError)
+
+    def test_exists(self):
+        assert self.thumbnail.exists() is False
+        self.thumbnail.generate()
+        assert self.thumbnail.exists() is True
+
+        assert metrics.get_counter('ultimatethumb_exists_checks_total', result='hit') == 1
+        # The generation checks for existing thumbnails after acquiring the lock.
+        assert metrics.get_counter('ultimatethumb_exists_checks_total', result='miss') == 2
+
+    def test_registry(self):
+        Thumbnail.from_name(self.thumbnail.get_name())
+        with pytest.raises(KeyError):
+            Thumbnail.from_name('{0}/unknown.jpg'.format('a' * 40))
+
+        assert metrics.get_counter('ultimatethumb_registry_lookups_total', result='cache') == 1
+        assert metrics.get_counter('ultimatethumb_registry_lookups_total', result='miss') == 1
+
+    def test_probe(self):
+        self.thumbnail.get_estimated_size()
+
+        assert metrics.get_summary('ultimatethumb_stage_seconds', stage='probe')[0] == 1
+
+    def test_admission(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        limiter = GenerationLimiter(slots=1)
+
+        assert limiter.acquire() is True
+        assert GenerationLimiter(slots=1).acquire() is False
+        assert GenerationLimiter(slots=1, queue_size=1, queue_timeout=0.1).acquire() is False
+        limiter.release()
+
+        for result in ('admitted', 'rejected', 'timeout'):
+            assert metrics.get_counter('ultimatethumb_admissions_total', result=result) == 1
+        assert metrics.get_summary('ultimatethumb_stage_seconds', stage='queue')[0] == 1
+
+    def test_view(self, client, rf, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'inline'
+        client.get(self.thumbnail.url)
+        client.get(
+            self.thumbnail.url, HTTP_IF_NONE_MATCH=client.get(self.thumbnail.url)['ETag']
+        )
+
+        assert metrics.get_counter('ultimatethumb_responses_total', status=200) == 2
+        assert metrics.get_counter('ultimatethumb_responses_total', status=304) == 1
+        assert metrics.get_summary('ultimatethumb_view_seconds')[0] == 3
+
+        response = MetricsView.as_view()(rf.get('/metrics'))
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'text/plain; version=0.0.4'
+        assert b'ultimatethumb_responses_total{status="304"} 1\n' in response.content
+
+
+def test_metrics_view_disabled(rf):
+    metrics._setup()
+    with pytest.raises(Http404):
+        MetricsView.as_view()(rf.get('/metrics'))
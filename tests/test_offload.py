@@ -0,0 +1,146 @@
+import os
+
+import pytest
+
+from tests.factories.mockapp import ImageModelFactory
+from ultimatethumb.offload import (
+    AccelRedirectOffload,
+    InlineOffload,
+    LiteSpeedOffload,
+    RedirectOffload,
+    SendfileOffload,
+    get_byte_range,
+    get_offload,
+)
+from ultimatethumb.thumbnail import Thumbnail
+
+
+def test_get_offload(settings):
+    settings.DEBUG = False
+    assert isinstance(get_offload(), AccelRedirectOffload) is True
+
+    settings.DEBUG = True
+    assert isinstance(get_offload(), InlineOffload) is True
+
+    settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = True
+    assert isinstance(get_offload(), AccelRedirectOffload) is True
+
+
+@pytest.mark.parametrize(
+    'value,expected',
+    [
+        ('accel', AccelRedirectOffload),
+        ('sendfile', SendfileOffload),
+        ('litespeed', LiteSpeedOffload),
+        ('redirect', RedirectOffload),
+        ('inline', InlineOffload),
+        ('ultimatethumb.offload.SendfileOffload', SendfileOffload),
+    ],
+)
+def test_get_offload_setting(settings, value, expected):
+    # The offload setting takes precedence.
+    settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = True
+    settings.ULTIMATETHUMB_OFFLOAD = value
+    assert type(get_offload()) is expected
+
+
+@pytest.mark.django_db
+class TestOffloadView:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_CACHE_CONTROL_MAX_AGE = 3600
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+
+    def test_accel(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'accel'
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response.content == b''
+        assert response['X-Accel-Redirect'] == self.thumbnail.get_storage_url()
+        assert response['Content-Length'] == str(
+            os.path.getsize(self.thumbnail.get_storage_path())
+        )
+        assert 'Last-Modified' in response
+        assert 'ETag' in response
+
+    def test_litespeed(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'litespeed'
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response.content == b''
+        assert response['X-LiteSpeed-Location'] == self.thumbnail.get_storage_url()
+        assert 'X-Accel-Redirect' not in response
+
+    def test_sendfile(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'sendfile'
+        response = client.get(self.thumbnail.url_2x)
+
+        assert response.status_code == 200
+        assert response.content == b''
+        assert response['X-Sendfile'] == self.thumbnail.get_storage_path(factor=2)
+        assert response['Content-Type'] == 'image/jpeg'
+        assert 'Last-Modified' in response
+
+    def test_redirect(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'redirect'
+        response = client.get(self.thumbnail.url_2x)
+
+        assert response.status_code == 302
+        assert response['Location'] == self.thumbnail.get_storage_url(factor=2)
+        assert self.thumbnail.exists(factor=2) is True
+        assert 'ETag' not in response
+        assert 'Cache-Control' not in response
+        assert 'Last-Modified' not in response
+
+    def test_inline(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'inline'
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        with open(self.thumbnail.get_storage_path(), 'rb') as thumbnail_file:
+            assert b''.join(response.streaming_content) == thumbnail_file.read()
+        assert response['Accept-Ranges'] == 'bytes'
+
+    def test_custom(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'tests.test_offload.HeaderOffload'
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response['X-Thumbnail'] == self.thumbnail.get_name()
+
+
+class HeaderOffload(SendfileOffload):
+    def render(self, request, thumbnail, factor, file_stat, mimetype, etag=None):
+        response = super().render(request, thumbnail, factor, file_stat, mimetype, etag=etag)
+        response['X-Thumbnail'] = thumbnail.get_name()
+        return response
+
+
+@pytest.mark.parametrize(
+    'value,expected',
+    [
+        (None, None),
+        ('', None),
+        ('bytes=0-9', (0, 9)),
+        ('bytes=10-', (10, 99)),
+        ('bytes=-10', (90, 99)),
+        ('bytes=-200', (0, 99)),
+        ('bytes=90-200', (90, 99)),
+        ('bytes=9-0', None),
+        ('bytes=-', None),
+        ('bytes=0-1,5-6', None),
+        ('items=0-9', None),
+    ],
+)
+def test_get_byte_range(value, expected):
+    assert get_byte_range(value, 100) == expected
+
+
+@pytest.mark.parametrize('value', ['bytes=100-', 'bytes=-0'])
+def test_get_byte_range_not_satisfiable(value):
+    with pytest.raises(ValueError):
+        get_byte_range(value, 100)
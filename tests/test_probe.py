@@ -0,0 +1,80 @@
+import pytest
+from PIL import Image as PILImage
+
+from ultimatethumb.probe import (
+    get_ico_size,
+    get_jpeg_size,
+    probe_image_size,
+    read_header,
+)
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    def create(extension, size=(120, 80), **kwargs):
+        path = str(tmp_path / 'image.{0}'.format(extension))
+        mode = 'RGBA' if extension in ('png', 'ico') else 'RGB'
+        PILImage.new(mode, size, 'orange').save(path, **kwargs)
+        return path
+
+    return create
+
+
+def pillow_size(path):
+    with PILImage.open(path) as image:
+        return image.size
+
+
+@pytest.mark.parametrize(
+    'extension,kwargs',
+    [
+        ('jpg', {}),
+        ('jpg', {'progressive': True}),
+        ('jpg', {'exif': b'Exif\x00\x00' + b'\x00' * 4096}),
+        ('png', {}),
+        ('gif', {}),
+        ('ico', {'sizes': [(16, 16), (64, 64), (32, 32)]}),
+    ],
+)
+def test_probe_image_size(image_path, extension, kwargs):
+    path = image_path(extension, **kwargs)
+    assert probe_image_size(path) == pillow_size(path)
+
+
+def test_probe_image_size_unknown_format(image_path):
+    assert probe_image_size(image_path('bmp')) is None
+
+
+def test_probe_image_size_truncated(tmp_path):
+    path = str(tmp_path / 'image.png')
+    with open(path, 'wb') as image_file:
+        image_file.write(b'\x89PNG\r\n\x1a\n\x00\x00')
+
+    assert probe_image_size(path) is None
+
+
+def test_read_header(image_path):
+    path = image_path('png')
+    assert len(read_header(path, 10)) == 10
+
+
+class TestGetJpegSize:
+    def test_missing_sof(self):
+        assert get_jpeg_size(b'\xff\xd8\xff\xe0\x00\x04\x00\x00\xff\xda\x00\x02') is None
+
+    def test_garbage(self):
+        assert get_jpeg_size(b'\xff\xd8\x00\x00') is None
+
+    def test_truncated(self):
+        assert get_jpeg_size(b'\xff\xd8\xff\xe0\x00\x10') is None
+
+
+class TestGetIcoSize:
+    def test_zero_means_256(self):
+        assert get_ico_size(b'\x00\x00\x01\x00\x01\x00\x00\x00' + b'\x00' * 14) == (256, 256)
+
+    def test_ambiguous(self):
+        data = b'\x00\x00\x01\x00\x02\x00'
+        data += b'\x10\x20' + b'\x00' * 14
+        data += b'\x20\x10' + b'\x00' * 14
+        assert get_ico_size(data) is None
@@ -0,0 +1,181 @@
+import threading
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.template import Context, Template
+
+from tests.factories.mockapp import ImageModelFactory
+from ultimatethumb.metrics import metrics
+from ultimatethumb.queues import (
+    SyncQueue,
+    ThreadPoolQueue,
+    thumbnail_queue,
+)
+from ultimatethumb.signals import thumbnail_generation_failed
+from ultimatethumb.thumbnail import ThumbnailSet
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def test_lazy_thumbnail_queue(settings):
+    thumbnail_queue._setup()
+    assert isinstance(thumbnail_queue._wrapped, ThreadPoolQueue) is True
+
+    settings.ULTIMATETHUMB_QUEUE = 'ultimatethumb.queues.SyncQueue'
+    thumbnail_queue._setup()
+    assert isinstance(thumbnail_queue._wrapped, SyncQueue) is True
+
+    del settings.ULTIMATETHUMB_QUEUE
+    thumbnail_queue._setup()
+
+
+@pytest.mark.django_db
+class TestThreadPoolQueue:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        self.thumbnail_set = ThumbnailSet(image.file.path, '50x0,100x0', {})
+
+    def test_enqueue(self):
+        queue = ThreadPoolQueue()
+
+        with mock.patch('ultimatethumb.thumbnail.ThumbnailSet.generate') as generate_mock:
+            assert queue.enqueue(self.thumbnail_set) is True
+            queue.executor.shutdown(wait=True)
+
+        assert generate_mock.call_count == 1
+        assert queue.pending == set()
+
+    def test_enqueue_pending(self, settings):
+        settings.ULTIMATETHUMB_QUEUE_SIZE = 1
+        queue = ThreadPoolQueue()
+        event = threading.Event()
+
+        with mock.patch(
+            'ultimatethumb.thumbnail.ThumbnailSet.generate', side_effect=lambda: event.wait(5)
+        ):
+            assert queue.enqueue(self.thumbnail_set) is True
+            # Same set again, already queued.
+            assert queue.enqueue(self.thumbnail_set) is False
+            # Queue is full.
+            other_set = ThumbnailSet(self.thumbnail_set.source, '60x0', {})
+            assert queue.enqueue(other_set) is False
+
+            event.set()
+            queue.executor.shutdown(wait=True)
+
+        assert queue.pending == set()
+
+    def test_enqueue_empty(self):
+        thumbnail_set = ThumbnailSet(self.thumbnail_set.source, '50x0', {})
+        thumbnail_set.thumbnails = []
+        assert ThreadPoolQueue().enqueue(thumbnail_set) is False
+
+    @mock.patch('ultimatethumb.queues.logger')
+    def test_generate_error(self, logger_mock):
+        queue = ThreadPoolQueue()
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        thumbnail_generation_failed.connect(receiver)
+        try:
+            with mock.patch(
+                'ultimatethumb.thumbnail.ThumbnailSet.generate', side_effect=OSError
+            ) as generate_mock:
+                queue.enqueue(self.thumbnail_set)
+                queue.executor.shutdown(wait=True)
+        finally:
+            thumbnail_generation_failed.disconnect(receiver)
+
+        assert generate_mock.called is True
+        assert queue.pending == set()
+        assert logger_mock.exception.call_count == 1
+        assert len(received) == 1
+        assert isinstance(received[0]['exception'], OSError) is True
+
+    @mock.patch('ultimatethumb.queues.logger')
+    def test_generate_error_reported(self, logger_mock, settings):
+        settings.ULTIMATETHUMB_METRICS = 'ultimatethumb.metrics.MemoryMetrics'
+        metrics._setup()
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        thumbnail_generation_failed.connect(receiver)
+        try:
+            with mock.patch(
+                'ultimatethumb.engines.PillowEngine.generate_many', side_effect=OSError
+            ):
+                settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+                ThreadPoolQueue().generate(self.thumbnail_set)
+            failures = metrics.get_counter('ultimatethumb_generation_failures_total')
+        finally:
+            thumbnail_generation_failed.disconnect(receiver)
+            del settings.ULTIMATETHUMB_METRICS
+            metrics._setup()
+
+        # Reported once by the generation.
+        assert logger_mock.exception.call_count == 1
+        assert len(received) == 1
+        assert received[0]['items'] != []
+        assert failures == len(received[0]['items'])
+
+
+@pytest.mark.django_db
+class TestPregenerate:
+    def render(self, source, extra=''):
+        template = Template(
+            (
+                '{%% load ultimatethumb_tags %%}'
+                '{%% ultimatethumb "img" "%s" sizes="50x0,100x0" %s %%}'
+            )
+            % (source, extra)
+        )
+        template.render(Context())
+
+    @mock.patch('ultimatethumb.templatetags.ultimatethumb_tags.thumbnail_queue')
+    def test_disabled(self, queue_mock):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        self.render(image.file.path)
+
+        assert queue_mock.enqueue.called is False
+
+    @mock.patch('ultimatethumb.templatetags.ultimatethumb_tags.thumbnail_queue')
+    def test_enabled(self, queue_mock, settings):
+        settings.ULTIMATETHUMB_PREGENERATE = True
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        self.render(image.file.path)
+
+        assert queue_mock.enqueue.call_count == 1
+        assert len(queue_mock.enqueue.call_args[0][0].thumbnails) == 2
+
+    @mock.patch('ultimatethumb.templatetags.ultimatethumb_tags.thumbnail_queue')
+    def test_argument(self, queue_mock, settings):
+        settings.ULTIMATETHUMB_PREGENERATE = True
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        self.render(image.file.path, 'pregenerate=False')
+        assert queue_mock.enqueue.called is False
+
+        del settings.ULTIMATETHUMB_PREGENERATE
+        self.render(image.file.path, 'pregenerate=True')
+        assert queue_mock.enqueue.called is True
+
+    def test_generate(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnail_set = ThumbnailSet(image.file.path, '50x0,100x0', {})
+
+        SyncQueue().enqueue(thumbnail_set)
+
+        for thumbnail in thumbnail_set.thumbnails:
+            assert thumbnail.exists() is True
+            assert thumbnail.exists(factor=2) is True
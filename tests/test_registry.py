@@ -0,0 +1,193 @@
+import json
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+
+from ultimatethumb.models import ThumbnailSpec
+from ultimatethumb.registry import (
+    CacheRegistry,
+    DatabaseRegistry,
+    SidecarRegistry,
+    thumbnail_registry,
+)
+from ultimatethumb.storage import thumbnail_storage
+from ultimatethumb.utils import (
+    build_thumb_name,
+    get_cache_key,
+    get_thumb_data,
+    get_thumb_name,
+)
+
+THUMB_NAME, SERIALIZED_DATA = build_thumb_name('test.jpg', arg1=1)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def test_lazy_thumbnail_registry(settings):
+    thumbnail_registry._setup()
+    assert isinstance(thumbnail_registry._wrapped, CacheRegistry) is True
+
+    settings.ULTIMATETHUMB_REGISTRY = 'ultimatethumb.registry.SidecarRegistry'
+    thumbnail_registry._setup()
+    assert isinstance(thumbnail_registry._wrapped, SidecarRegistry) is True
+
+    del settings.ULTIMATETHUMB_REGISTRY
+    thumbnail_registry._setup()
+
+
+class TestCacheRegistry:
+    def test_register(self):
+        registry = CacheRegistry()
+        registry.register(THUMB_NAME, SERIALIZED_DATA)
+
+        assert cache.get(get_cache_key(THUMB_NAME)) == SERIALIZED_DATA
+        assert registry.get(THUMB_NAME) == SERIALIZED_DATA
+
+    def test_register_many(self):
+        registry = CacheRegistry()
+        registry.register_many({THUMB_NAME: SERIALIZED_DATA})
+
+        assert registry.get(THUMB_NAME) == SERIALIZED_DATA
+
+    def test_get_unknown(self):
+        assert CacheRegistry().get(THUMB_NAME) is None
+
+    @mock.patch('ultimatethumb.registry.CacheRegistry.store')
+    def test_register_store_once(self, store_mock):
+        registry = CacheRegistry()
+        registry.register(THUMB_NAME, SERIALIZED_DATA)
+        registry.register(THUMB_NAME, SERIALIZED_DATA)
+        registry.register_many({THUMB_NAME: SERIALIZED_DATA})
+
+        assert store_mock.call_count == 1
+
+    def test_get_many(self):
+        registry = CacheRegistry()
+        registry.register(THUMB_NAME, SERIALIZED_DATA)
+
+        assert registry.get_many([THUMB_NAME, 'unknown/test.jpg']) == {
+            THUMB_NAME: SERIALIZED_DATA
+        }
+
+    @mock.patch('ultimatethumb.registry.CacheRegistry.load')
+    def test_get_many_read_through(self, load_mock):
+        load_mock.return_value = SERIALIZED_DATA
+        registry = CacheRegistry()
+
+        assert registry.get_many([THUMB_NAME]) == {THUMB_NAME: SERIALIZED_DATA}
+        assert registry.get_many([THUMB_NAME]) == {THUMB_NAME: SERIALIZED_DATA}
+        assert load_mock.call_count == 1
+
+    def test_get_group(self):
+        registry = CacheRegistry()
+        other_name, other_data = build_thumb_name('test.jpg', arg1=2)
+        registry.register_many({THUMB_NAME: SERIALIZED_DATA, other_name: other_data})
+
+        assert registry.get_group(THUMB_NAME) == [THUMB_NAME, other_name]
+        assert registry.get_group(other_name) == [THUMB_NAME, other_name]
+
+    def test_get_group_single(self):
+        registry = CacheRegistry()
+        registry.register_many({THUMB_NAME: SERIALIZED_DATA})
+
+        assert registry.get_group(THUMB_NAME) == []
+
+    @mock.patch('ultimatethumb.registry.CacheRegistry.load')
+    def test_get_read_through(self, load_mock):
+        load_mock.return_value = SERIALIZED_DATA
+        registry = CacheRegistry()
+
+        assert registry.get(THUMB_NAME) == SERIALIZED_DATA
+        assert registry.get(THUMB_NAME) == SERIALIZED_DATA
+        assert load_mock.call_count == 1
+
+
+@pytest.mark.django_db
+class TestDatabaseRegistry:
+    def test_register(self):
+        registry = DatabaseRegistry()
+        registry.register(THUMB_NAME, SERIALIZED_DATA)
+
+        assert ThumbnailSpec.objects.get(name=THUMB_NAME).data == SERIALIZED_DATA
+
+        cache.clear()
+        assert registry.get(THUMB_NAME) == SERIALIZED_DATA
+        assert cache.get(get_cache_key(THUMB_NAME)) == SERIALIZED_DATA
+
+    def test_register_many(self, django_assert_num_queries):
+        registry = DatabaseRegistry()
+        registry.register(THUMB_NAME, SERIALIZED_DATA)
+        cache.clear()
+
+        other_name, other_data = build_thumb_name('test.jpg', arg1=2)
+        with django_assert_num_queries(1):
+            registry.register_many({THUMB_NAME: SERIALIZED_DATA, other_name: other_data})
+
+        assert ThumbnailSpec.objects.count() == 2
+
+    def test_get_unknown(self):
+        assert DatabaseRegistry().get(THUMB_NAME) is None
+
+    def test_get_thumb_data_after_flush(self, settings):
+        settings.ULTIMATETHUMB_REGISTRY = 'ultimatethumb.registry.DatabaseRegistry'
+        thumbnail_registry._setup()
+
+        thumb_name = get_thumb_name('test.jpg', arg1=1)
+        cache.clear()
+        assert get_thumb_data(thumb_name) == ('test.jpg', {'arg1': 1})
+
+        del settings.ULTIMATETHUMB_REGISTRY
+        thumbnail_registry._setup()
+
+
+class TestSidecarRegistry:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.registry = SidecarRegistry()
+        self.sidecar_name = self.registry.get_sidecar_name(THUMB_NAME)
+        yield
+        thumbnail_storage.delete(self.sidecar_name)
+
+    def test_get_sidecar_name(self):
+        assert self.sidecar_name == '{0}.json'.format(THUMB_NAME.split('/')[0])
+
+    def test_register(self):
+        self.registry.register(THUMB_NAME, SERIALIZED_DATA)
+
+        with thumbnail_storage.open(self.sidecar_name) as sidecar_file:
+            assert json.loads(sidecar_file.read()) == {
+                'name': THUMB_NAME,
+                'data': SERIALIZED_DATA,
+            }
+
+        cache.clear()
+        assert self.registry.get(THUMB_NAME) == SERIALIZED_DATA
+
+    def test_register_existing(self):
+        self.registry.store({THUMB_NAME: SERIALIZED_DATA})
+        self.registry.store({THUMB_NAME: SERIALIZED_DATA})
+
+        files = thumbnail_storage.listdir('')[1]
+        assert len([f for f in files if f.endswith('.json')]) == 1
+
+    def test_get_unknown(self):
+        assert self.registry.get(THUMB_NAME) is None
+
+    def test_get_other_filename(self):
+        self.registry.register(THUMB_NAME, SERIALIZED_DATA)
+        cache.clear()
+
+        other_name = '{0}/other.jpg'.format(THUMB_NAME.split('/')[0])
+        assert self.registry.get(other_name) is None
+
+    def test_get_invalid(self):
+        with thumbnail_storage.open(self.sidecar_name, 'wb') as sidecar_file:
+            sidecar_file.write(b'invalid')
+
+        assert self.registry.get(THUMB_NAME) is None
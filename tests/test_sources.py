@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+
+from tests.factories.mockapp import ImageModelFactory
+from tests.resources.storages import RemoteStorage
+from ultimatethumb.sources import SourceCache, SourceLock, get_source_path
+from ultimatethumb.thumbnail import ThumbnailSet
+from ultimatethumb.utils import parse_source
+
+
+@pytest.fixture
+def remote_storage():
+    cache.clear()
+    RemoteStorage.files.clear()
+    del RemoteStorage.calls[:]
+
+    yield RemoteStorage()
+
+    cache.clear()
+    RemoteStorage.files.clear()
+
+
+def get_opens(name):
+    return RemoteStorage.calls.count(('open', name))
+
+
+class TestSourceCache:
+    @pytest.fixture(autouse=True)
+    def setup(self, remote_storage, tmp_path):
+        self.storage = remote_storage
+        self.root = str(tmp_path)
+        self.storage.save('images/test.jpg', ContentFile(b'x' * 100))
+
+    def get_cache(self, **kwargs):
+        return SourceCache(root=self.root, storage=self.storage, **kwargs)
+
+    def test_get_path(self):
+        path = self.get_cache().get_path('images/test.jpg')
+
+        assert path.startswith(self.root)
+        assert path.endswith('.jpg')
+        with open(path, 'rb') as source_file:
+            assert source_file.read() == b'x' * 100
+
+        assert self.get_cache().get_path('images/test.jpg') == path
+        assert get_opens('images/test.jpg') == 1
+
+    def test_modified(self):
+        path = self.get_cache().get_path('images/test.jpg')
+
+        content, modified_time = RemoteStorage.files['images/test.jpg']
+        RemoteStorage.files['images/test.jpg'] = (b'y' * 10, modified_time + timedelta(1))
+
+        # The modification time is cached.
+        assert self.get_cache().get_path('images/test.jpg') == path
+
+        cache.clear()
+        new_path = self.get_cache().get_path('images/test.jpg')
+        assert new_path != path
+        with open(new_path, 'rb') as source_file:
+            assert source_file.read() == b'y' * 10
+
+    def test_settings(self, settings):
+        settings.ULTIMATETHUMB_SOURCE_CACHE_ROOT = self.root
+        settings.ULTIMATETHUMB_SOURCE_CACHE_SIZE = 100
+
+        source_cache = SourceCache()
+        assert source_cache.root == self.root
+        assert source_cache.max_size == 100
+        assert source_cache.grace_period == 60
+
+    def test_evict(self):
+        for name in ('images/1.jpg', 'images/2.jpg'):
+            self.storage.save(name, ContentFile(b'x' * 100))
+
+        source_cache = self.get_cache(max_size=250)
+        first = source_cache.get_path('images/test.jpg')
+        second = source_cache.get_path('images/1.jpg')
+        os.utime(first, (1000, 1000))
+        os.utime(second, (500, 500))
+
+        # Recently used sources are kept.
+        source_cache.get_path('images/test.jpg')
+        third = source_cache.get_path('images/2.jpg')
+
+        assert os.path.exists(first) is True
+        assert os.path.exists(second) is False
+        assert os.path.exists(third) is True
+        # Lock files are removed on release.
+        assert [name for name in os.listdir(self.root) if name.endswith('.lock')] == []
+
+    def test_evict_grace_period(self):
+        self.storage.save('images/1.jpg', ContentFile(b'x' * 100))
+
+        source_cache = self.get_cache(max_size=150, grace_period=60)
+        first = source_cache.get_path('images/test.jpg')
+        os.utime(first, (time.time() - 30,) * 2)
+        source_cache.get_path('images/1.jpg')
+        assert os.path.exists(first) is True
+
+        os.utime(first, (time.time() - 90,) * 2)
+        source_cache.evict()
+        assert os.path.exists(first) is False
+
+    def test_evict_locked(self):
+        source_cache = self.get_cache(max_size=0, grace_period=0)
+        path = source_cache.get_path('images/test.jpg')
+        os.utime(path, (1000, 1000))
+
+        with SourceLock(path):
+            source_cache.evict()
+            assert os.path.exists(path) is True
+
+        source_cache.evict()
+        assert os.path.exists(path) is False
+
+    def test_evict_keep(self):
+        path = self.get_cache(max_size=10).get_path('images/test.jpg')
+        assert os.path.exists(path) is True
+
+    def test_fetch_error(self):
+        with mock.patch.object(RemoteStorage, '_open', side_effect=OSError):
+            with pytest.raises(OSError):
+                self.get_cache().get_path('images/test.jpg')
+
+        # Neither the temporary file nor the lock file is left.
+        assert os.listdir(self.root) == []
+
+    def test_coalesce(self):
+        barrier = threading.Barrier(4)
+        paths = []
+
+        def fetch():
+            barrier.wait()
+            paths.append(self.get_cache().get_path('images/test.jpg'))
+
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(paths)) == 1
+        assert get_opens('images/test.jpg') == 1
+
+
+def test_get_source_path(remote_storage, settings, tmp_path):
+    settings.ULTIMATETHUMB_SOURCE_CACHE_ROOT = str(tmp_path)
+    remote_storage.save('images/test.jpg', ContentFile(b'x'))
+
+    assert get_source_path('/path/to/test.jpg') == '/path/to/test.jpg'
+
+    with mock.patch('ultimatethumb.sources.default_storage', remote_storage):
+        path = get_source_path('storage:images/test.jpg')
+
+    assert path.startswith(str(tmp_path))
+
+
+def test_parse_source_remote(remote_storage):
+    with mock.patch('ultimatethumb.utils.default_storage', remote_storage):
+        assert parse_source('images/test.jpg') == 'storage:images/test.jpg'
+
+    assert parse_source('storage:images/test.jpg') == 'storage:images/test.jpg'
+
+
+@pytest.mark.django_db
+def test_thumbnails(remote_storage, settings, tmp_path):
+    settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+    settings.ULTIMATETHUMB_SOURCE_CACHE_ROOT = str(tmp_path)
+
+    image = ImageModelFactory.create(file__width=400, file__height=200)
+    with open(image.file.path, 'rb') as image_file:
+        remote_storage.save('images/remote.jpg', image_file)
+
+    with mock.patch('ultimatethumb.sources.default_storage', remote_storage):
+        thumbnail_set = ThumbnailSet('storage:images/remote.jpg', '50x0,100x0', {})
+        thumbnail_set.generate()
+
+        for thumbnail in thumbnail_set.thumbnails:
+            assert thumbnail.exists() is True
+            assert thumbnail.exists(factor=2) is True
+            assert thumbnail.get_estimated_size().width == thumbnail.get_size().width
+
+    # Probes and all generations share the local copy.
+    assert get_opens('images/remote.jpg') == 1
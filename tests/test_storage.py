@@ -1,7 +1,24 @@
+import os
+
 import pytest
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
 
-from ultimatethumb.storage import ThumbnailFileSystemStorage, thumbnail_storage
+from tests.factories.mockapp import ImageModelFactory
+from tests.resources.storages import RemoteStorage
+from ultimatethumb.cleanup import ThumbnailCleanup
+from ultimatethumb.locks import CacheLock, get_generation_lock
+from ultimatethumb.storage import (
+    ThumbnailFileSystemStorage,
+    get_file_stat,
+    get_local_path,
+    is_local_storage,
+    save_file,
+    thumbnail_storage,
+)
+from ultimatethumb.thumbnail import Thumbnail
+from ultimatethumb.utils import MoveableNamedTemporaryFile, base64_cache
 
 
 def test_lazy_thumbnail_storage():
@@ -39,3 +56,141 @@ class TestThumbnailFileSystemStorage:
         )
         assert storage.path('test.test') == '/path/to/thumbs/test.test'
         assert storage.url('test.test') == '/url/to/thumbs/test.test'
+
+
+@pytest.fixture
+def remote_storage(settings):
+    settings.ULTIMATETHUMB_STORAGE = 'tests.resources.storages.RemoteStorage'
+    settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+    thumbnail_storage._setup()
+    cache.clear()
+    base64_cache.clear()
+    RemoteStorage.files.clear()
+    del RemoteStorage.calls[:]
+
+    yield thumbnail_storage
+
+    del settings.ULTIMATETHUMB_STORAGE
+    thumbnail_storage._setup()
+    cache.clear()
+    RemoteStorage.files.clear()
+
+
+class TestLocalStorage:
+    def test_is_local_storage(self):
+        assert is_local_storage() is True
+        assert get_local_path('test.jpg') == thumbnail_storage.path('test.jpg')
+
+    def test_get_file_stat(self):
+        assert get_file_stat('missing/test.jpg') is None
+
+        thumbnail_storage.save('stat/test.jpg', ContentFile(b'test'))
+        file_stat = get_file_stat('stat/test.jpg')
+
+        assert file_stat.name == 'stat/test.jpg'
+        assert file_stat.path == thumbnail_storage.path('stat/test.jpg')
+        assert file_stat.size == 4
+        assert file_stat.modified_time == os.stat(file_stat.path).st_mtime
+
+        thumbnail_storage.delete('stat/test.jpg')
+
+    def test_save_file(self):
+        tmpfile = MoveableNamedTemporaryFile('save/test.jpg')
+        tmpfile.file.write(b'test')
+        tmpfile.file.flush()
+
+        assert save_file('save/test.jpg', tmpfile) == 'save/test.jpg'
+        # The temporary file was moved.
+        assert os.path.exists(tmpfile.temporary_file_path()) is False
+
+        thumbnail_storage.delete('save/test.jpg')
+
+
+class TestRemoteStorage:
+    def test_is_local_storage(self, remote_storage):
+        assert is_local_storage() is False
+        assert get_local_path('test.jpg') is None
+
+    def test_get_file_stat(self, remote_storage):
+        assert get_file_stat('stat/test.jpg') is None
+
+        remote_storage.save('stat/test.jpg', ContentFile(b'test'))
+        file_stat = get_file_stat('stat/test.jpg')
+
+        assert file_stat.name == 'stat/test.jpg'
+        assert file_stat.path is None
+        assert file_stat.size == 4
+        assert file_stat.modified_time == RemoteStorage.files['stat/test.jpg'][1].timestamp()
+
+    def test_get_file_stat_cached(self, remote_storage):
+        remote_storage.save('stat/test.jpg', ContentFile(b'test'))
+        del RemoteStorage.calls[:]
+
+        assert get_file_stat('stat/test.jpg') == get_file_stat('stat/test.jpg')
+        assert RemoteStorage.calls == [('exists', 'stat/test.jpg')]
+
+    def test_save_file(self, remote_storage):
+        tmpfile = MoveableNamedTemporaryFile('save/test.jpg')
+        tmpfile.file.write(b'test' * 100000)
+        tmpfile.file.flush()
+
+        assert save_file('save/test.jpg', tmpfile) == 'save/test.jpg'
+        assert RemoteStorage.files['save/test.jpg'][0] == b'test' * 100000
+        assert os.path.exists(tmpfile.temporary_file_path()) is False
+
+
+@pytest.mark.django_db
+class TestRemoteStorageThumbnails:
+    @pytest.fixture(autouse=True)
+    def setup(self, remote_storage):
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+
+    def test_generate(self):
+        assert self.thumbnail.exists() is False
+
+        self.thumbnail.generate()
+
+        assert self.thumbnail.exists() is True
+        assert self.thumbnail.get_storage_name() in RemoteStorage.files
+        assert self.thumbnail.get_size() == (25, 50)
+
+    def test_base64(self):
+        assert self.thumbnail.base64.startswith('data:image/jpeg;base64,/9j/')
+        assert self.thumbnail.get_storage_name(suffix='base64') in RemoteStorage.files
+
+    def test_generation_lock(self):
+        assert isinstance(get_generation_lock('test.jpg'), CacheLock) is True
+
+    def test_view(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'inline'
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content) == (
+            RemoteStorage.files[self.thumbnail.get_storage_name()][0]
+        )
+        assert response['Last-Modified']
+
+        response = client.get(self.thumbnail.url, HTTP_RANGE='bytes=0-9')
+        assert response.status_code == 206
+        assert len(b''.join(response.streaming_content)) == 10
+
+    def test_view_redirect(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'redirect'
+        response = client.get(self.thumbnail.url_2x)
+
+        assert response.status_code == 302
+        assert response['Location'] == 'https://cdn.example.com/{0}'.format(
+            self.thumbnail.get_storage_name(factor=2)
+        )
+
+    def test_view_sendfile(self, client, settings):
+        settings.ULTIMATETHUMB_OFFLOAD = 'sendfile'
+
+        with pytest.raises(ImproperlyConfigured):
+            client.get(self.thumbnail.url)
+
+    def test_cleanup(self):
+        with pytest.raises(ImproperlyConfigured):
+            ThumbnailCleanup()
@@ -51,9 +51,13 @@ class TestUltimatethumbTags:
     def test_static_hashed_source(self, settings):
         settings.INSTALLED_APPS += ('django.contrib.staticfiles',)
         if django.VERSION[:2] >= (4, 2):
-            settings.STORAGES["staticfiles"] = {
-                "BACKEND": "django.contrib.staticfiles.storage.ManifestStaticFilesStorage",
-            }
+            # Assign a new dict to reset the already initialized storages.
+            settings.STORAGES = dict(
+                settings.STORAGES,
+                staticfiles={
+                    "BACKEND": "django.contrib.staticfiles.storage.ManifestStaticFilesStorage",
+                },
+            )
         else:
             settings.STATICFILES_STORAGE = (
                 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
@@ -153,6 +157,22 @@ class TestUltimatethumbTags:
         assert len(context['img']) == 1
         assert context['img'][0].options['pngquant'] == 10
 
+    def test_profile(self):
+        source = ImageModelFactory.create(file__width=210, file__height=100)
+
+        template = Template(
+            (
+                '{%% load ultimatethumb_tags %%}'
+                '{%% ultimatethumb "img" "%s" sizes="200x0" profile="web" %%}'
+            )
+            % source.file.path
+        )
+
+        context = Context()
+        assert template.render(context) == ''
+
+        assert context['img'][0].options['profile'] == 'web'
+
     def test_viewport(self):
         source = ImageModelFactory.create(file__width=400, file__height=100)
 
@@ -366,3 +386,57 @@ class TestUltimatethumbTags:
         assert context['img'][2].requested_size.width == '210'
         assert context['img'][2].requested_size.height == '0'
         assert context['img'][2].url is not None
+
+    def test_formats(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'tests.resources.engines.AvifEngine'
+        settings.ULTIMATETHUMB_FORMATS = ['avif', 'webp']
+        source = ImageModelFactory.create(file__width=210, file__height=100)
+
+        template = Template(
+            (
+                '{%% load ultimatethumb_tags %%}'
+                '{%% ultimatethumb "img" "%s" sizes="100x0" formats="avif,webp" %%}'
+            )
+            % source.file.path
+        )
+
+        context = Context()
+        assert template.render(context) == ''
+
+        variants = context['img'][0].variants
+        assert [variant.format for variant in variants] == ['avif', 'webp']
+        assert variants[1].url == '{0}.webp'.format(context['img'][0].url)
+        assert variants[1].url_2x == '{0}.webp'.format(context['img'][0].url_2x)
+
+    def test_formats_invalid(self, settings):
+        settings.ULTIMATETHUMB_FORMATS = ['webp']
+        source = ImageModelFactory.create(file__width=210, file__height=100)
+
+        template = Template(
+            (
+                '{%% load ultimatethumb_tags %%}'
+                '{%% ultimatethumb "img" "%s" sizes="100x0" formats="avif" %%}'
+            )
+            % source.file.path
+        )
+
+        with pytest.raises(ValueError):
+            template.render(Context())
+
+    def test_formats_gif(self, settings):
+        settings.ULTIMATETHUMB_FORMATS = ['webp']
+        source = ImageModelFactory.create(
+            file__filename='test.gif', file__format='GIF', file__width=210, file__height=100
+        )
+
+        template = Template(
+            (
+                '{%% load ultimatethumb_tags %%}'
+                '{%% ultimatethumb "img" "%s" sizes="100x0" formats="webp" %%}'
+            )
+            % source.file.path
+        )
+
+        context = Context()
+        assert template.render(context) == ''
+        assert context['img'][0].variants == []
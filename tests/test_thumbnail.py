@@ -1,12 +1,17 @@
+import base64
 import os
 from unittest import mock
 
 import pytest
 from django.core.cache import cache
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage
 
 from tests.factories.mockapp import ImageModelFactory
+from tests.resources.compat import requires_avif
 from ultimatethumb.storage import thumbnail_storage
-from ultimatethumb.thumbnail import Size, Thumbnail
+from ultimatethumb.thumbnail import Size, Thumbnail, ThumbnailSet
+from ultimatethumb.utils import base64_cache, get_thumb_token, get_token_data
 
 
 @pytest.mark.django_db
@@ -14,6 +19,7 @@ class TestThumbnail:
     @pytest.fixture(autouse=True)
     def setup(self):
         cache.clear()
+        base64_cache.clear()
 
     def teardown(self):
         cache.clear()
@@ -35,6 +41,15 @@ class TestThumbnail:
         thumbnail = Thumbnail('test.jpg', {'size': ['100', '100'], 'viewport': 'ignored'})
         assert thumbnail.get_name() == '821b6e68771352f0bc53acd8e8144972a56dd0ac/test.jpg'
 
+    @mock.patch('ultimatethumb.thumbnail.get_thumb_name')
+    def test_get_name_memoized(self, name_mock):
+        name_mock.return_value = '821b6e68771352f0bc53acd8e8144972a56dd0ac/test.jpg'
+        thumbnail = Thumbnail('test.jpg', {'size': ['100', '100']})
+
+        assert thumbnail.get_name() == thumbnail.url[1:] == thumbnail.get_name()
+        assert thumbnail.get_mimetype() == 'image/jpeg'
+        assert name_mock.call_count == 1
+
     def test_from_name(self):
         thumbnail = Thumbnail('test.jpg', {'size': ['100', '100'], 'viewport': 'ignored'})
         thumbnail2 = Thumbnail.from_name(thumbnail.get_name())
@@ -42,6 +57,57 @@ class TestThumbnail:
         assert thumbnail.source == thumbnail2.source
         thumbnail.options.pop('viewport')
         assert thumbnail.options == thumbnail2.options
+        assert thumbnail.get_name() == thumbnail2.get_name()
+
+    @mock.patch('ultimatethumb.thumbnail.get_thumb_data')
+    @mock.patch('ultimatethumb.thumbnail.get_thumb_name')
+    def test_from_name_no_name_lookup(self, name_mock, data_mock):
+        data_mock.return_value = ('test.jpg', {'size': ['100', '100']})
+        thumbnail = Thumbnail.from_name('821b6e68771352f0bc53acd8e8144972a56dd0ac/test.jpg')
+
+        assert thumbnail.get_name() == '821b6e68771352f0bc53acd8e8144972a56dd0ac/test.jpg'
+        assert name_mock.called is False
+
+    def test_from_token(self):
+        thumbnail = Thumbnail(
+            default_storage.path('test.jpg'), {'size': ['100', '100'], 'viewport': 'ignored'}
+        )
+        thumbnail2 = Thumbnail.from_token(
+            get_thumb_token('test.jpg', **thumbnail.get_name_options())
+        )
+
+        assert thumbnail.source == thumbnail2.source
+        assert thumbnail2.source_name == 'test.jpg'
+        assert thumbnail.get_name_options() == thumbnail2.options
+        assert thumbnail.get_name() == thumbnail2.get_name()
+
+    @mock.patch('ultimatethumb.utils.cache.get')
+    @mock.patch('ultimatethumb.utils.cache.set')
+    def test_signed_urls(self, set_mock, get_mock, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail('test.jpg', {'size': ['100', '100']})
+
+        assert thumbnail.url == '/t/{0}/test.jpg'.format(thumbnail.token)
+        assert thumbnail.url_2x == '/2x/t/{0}/test.jpg'.format(thumbnail.token)
+        assert thumbnail.get_name() == '821b6e68771352f0bc53acd8e8144972a56dd0ac/test.jpg'
+
+        thumbnail = Thumbnail(default_storage.path('test.jpg'), {'size': ['100', '100']})
+        assert Thumbnail.from_token(thumbnail.token).get_name() == thumbnail.get_name()
+        assert get_mock.called is False
+        assert set_mock.called is False
+
+    def test_token_source_name(self, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail(default_storage.path('images/test.jpg'), {'size': ['100', '100']})
+
+        assert settings.MEDIA_ROOT not in get_token_data(thumbnail.token)[0]
+        assert get_token_data(thumbnail.token)[0] == 'images/test.jpg'
+
+        image = ImageModelFactory.create()
+        thumbnail_set = ThumbnailSet(
+            image.file.path, '100x0', {}, source_name='static:test.jpg'
+        )
+        assert get_token_data(thumbnail_set.thumbnails[0].token)[0] == 'static:test.jpg'
 
     def test_mimetype(self):
         thumbnail = Thumbnail('test.jpg', {'size': ['100', '100']})
@@ -129,6 +195,52 @@ class TestThumbnail:
         assert thumbnail.generate() is True
         assert pngquant_mock.called is True
 
+    @mock.patch('ultimatethumb.thumbnail.PngquantCommand.execute')
+    def test_generate_pngquant_in_process(self, pngquant_mock, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        image = ImageModelFactory.create(file__filename='test.png')
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50'], 'pngquant': '50'})
+
+        assert thumbnail.generate() is True
+        assert pngquant_mock.called is False
+
+        settings.ULTIMATETHUMB_PNGQUANT_EXTERNAL = True
+        assert thumbnail.generate(factor=2) is True
+        assert pngquant_mock.called is True
+
+    def test_get_group(self):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+
+        group = Thumbnail.from_name(thumbnails[1].get_name()).get_group()
+        assert [thumbnail.get_name() for thumbnail in group] == [
+            thumbnails[1].get_name(),
+            thumbnails[0].get_name(),
+        ]
+
+    def test_get_group_single(self):
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        assert thumbnail.get_group() == [thumbnail]
+
+    @mock.patch('ultimatethumb.thumbnail.generate_thumbnails')
+    def test_generate_group(self, generate_mock):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+
+        assert thumbnails[1].generate_group(2) is True
+        items = [
+            (thumbnail.get_name(), factor)
+            for thumbnail, factor in generate_mock.call_args[0][0]
+        ]
+        assert items == [
+            (thumbnails[1].get_name(), 2),
+            (thumbnails[1].get_name(), 1),
+            (thumbnails[0].get_name(), 1),
+            (thumbnails[0].get_name(), 2),
+        ]
+
     def test_exists(self):
         image = ImageModelFactory.create()
         thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
@@ -217,6 +329,45 @@ class TestThumbnail:
         thumbnail = Thumbnail(image.file.path, {'size': ['100', '50'], 'quality': 5})
         assert thumbnail.get_gm_options()['quality'] == 5
 
+    def test_gm_options_profile(self):
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['100', '50'], 'profile': 'web'})
+        assert list(thumbnail.get_gm_options().items()) == [
+            ('+profile', '"*"'),
+            ('resize', '25x50>'),
+            ('quality', 90),
+            ('strip', True),
+            ('interlace', 'Line'),
+            ('define', 'jpeg:optimize-coding=true'),
+            ('sampling-factor', '2x2'),
+        ]
+
+    def test_gm_options_profile_png(self, settings):
+        settings.ULTIMATETHUMB_ENCODER_PROFILES = {'png': {'progressive': True, 'strip': True}}
+        image = ImageModelFactory.create(file__filename='test.png', file__format='PNG')
+        thumbnail = Thumbnail(image.file.path, {'size': ['100', '50'], 'profile': 'png'})
+        options = thumbnail.get_gm_options()
+        assert options['strip'] is True
+        assert 'interlace' not in options
+
+    def test_profile(self, settings):
+        thumbnail = Thumbnail('test.jpg', {'size': ['100', '50']})
+        assert 'profile' not in thumbnail.options
+        assert thumbnail.get_encoder_options() == {}
+
+        settings.ULTIMATETHUMB_ENCODER_PROFILE = 'web'
+        profile_thumbnail = Thumbnail('test.jpg', {'size': ['100', '50']})
+        assert profile_thumbnail.options['profile'] == 'web'
+        assert profile_thumbnail.get_encoder_options()['progressive'] is True
+        assert profile_thumbnail.get_name() != thumbnail.get_name()
+
+        thumbnail = Thumbnail('test.jpg', {'size': ['100', '50'], 'profile': 'default'})
+        assert thumbnail.options['profile'] == 'default'
+
+    def test_profile_invalid(self):
+        with pytest.raises(ValueError):
+            Thumbnail('test.jpg', {'size': ['100', '50'], 'profile': 'invalid'})
+
     @pytest.mark.parametrize(
         'input_size,thumb_size,upscale,crop,expected',
         [
@@ -423,7 +574,198 @@ class TestThumbnail:
             'DEQA/AHhPom3/2Q=='
         )
 
+    def test_base64_content_cached(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+        content = thumbnail.get_base64_content()
+
+        with mock.patch.object(Thumbnail, 'read_base64_content') as read_mock:
+            assert thumbnail.get_base64_content() == content
+            assert Thumbnail(image.file.path, {'size': ['50', '50']}).base64.endswith(content)
+        assert read_mock.called is False
+
+    def test_base64_content_shared_cache(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_SHARED_BASE64_CACHE = True
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+        content = thumbnail.get_base64_content()
+        base64_cache.clear()
+
+        with mock.patch.object(Thumbnail, 'read_base64_content') as read_mock:
+            assert thumbnail.get_base64_content() == content
+        assert read_mock.called is False
+
+    def test_base64_content_without_file(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_BASE64_FILES = False
+        image = ImageModelFactory.create()
+        thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
+
+        with open(thumbnail.get_storage_path(), 'rb') as thumb_image:
+            expected = base64.b64encode(thumb_image.read()).decode()
+
+        assert thumbnail.get_base64_content() == expected
+        assert thumbnail.get_base64_path(generate=False).endswith('.base64')
+        assert os.path.exists(thumbnail.get_base64_path(generate=False)) is False
+
     def test_base64_path(self):
         image = ImageModelFactory.create()
         thumbnail = Thumbnail(image.file.path, {'size': ['50', '50']})
         assert thumbnail.get_base64_path().endswith('.base64')
+
+
+@pytest.mark.django_db
+class TestThumbnailSet:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+
+    def teardown(self):
+        cache.clear()
+
+    def test_get_thumbnails(self):
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+
+        assert len(thumbnails) == 2
+        for thumbnail in thumbnails:
+            assert Thumbnail.from_name(thumbnail.get_name()).options == (
+                thumbnail.get_name_options()
+            )
+
+    @mock.patch('ultimatethumb.utils.cache.has_key')
+    @mock.patch('ultimatethumb.utils.cache.set')
+    @mock.patch('ultimatethumb.utils.cache.get_many')
+    @mock.patch('ultimatethumb.utils.cache.set_many')
+    def test_get_thumbnails_cache_calls(self, set_many_mock, get_many_mock, set_mock, has_mock):
+        get_many_mock.return_value = {}
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0,150x0', {}).thumbnails
+
+        for thumbnail in thumbnails:
+            assert thumbnail.url
+            assert thumbnail.url_2x
+            assert thumbnail.get_mimetype() == 'image/jpeg'
+
+        assert get_many_mock.call_count == 1
+        assert set_many_mock.call_count == 1
+        assert has_mock.called is False
+        assert set_mock.called is False
+
+    def test_generate(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnail_set = ThumbnailSet(image.file.path, '50x0,100x0', {'factor2x': False})
+
+        with mock.patch(
+            'ultimatethumb.engines.PillowEngine.generate_source', autospec=True
+        ) as generate_mock:
+            assert thumbnail_set.generate() is True
+
+        assert generate_mock.call_count == 1
+        assert len(generate_mock.call_args[0][2]) == 2
+
+    def test_generate_existing(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnail_set = ThumbnailSet(image.file.path, '50x0', {'factor2x': False})
+        thumbnail_set.thumbnails[0].generate()
+
+        with mock.patch('ultimatethumb.thumbnail.generate_thumbnails') as generate_mock:
+            assert thumbnail_set.generate() is True
+
+        assert generate_mock.called is False
+
+    @mock.patch('ultimatethumb.utils.cache.get_many')
+    def test_get_thumbnails_signed_urls(self, get_many_mock, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+
+        assert len(thumbnails) == 2
+        assert thumbnails[0].url.startswith('/t/')
+        assert get_many_mock.called is False
+
+
+@pytest.mark.django_db
+class TestThumbnailVariants:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        cache.clear()
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_FORMATS = ['avif', 'webp']
+        self.image = ImageModelFactory.create(file__width=400, file__height=200)
+        yield
+        cache.clear()
+
+    def test_get_variant(self):
+        thumbnail = Thumbnail('test.png', {'size': ['100', '100']})
+        variant = thumbnail.get_variant('webp')
+
+        name = thumbnail.get_name()
+        assert variant.get_name() == name
+        assert thumbnail.format is None
+        assert variant.get_format_name() == '{0}.webp'.format(name)
+        assert variant.url == '/{0}.webp'.format(name)
+        assert variant.url_2x == '/2x/{0}.webp'.format(name)
+        assert variant.get_storage_name() == '{0}.webp'.format(name)
+        assert variant.get_storage_name(2) == '2x/{0}.webp'.format(name)
+        assert variant.get_storage_name(suffix='base64') == (
+            thumbnail.get_storage_name(suffix='base64')
+        )
+        assert variant.get_mimetype() == 'image/webp'
+        assert thumbnail.get_variant('avif').get_mimetype() == 'image/avif'
+
+    def test_variants(self):
+        thumbnail = Thumbnail('test.png', {'size': ['100', '100']})
+        assert thumbnail.variants == []
+
+        thumbnail.formats = ['avif', 'webp']
+        assert [variant.format for variant in thumbnail.variants] == ['avif', 'webp']
+
+    def test_generate(self):
+        thumbnail = Thumbnail(self.image.file.path, {'size': ['50', '50']})
+        variant = thumbnail.get_variant('webp')
+        variant.generate()
+
+        assert variant.exists() is True
+        assert thumbnail.exists() is False
+        with PILImage.open(variant.get_storage_path()) as image:
+            assert image.format == 'WEBP'
+        assert variant.get_size() == (50, 25)
+
+    def test_base64(self):
+        thumbnail = Thumbnail(self.image.file.path, {'size': ['2', '2']})
+        variant = thumbnail.get_variant('webp')
+
+        assert variant.base64 == thumbnail.base64
+        assert variant.base64.startswith('data:image/jpeg;base64,')
+
+    def test_generate_group(self):
+        thumbnails = ThumbnailSet(self.image.file.path, '50x0,100x0', {}).thumbnails
+        variant = thumbnails[0].get_variant('webp')
+
+        variant.generate_group()
+
+        for thumbnail in thumbnails:
+            assert thumbnail.get_variant('webp').exists() is True
+            assert thumbnail.get_variant('webp').exists(factor=2) is True
+            assert thumbnail.exists() is False
+
+    @requires_avif
+    def test_thumbnail_set(self):
+        thumbnail_set = ThumbnailSet(
+            self.image.file.path, '50x0,100x0', {}, formats=['avif', 'webp']
+        )
+
+        assert len(thumbnail_set.get_missing()) == 12
+
+        assert thumbnail_set.generate() is True
+
+        for thumbnail in thumbnail_set.thumbnails:
+            assert [variant.format for variant in thumbnail.variants] == ['avif', 'webp']
+            for variant in [thumbnail] + thumbnail.variants:
+                assert variant.exists() is True
+                assert variant.exists(factor=2) is True
@@ -1,18 +1,38 @@
+import base64
+import io
 import os
 from unittest import mock
 
 import pytest
 from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signing import BadSignature
 from django.utils.encoding import force_bytes
+from PIL import Image as PILImage
 
+from tests.factories.mockapp import ImageModelFactory
+from ultimatethumb.registry import get_group_cache_key
 from ultimatethumb.utils import (
+    LRUCache,
     MoveableNamedTemporaryFile,
     build_url,
+    encode_base64,
     factor_size,
+    get_accepted_format,
     get_cache_key,
+    get_encoder_profile,
+    get_formats,
+    get_size_for_path,
     get_thumb_data,
+    get_thumb_group,
     get_thumb_name,
+    get_thumb_names,
+    get_thumb_token,
+    get_token_data,
+    parse_formats,
     parse_sizes,
+    size_cache,
+    split_format,
 )
 
 
@@ -58,6 +78,53 @@ class TestGetThumbName:
         assert result1 == result2 == result3
 
 
+class TestGetThumbNames:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+
+    def test_call(self):
+        assert get_thumb_names([('test.jpg', {'arg1': 1, 'arg2': 2}), ('test.jpg', {})]) == [
+            get_thumb_name('test.jpg', arg1=1, arg2=2),
+            get_thumb_name('test.jpg'),
+        ]
+
+    def test_call_empty(self):
+        assert get_thumb_names([]) == []
+
+    @mock.patch('ultimatethumb.utils.cache.get_many')
+    @mock.patch('ultimatethumb.utils.cache.set_many')
+    def test_call_cache_set_many(self, set_many_mock, get_many_mock):
+        get_many_mock.return_value = {}
+
+        names = get_thumb_names([('test.jpg', {'arg1': 1}), ('test.jpg', {'arg1': 2})])
+        assert get_many_mock.call_count == 1
+        assert set_many_mock.call_count == 1
+        assert sorted(set_many_mock.call_args[0][0].keys()) == sorted(
+            [get_cache_key(name) for name in names]
+            + [get_group_cache_key(name) for name in names]
+        )
+
+        get_many_mock.return_value = {get_cache_key(names[0]): 'cached'}
+
+        get_thumb_names([('test.jpg', {'arg1': 1}), ('test.jpg', {'arg1': 2})])
+        assert get_many_mock.call_count == 2
+        assert set_many_mock.call_count == 2
+        assert sorted(set_many_mock.call_args[0][0].keys()) == sorted(
+            [get_cache_key(names[1]), get_group_cache_key(names[1])]
+        )
+
+        get_many_mock.return_value = dict((get_cache_key(name), 'cached') for name in names)
+
+        get_thumb_names([('test.jpg', {'arg1': 1}), ('test.jpg', {'arg1': 2})])
+        assert get_many_mock.call_count == 3
+        assert set_many_mock.call_count == 2
+
+    def test_call_valid_data(self):
+        name = get_thumb_names([('test.jpg', {'arg1': 1})])[0]
+        assert get_thumb_data(name) == ('test.jpg', {'arg1': 1})
+
+
 class TestGetThumbData:
     @pytest.fixture(autouse=True)
     def setup(self):
@@ -72,6 +139,50 @@ class TestGetThumbData:
         get_thumb_data(result1)
 
 
+class TestGetThumbGroup:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+
+    def test_group(self):
+        names = get_thumb_names([('test.jpg', {'arg1': 1}), ('test.jpg', {'arg1': 2})])
+        group = get_thumb_group(names[0])
+
+        assert group == {
+            names[0]: ('test.jpg', {'arg1': 1}),
+            names[1]: ('test.jpg', {'arg1': 2}),
+        }
+        assert get_thumb_group(names[1]) == group
+
+    def test_no_group(self):
+        name = get_thumb_name('test.jpg', arg1=1)
+        assert get_thumb_group(name) == {}
+
+
+class TestGetThumbToken:
+    def test_call(self):
+        token = get_thumb_token('test.jpg', arg1=1, arg2=2)
+        assert token == get_thumb_token('test.jpg', arg2=2, arg1=1)
+        assert get_token_data(token) == ('test.jpg', {'arg1': 1, 'arg2': 2})
+
+    def test_call_compressed(self):
+        options = {'size': ['100', '100'], 'crop': False, 'upscale': False, 'factor2x': True}
+        token = get_thumb_token('/some/long/path/to/media/test.jpg', **options)
+        assert token.startswith('.')
+        assert get_token_data(token) == ('/some/long/path/to/media/test.jpg', options)
+
+    def test_call_tampered(self):
+        token = get_thumb_token('test.jpg', arg1=1)
+        with pytest.raises(BadSignature):
+            get_token_data('a{0}'.format(token))
+
+    def test_call_other_secret(self, settings):
+        token = get_thumb_token('test.jpg', arg1=1)
+        settings.SECRET_KEY = 'other'
+        with pytest.raises(BadSignature):
+            get_token_data(token)
+
+
 class TestParseSizes:
     def test_valid_single(self):
         assert parse_sizes('400x100') == [['400', '100']]
@@ -130,6 +241,119 @@ class TestParseSizes:
             parse_sizes('400:50%x0')
 
 
+class TestFormats:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'tests.resources.engines.AvifEngine'
+        settings.ULTIMATETHUMB_FORMATS = ['avif', 'WEBP']
+
+    def test_get_formats(self, settings):
+        assert get_formats() == ['avif', 'webp']
+
+        # Graphicsmagick can't write AVIF.
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.GraphicsmagickEngine'
+        assert get_formats() == ['webp']
+
+        del settings.ULTIMATETHUMB_FORMATS
+        assert get_formats() == []
+
+    def test_parse_formats(self):
+        assert parse_formats(None) == []
+        assert parse_formats('webp, AVIF') == ['webp', 'avif']
+        assert parse_formats(['webp']) == ['webp']
+
+    def test_parse_formats_invalid(self):
+        with pytest.raises(ValueError):
+            parse_formats('webp,jxl')
+
+    def test_parse_formats_unsupported(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.GraphicsmagickEngine'
+
+        assert parse_formats('webp') == ['webp']
+        with pytest.raises(ImproperlyConfigured):
+            parse_formats('webp,avif')
+
+    def test_split_format(self):
+        assert split_format('abc/test.png.webp') == ('abc/test.png', 'webp')
+        assert split_format('abc/test.png.AVIF') == ('abc/test.png', 'avif')
+        assert split_format('abc/test.png') == ('abc/test.png', None)
+        assert split_format('abc/test.webp') == ('abc/test.webp', None)
+        assert split_format('abc/test.png.jxl') == ('abc/test.png.jxl', None)
+
+    @pytest.mark.parametrize(
+        'accept,exclude,expected',
+        [
+            (None, None, None),
+            ('*/*', None, None),
+            ('image/*,*/*;q=0.8', None, None),
+            ('image/webp,*/*', None, 'webp'),
+            ('image/avif,image/webp,image/apng,*/*;q=0.8', None, 'avif'),
+            ('image/webp,image/avif;q=0.5', None, 'webp'),
+            ('image/avif;q=0,image/webp', None, 'webp'),
+            ('image/avif;q=foo,image/webp', None, 'webp'),
+            ('image/avif,image/webp', 'avif', 'webp'),
+        ],
+    )
+    def test_get_accepted_format(self, accept, exclude, expected):
+        assert get_accepted_format(accept, exclude=exclude) == expected
+
+    def test_get_accepted_format_unsupported(self, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.GraphicsmagickEngine'
+        assert get_accepted_format('image/avif,image/webp;q=0.5') == 'webp'
+
+
+class TestEncoderProfiles:
+    def test_get_encoder_profile(self):
+        assert get_encoder_profile(None) == {}
+        assert get_encoder_profile('default') == {}
+        assert get_encoder_profile('web') == {
+            'progressive': True,
+            'optimize': True,
+            'subsampling': '4:2:0',
+            'strip': True,
+        }
+
+    def test_get_encoder_profile_setting(self, settings):
+        settings.ULTIMATETHUMB_ENCODER_PROFILES = {
+            'web': {'progressive': True},
+            'print': {'subsampling': '4:4:4'},
+        }
+        assert get_encoder_profile('web') == {'progressive': True}
+        assert get_encoder_profile('print') == {'subsampling': '4:4:4'}
+
+    @pytest.mark.parametrize(
+        'profile',
+        [
+            {'interlace': True},
+            {'subsampling': '4:1:1'},
+        ],
+    )
+    def test_get_encoder_profile_invalid(self, settings, profile):
+        settings.ULTIMATETHUMB_ENCODER_PROFILES = {'invalid': profile}
+        with pytest.raises(ValueError):
+            get_encoder_profile('invalid')
+
+        with pytest.raises(ValueError):
+            get_encoder_profile('missing')
+
+
+class TestEncodeBase64:
+    @pytest.mark.parametrize('size', [0, 1, 2, 3, 100, 1000])
+    def test_encode(self, size):
+        content = os.urandom(size)
+        chunks = list(encode_base64(io.BytesIO(content), chunk_size=30))
+
+        assert b''.join(chunks) == base64.b64encode(content)
+        assert all(b'=' not in chunk for chunk in chunks[:-1])
+
+    def test_short_reads(self):
+        content = os.urandom(100)
+        source = io.BytesIO(content)
+        source_file = mock.Mock(read=lambda size: source.read(min(size, 7)))
+
+        assert b''.join(encode_base64(source_file, chunk_size=30)) == base64.b64encode(content)
+
+
 class TestFactorSize:
     def test_int(self):
         assert factor_size(10, 2) == '20'
@@ -141,6 +365,118 @@ class TestFactorSize:
         assert factor_size('10%', 2) == '20%'
 
 
+class TestLRUCache:
+    def test_get_set(self):
+        lru = LRUCache('ULTIMATETHUMB_TEST_CACHE_SIZE', 2)
+        lru.set('a', 1)
+
+        assert lru.get('a') == 1
+        assert lru.get('b') is None
+        assert lru.get('b', 2) == 2
+
+    def test_evict_least_recently_used(self):
+        lru = LRUCache('ULTIMATETHUMB_TEST_CACHE_SIZE', 2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        assert len(lru) == 2
+        assert lru.get('a') == 1
+        assert lru.get('b') is None
+        assert lru.get('c') == 3
+
+    def test_disabled(self, settings):
+        settings.ULTIMATETHUMB_TEST_CACHE_SIZE = 0
+        lru = LRUCache('ULTIMATETHUMB_TEST_CACHE_SIZE', 2)
+        lru.set('a', 1)
+
+        assert len(lru) == 0
+
+    def test_sizeof(self):
+        lru = LRUCache('ULTIMATETHUMB_TEST_CACHE_SIZE', 10, sizeof=len)
+        lru.set('a', 'x' * 4)
+        lru.set('b', 'x' * 4)
+        lru.set('a', 'x' * 5)
+        assert (len(lru), lru.size) == (2, 9)
+
+        lru.set('c', 'x' * 3)
+        assert lru.get('b') is None
+        assert (len(lru), lru.size) == (2, 8)
+
+        # Too large to be cached at all.
+        lru.set('d', 'x' * 11)
+        assert lru.get('d') is None
+        assert (len(lru), lru.size) == (2, 8)
+
+        lru.clear()
+        assert lru.size == 0
+
+
+@pytest.mark.django_db
+class TestGetSizeForPath:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+        size_cache.clear()
+
+    def test_call(self):
+        image = ImageModelFactory.create(file__width=50, file__height=100)
+        assert get_size_for_path(image.file.path) == (50, 100)
+
+    def test_call_missing(self):
+        with pytest.raises(OSError):
+            get_size_for_path('/does/not/exist.jpg')
+
+    @mock.patch('ultimatethumb.utils.probe_size_for_path')
+    def test_call_cached(self, probe_mock):
+        probe_mock.return_value = (50, 100)
+        image = ImageModelFactory.create(file__width=50, file__height=100)
+
+        assert get_size_for_path(image.file.path) == (50, 100)
+        assert get_size_for_path(image.file.path) == (50, 100)
+        assert probe_mock.call_count == 1
+
+    def test_call_file_changed(self):
+        image = ImageModelFactory.create(file__width=50, file__height=100)
+        assert get_size_for_path(image.file.path) == (50, 100)
+
+        stat = os.stat(image.file.path)
+        PILImage.new('RGB', (20, 10)).save(image.file.path, 'JPEG')
+        os.utime(image.file.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+        assert get_size_for_path(image.file.path) == (20, 10)
+
+    @mock.patch('ultimatethumb.utils.probe_size_for_path')
+    def test_call_shared_cache(self, probe_mock, settings):
+        settings.ULTIMATETHUMB_SHARED_SIZE_CACHE = True
+        probe_mock.return_value = (50, 100)
+        image = ImageModelFactory.create(file__width=50, file__height=100)
+
+        assert get_size_for_path(image.file.path) == (50, 100)
+        size_cache.clear()
+        assert get_size_for_path(image.file.path) == (50, 100)
+        assert probe_mock.call_count == 1
+
+    @mock.patch('ultimatethumb.utils.probe_image_size')
+    def test_call_header_probe(self, probe_mock, settings):
+        settings.ULTIMATETHUMB_SIZE_PROBE = 'header'
+        probe_mock.return_value = (50, 100)
+        image = ImageModelFactory.create(file__width=50, file__height=100)
+
+        assert get_size_for_path(image.file.path) == (50, 100)
+        assert probe_mock.call_count == 1
+
+    @mock.patch('ultimatethumb.utils.probe_image_size')
+    def test_call_header_probe_fallback(self, probe_mock, settings):
+        settings.ULTIMATETHUMB_SIZE_PROBE = 'header'
+        probe_mock.return_value = None
+        image = ImageModelFactory.create(file__width=50, file__height=100)
+
+        assert get_size_for_path(image.file.path) == (50, 100)
+        assert probe_mock.call_count == 1
+
+
 class TestBuildUrl:
     def test_no_factor(self):
         assert build_url('207736f753aeca1bdbc5ebd4d2e265d45194fc28/test.jpg') == (
@@ -152,6 +488,16 @@ class TestBuildUrl:
             '/2x/207736f753aeca1bdbc5ebd4d2e265d45194fc28/test.jpg'
         )
 
+    def test_token(self):
+        assert build_url(
+            '207736f753aeca1bdbc5ebd4d2e265d45194fc28/test.jpg', token='abc:def'
+        ) == ('/t/abc:def/test.jpg')
+
+    def test_token_with_factor(self):
+        assert build_url(
+            '207736f753aeca1bdbc5ebd4d2e265d45194fc28/test.jpg', 2, token='.abc:def'
+        ) == ('/2x/t/.abc:def/test.jpg')
+
     def test_domain_with_scheme(self, settings):
         settings.ULTIMATETHUMB_DOMAIN = 'http://statichost'
         assert build_url('207736f753aeca1bdbc5ebd4d2e265d45194fc28/test.jpg') == (
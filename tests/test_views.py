@@ -1,9 +1,28 @@
+import os
+import tempfile
+from unittest import mock
+
 import pytest
-from django.urls import reverse
+from django.core.cache import cache
+from django.http import Http404
+from django.urls import resolve, reverse
 
 from tests.factories.mockapp import ImageModelFactory
+from tests.resources.compat import (
+    AsyncRequestFactory,
+    async_to_sync,
+    requires_async_views,
+    requires_avif,
+)
+from ultimatethumb.locks import SlotLock
 from ultimatethumb.storage import thumbnail_storage
-from ultimatethumb.thumbnail import Thumbnail
+from ultimatethumb.thumbnail import Thumbnail, ThumbnailSet
+from ultimatethumb.views import (
+    AsyncThumbnailView,
+    etag_matches,
+    get_etag,
+    get_server_timing,
+)
 
 
 @pytest.mark.django_db
@@ -23,6 +42,29 @@ class TestThumbnailView:
         assert 'Content-Disposition' not in response
         assert 'X-Accel-Redirect' not in response
 
+    def test_get_batch_generation(self, client, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+
+        response = client.get(thumbnails[0].url)
+
+        assert response.status_code == 200
+        assert thumbnails[1].exists() is True
+        assert thumbnails[1].exists(factor=2) is True
+
+    def test_get_batch_generation_disabled(self, client, settings):
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_BATCH_GENERATION = False
+        image = ImageModelFactory.create(file__width=400, file__height=200)
+        thumbnails = ThumbnailSet(image.file.path, '50x0,100x0', {}).thumbnails
+
+        response = client.get(thumbnails[0].url)
+
+        assert response.status_code == 200
+        assert thumbnails[0].exists() is True
+        assert thumbnails[1].exists() is False
+
     def test_get_invalid(self, client):
         response = client.get(
             reverse(
@@ -32,6 +74,34 @@ class TestThumbnailView:
         )
         assert response.status_code == 404
 
+    def test_get_signed(self, client, settings):
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+        cache.clear()
+
+        response = client.get(thumbnail.url_2x)
+
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'image/jpeg'
+
+    def test_get_signed_invalid(self, client):
+        response = client.get(
+            reverse('thumbnail-signed', kwargs={'token': 'foo:bar', 'filename': 'foobar.jpg'})
+        )
+        assert response.status_code == 404
+
+    def test_get_signed_invalid_filename(self, client, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+
+        response = client.get(
+            reverse(
+                'thumbnail-signed', kwargs={'token': thumbnail.token, 'filename': 'foo.jpg'}
+            )
+        )
+        assert response.status_code == 404
+
     def test_get_x_accel_redirect(self, client, settings):
         settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = True
         response = client.get(self.thumbnail.url)
@@ -62,3 +132,470 @@ class TestThumbnailView:
             self.thumbnail.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
         )
         assert response2.status_code == 304
+
+
+@pytest.mark.django_db
+class TestThumbnailViewFileResponse:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+
+        with open(self.thumbnail.get_storage_path(), 'rb') as thumbnail_file:
+            self.content = thumbnail_file.read()
+
+    def test_get(self, client):
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response.streaming is True
+        assert b''.join(response.streaming_content) == self.content
+        assert response['Content-Length'] == str(len(self.content))
+        assert response['Accept-Ranges'] == 'bytes'
+        assert 'Content-Disposition' not in response
+
+    def test_get_range(self, client):
+        response = client.get(self.thumbnail.url, HTTP_RANGE='bytes=10-19')
+
+        assert response.status_code == 206
+        assert b''.join(response.streaming_content) == self.content[10:20]
+        assert response['Content-Length'] == '10'
+        assert response['Content-Range'] == 'bytes 10-19/{0}'.format(len(self.content))
+
+    def test_get_range_open(self, client):
+        response = client.get(self.thumbnail.url, HTTP_RANGE='bytes=10-')
+
+        assert response.status_code == 206
+        assert b''.join(response.streaming_content) == self.content[10:]
+
+    def test_get_range_suffix(self, client):
+        response = client.get(self.thumbnail.url, HTTP_RANGE='bytes=-10')
+
+        assert response.status_code == 206
+        assert b''.join(response.streaming_content) == self.content[-10:]
+
+    def test_get_range_not_satisfiable(self, client):
+        response = client.get(
+            self.thumbnail.url, HTTP_RANGE='bytes={0}-'.format(len(self.content))
+        )
+
+        assert response.status_code == 416
+        assert response['Content-Range'] == 'bytes */{0}'.format(len(self.content))
+
+    def test_get_range_multiple(self, client):
+        response = client.get(self.thumbnail.url, HTTP_RANGE='bytes=0-1,5-6')
+
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content) == self.content
+
+    def test_get_if_range(self, client):
+        response = client.get(self.thumbnail.url)
+
+        response = client.get(
+            self.thumbnail.url,
+            HTTP_RANGE='bytes=0-9',
+            HTTP_IF_RANGE=response['Last-Modified'],
+        )
+        assert response.status_code == 206
+
+        response = client.get(
+            self.thumbnail.url,
+            HTTP_RANGE='bytes=0-9',
+            HTTP_IF_RANGE='Wed, 21 Oct 2015 07:28:00 GMT',
+        )
+        assert response.status_code == 200
+
+    def test_get_if_range_etag(self, client):
+        etag = client.get(self.thumbnail.url)['ETag']
+
+        response = client.get(self.thumbnail.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        assert response.status_code == 206
+        assert b''.join(response.streaming_content) == self.content[:10]
+
+        # Weak or other ETags don't match.
+        for if_range in ('W/{0}'.format(etag), '"other"'):
+            response = client.get(
+                self.thumbnail.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=if_range
+            )
+            assert response.status_code == 200
+
+    def test_head(self, client):
+        with mock.patch('ultimatethumb.offload.open', create=True) as open_mock:
+            response = client.head(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response.content == b''
+        assert response['Content-Length'] == str(len(self.content))
+        assert open_mock.called is False
+
+
+@pytest.mark.django_db
+class TestThumbnailViewCaching:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+        self.etag = '"{0}"'.format(self.thumbnail.get_name().split('/')[0])
+
+    def test_etag(self, client):
+        response = client.get(self.thumbnail.url)
+        assert response['ETag'] == self.etag
+        assert 'Cache-Control' not in response
+
+        response = client.get(self.thumbnail.url_2x)
+        assert response['ETag'] == self.etag[:-1] + '-2x"'
+
+    def test_if_none_match(self, client):
+        with mock.patch('ultimatethumb.views.Thumbnail') as thumbnail_mock, mock.patch(
+            'ultimatethumb.storage.os.stat'
+        ) as stat_mock:
+            response = client.get(self.thumbnail.url, HTTP_IF_NONE_MATCH=self.etag)
+
+        assert response.status_code == 304
+        assert response['ETag'] == self.etag
+        assert thumbnail_mock.from_name.called is False
+        assert stat_mock.called is False
+
+    def test_if_none_match_other(self, client):
+        response = client.get(self.thumbnail.url)
+
+        response = client.get(
+            self.thumbnail.url,
+            HTTP_IF_NONE_MATCH='"other"',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'],
+        )
+        assert response.status_code == 200
+
+    def test_if_none_match_signed(self, client, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+
+        with mock.patch('ultimatethumb.storage.os.stat') as stat_mock, mock.patch(
+            'ultimatethumb.utils.cache.get'
+        ) as cache_mock:
+            response = client.get(thumbnail.url, HTTP_IF_NONE_MATCH=self.etag)
+
+        assert response.status_code == 304
+        assert stat_mock.called is False
+        assert cache_mock.called is False
+
+    def test_cache_control(self, client, settings):
+        settings.ULTIMATETHUMB_CACHE_CONTROL_MAX_AGE = 3600
+
+        response = client.get(self.thumbnail.url)
+        assert response['Cache-Control'] == 'public, max-age=3600, immutable'
+
+        response = client.get(self.thumbnail.url, HTTP_IF_NONE_MATCH=self.etag)
+        assert response['Cache-Control'] == 'public, max-age=3600, immutable'
+
+    def test_single_stat(self, client):
+        self.thumbnail.generate()
+
+        with mock.patch('ultimatethumb.storage.os.stat', wraps=os.stat) as stat_mock:
+            response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert stat_mock.call_count == 1
+
+
+@pytest.mark.django_db
+class TestThumbnailViewFormats:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        cache.clear()
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_FORMATS = ['avif', 'webp']
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+        self.thumb_hash = self.thumbnail.get_name().split('/')[0]
+        yield
+        cache.clear()
+
+    def test_variant_url(self, client):
+        variant = self.thumbnail.get_variant('webp')
+        response = client.get(variant.url)
+
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'image/webp'
+        assert response['ETag'] == '"{0}-webp"'.format(self.thumb_hash)
+        assert 'Vary' not in response
+        assert variant.exists() is True
+        assert self.thumbnail.exists() is False
+
+        response = client.get(variant.url_2x)
+        assert response['ETag'] == '"{0}-2x-webp"'.format(self.thumb_hash)
+
+    def test_variant_url_disabled(self, client, settings):
+        variant_url = self.thumbnail.get_variant('webp').url
+        settings.ULTIMATETHUMB_FORMATS = []
+
+        assert client.get(variant_url).status_code == 404
+
+    @requires_avif
+    def test_variant_url_signed(self, client, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+        response = client.get(thumbnail.get_variant('avif').url)
+
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'image/avif'
+
+    def test_negotiate(self, client, settings):
+        settings.ULTIMATETHUMB_NEGOTIATE_FORMATS = True
+
+        response = client.get(self.thumbnail.url, HTTP_ACCEPT='image/webp,*/*')
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'image/webp'
+        assert response['Vary'] == 'Accept'
+        assert response['ETag'] == '"{0}-webp"'.format(self.thumb_hash)
+
+        response = client.get(self.thumbnail.url, HTTP_ACCEPT='*/*')
+        assert response['Content-Type'] == 'image/jpeg'
+        assert response['Vary'] == 'Accept'
+        assert response['ETag'] == '"{0}"'.format(self.thumb_hash)
+
+    def test_negotiate_not_modified(self, client, settings):
+        settings.ULTIMATETHUMB_NEGOTIATE_FORMATS = True
+
+        response = client.get(
+            self.thumbnail.url,
+            HTTP_ACCEPT='image/avif',
+            HTTP_IF_NONE_MATCH='"{0}-avif"'.format(self.thumb_hash),
+        )
+        assert response.status_code == 304
+        assert response['Vary'] == 'Accept'
+
+        response = client.get(
+            self.thumbnail.url,
+            HTTP_ACCEPT='image/webp',
+            HTTP_IF_NONE_MATCH='"{0}-avif"'.format(self.thumb_hash),
+        )
+        assert response.status_code == 200
+
+    def test_negotiate_disabled(self, client):
+        response = client.get(self.thumbnail.url, HTTP_ACCEPT='image/webp,*/*')
+
+        assert response['Content-Type'] == 'image/jpeg'
+        assert 'Vary' not in response
+
+    def test_negotiate_gif(self, client, settings):
+        settings.ULTIMATETHUMB_NEGOTIATE_FORMATS = True
+        image = ImageModelFactory.create(file__filename='test.gif', file__format='GIF')
+        thumbnail = Thumbnail(image.file.path, {'size': [50, 50]})
+
+        response = client.get(thumbnail.url, HTTP_ACCEPT='image/webp,*/*')
+        assert response['Content-Type'] == 'image/gif'
+        assert 'Vary' not in response
+
+
+@pytest.mark.django_db
+class TestThumbnailViewServerTiming:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        cache.clear()
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_SERVER_TIMING = True
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+        yield
+        cache.clear()
+
+    def get_stages(self, response):
+        return [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+
+    def test_miss(self, client):
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response['X-Ultimatethumb-Generated'] == 'miss'
+        stages = self.get_stages(response)
+        for stage in ('lookup', 'exists', 'lock', 'decode', 'resize', 'encode', 'engine'):
+            assert stage in stages
+        assert stages[-1] == 'total'
+
+    def test_hit(self, client):
+        self.thumbnail.generate()
+        response = client.get(self.thumbnail.url)
+
+        assert response['X-Ultimatethumb-Generated'] == 'hit'
+        assert self.get_stages(response) == ['lookup', 'exists', 'total']
+
+    def test_not_modified(self, client):
+        response = client.get(
+            self.thumbnail.url,
+            HTTP_IF_NONE_MATCH='"{0}"'.format(self.thumbnail.get_name().split('/')[0]),
+        )
+
+        assert response.status_code == 304
+        assert 'X-Ultimatethumb-Generated' not in response
+        assert self.get_stages(response) == ['total']
+
+    def test_disabled(self, client, settings):
+        settings.ULTIMATETHUMB_SERVER_TIMING = False
+        response = client.get(self.thumbnail.url)
+
+        assert 'Server-Timing' not in response
+        assert 'X-Ultimatethumb-Generated' not in response
+
+
+@requires_async_views
+@pytest.mark.django_db
+class TestAsyncThumbnailView:
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        cache.clear()
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50], 'retina': True})
+        yield
+        cache.clear()
+
+    def get(self, url, headers=None):
+        return async_to_sync(AsyncThumbnailView.as_view())(
+            AsyncRequestFactory().get(url, headers=headers), **resolve(url).kwargs
+        )
+
+    def test_view_is_async(self):
+        assert AsyncThumbnailView.view_is_async is True
+
+    def test_get(self):
+        response = self.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'image/jpeg'
+        assert response['ETag'] == get_etag(self.thumbnail.get_name())
+        assert 'Last-Modified' in response
+        # The group is generated at once.
+        assert self.thumbnail.exists() is True
+        assert self.thumbnail.exists(factor=2) is True
+
+        response = self.get(self.thumbnail.url_2x)
+        assert response.status_code == 200
+
+    def test_get_batch_generation_disabled(self, settings):
+        settings.ULTIMATETHUMB_BATCH_GENERATION = False
+        self.get(self.thumbnail.url)
+
+        assert self.thumbnail.exists() is True
+        assert self.thumbnail.exists(factor=2) is False
+
+    def test_get_not_modified(self):
+        with mock.patch('ultimatethumb.views.Thumbnail') as thumbnail_mock:
+            response = self.get(
+                self.thumbnail.url,
+                headers={'If-None-Match': get_etag(self.thumbnail.get_name())},
+            )
+
+        assert response.status_code == 304
+        assert thumbnail_mock.from_name.called is False
+
+    def test_get_invalid(self):
+        with pytest.raises(Http404):
+            self.get(reverse('thumbnail', kwargs={'name': '{0}/test.jpg'.format('a' * 40)}))
+
+    def test_get_signed(self, settings):
+        settings.ULTIMATETHUMB_SIGNED_URLS = True
+        thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+        cache.clear()
+
+        response = self.get(thumbnail.url)
+        assert response.status_code == 200
+
+    def test_server_timing(self, settings):
+        settings.ULTIMATETHUMB_SERVER_TIMING = True
+        response = self.get(self.thumbnail.url)
+
+        assert response['X-Ultimatethumb-Generated'] == 'miss'
+        stages = [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+        for stage in ('lookup', 'exists', 'lock', 'queue', 'decode', 'engine', 'save'):
+            assert stage in stages
+
+        response = self.get(self.thumbnail.url)
+        assert response['X-Ultimatethumb-Generated'] == 'hit'
+
+
+@pytest.mark.django_db
+class TestThumbnailViewAdmissionControl:
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch, settings, tmp_path):
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+        settings.ULTIMATETHUMB_USE_X_ACCEL_REDIRECT = False
+        settings.ULTIMATETHUMB_ENGINE = 'ultimatethumb.engines.PillowEngine'
+        settings.ULTIMATETHUMB_ADMISSION_CONTROL = True
+        settings.ULTIMATETHUMB_GENERATION_SLOTS = 1
+        settings.ULTIMATETHUMB_GENERATION_QUEUE_SIZE = 0
+        self.image = ImageModelFactory.create()
+        self.thumbnail = Thumbnail(self.image.file.path, {'size': [50, 50]})
+
+    def test_admitted(self, client):
+        response = client.get(self.thumbnail.url)
+
+        assert response.status_code == 200
+        # The slot is released.
+        assert SlotLock('slot-0').acquire(blocking=False) is True
+
+    def test_rejected(self, client, settings):
+        settings.ULTIMATETHUMB_GENERATION_RETRY_AFTER = 10
+        existing = Thumbnail(self.image.file.path, {'size': [20, 20]})
+        existing.generate()
+
+        with SlotLock('slot-0'):
+            response = client.get(self.thumbnail.url)
+            assert response.status_code == 503
+            assert response['Retry-After'] == '10'
+            assert 'no-cache' in response['Cache-Control']
+            assert 'ETag' not in response
+            assert self.thumbnail.exists() is False
+
+            # Existing thumbnails are served.
+            assert client.get(existing.url).status_code == 200
+
+    @requires_async_views
+    def test_rejected_async(self):
+        with SlotLock('slot-0'):
+            response = async_to_sync(AsyncThumbnailView.as_view())(
+                AsyncRequestFactory().get(self.thumbnail.url),
+                **resolve(self.thumbnail.url).kwargs
+            )
+
+        assert response.status_code == 503
+        assert response['Retry-After'] == '5'
+
+
+def test_get_server_timing():
+    assert get_server_timing([], 0.001) == 'total;dur=1.00'
+    assert get_server_timing(
+        [('lookup', 0.0001), ('encode', 0.002), ('encode', 0.003)], 0.01
+    ) == ('lookup;dur=0.10, encode;dur=5.00, total;dur=10.00')
+
+
+def test_get_etag():
+    assert get_etag('{0}/test.jpg'.format('a' * 40)) == '"{0}"'.format('a' * 40)
+    assert get_etag('{0}/test.jpg'.format('a' * 40), 2) == '"{0}-2x"'.format('a' * 40)
+    assert get_etag('{0}/test.jpg'.format('a' * 40), 2, 'webp') == '"{0}-2x-webp"'.format(
+        'a' * 40
+    )
+
+
+@pytest.mark.parametrize(
+    'value,expected',
+    [
+        (None, False),
+        ('', False),
+        ('"abc"', True),
+        ('W/"abc"', True),
+        ('"other", "abc"', True),
+        ('*', True),
+        ('"other"', False),
+        ('abc', False),
+    ],
+)
+def test_etag_matches(value, expected):
+    assert etag_matches(value, '"abc"') is expected
@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class UltimatethumbConfig(AppConfig):
+    name = 'ultimatethumb'
+    verbose_name = 'Ultimatethumb'
+    default_auto_field = 'django.db.models.AutoField'
@@ -0,0 +1,229 @@
+import heapq
+import os
+import re
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
+
+from .storage import get_local_path
+
+HASH_RE = re.compile(r'^[0-9a-f]{40}$')
+FACTOR_RE = re.compile(r'^\d+x$')
+
+ThumbnailGroup = namedtuple('ThumbnailGroup', ('last_access', 'name', 'size', 'files'))
+
+
+class ThumbnailCleanup(object):
+    """
+    Removes the least recently accessed thumbnails until the thumbnail storage
+    fits into the configured size and file budget.
+
+    A thumbnail is removed together with its companions (retina versions,
+    base64 versions and lock files). Sidecar files of the registry are kept to
+    allow generating the thumbnail again if requested. Base64 files without
+    the thumbnail they were generated from are removed in any case.
+
+    The last access is based on the access time of the files (and the
+    modification time if atime is not updated by the file system).
+
+    The storage is walked twice using os.scandir: the first pass calculates the
+    totals, the second pass only keeps the oldest thumbnails needed to get
+    below the budget in memory.
+    """
+
+    def __init__(self, max_size=None, max_files=None, dry_run=False, root=None):
+        if max_size is None:
+            max_size = getattr(settings, 'ULTIMATETHUMB_CLEANUP_MAX_SIZE', None)
+        if max_files is None:
+            max_files = getattr(settings, 'ULTIMATETHUMB_CLEANUP_MAX_FILES', None)
+
+        self.max_size = max_size
+        self.max_files = max_files
+        self.dry_run = dry_run
+        self.root = root or get_local_path('')
+        if self.root is None:
+            raise ImproperlyConfigured('Cleanup requires a local thumbnail storage.')
+
+    def run(self):
+        """
+        Runs the cleanup, returns a dict with statistics.
+        """
+        stats = {
+            'thumbnails': 0,
+            'files': 0,
+            'size': 0,
+            'orphans': 0,
+            'removed_thumbnails': 0,
+            'removed_files': 0,
+            'removed_size': 0,
+        }
+
+        if not os.path.isdir(self.root):
+            return stats
+
+        for group in self.iter_groups(remove_orphans=True, stats=stats):
+            stats['thumbnails'] += 1
+            stats['files'] += group.files
+            stats['size'] += group.size
+
+        excess_size = stats['size'] - self.max_size if self.max_size is not None else 0
+        excess_files = stats['files'] - self.max_files if self.max_files is not None else 0
+
+        if excess_size > 0 or excess_files > 0:
+            for group in self.get_oldest_groups(excess_size, excess_files):
+                self.remove_group(group.name)
+                stats['removed_thumbnails'] += 1
+                stats['removed_files'] += group.files
+                stats['removed_size'] += group.size
+
+        return stats
+
+    def get_oldest_groups(self, excess_size, excess_files):
+        """
+        Returns the least recently accessed groups which need to be removed to
+        free excess_size bytes and excess_files files, oldest first.
+        """
+        heap = []
+        heap_size = 0
+        heap_files = 0
+
+        for group in self.iter_groups():
+            heapq.heappush(heap, (-group.last_access, group))
+            heap_size += group.size
+            heap_files += group.files
+
+            # Drop the most recently accessed group if the others are sufficient.
+            while heap:
+                newest = heap[0][1]
+                if (
+                    heap_size - newest.size < excess_size
+                    or heap_files - newest.files < excess_files
+                ):
+                    break
+
+                heapq.heappop(heap)
+                heap_size -= newest.size
+                heap_files -= newest.files
+
+        return [group for _, group in sorted(heap, reverse=True)]
+
+    def get_group_dirs(self, name):
+        """
+        Returns the existing directories of a thumbnail, including the
+        directories of other factors (e.g. 2x).
+        """
+        dirs = []
+
+        path = os.path.join(self.root, name)
+        if os.path.isdir(path):
+            dirs.append(path)
+
+        for factor_dir in self.factor_dirs:
+            path = os.path.join(factor_dir, name)
+            if os.path.isdir(path):
+                dirs.append(path)
+
+        return dirs
+
+    @cached_property
+    def factor_dirs(self):
+        with os.scandir(self.root) as entries:
+            return [
+                entry.path
+                for entry in entries
+                if FACTOR_RE.match(entry.name) and entry.is_dir(follow_symlinks=False)
+            ]
+
+    def iter_groups(self, remove_orphans=False, stats=None):
+        """
+        Yields a ThumbnailGroup for every thumbnail directory hash. Orphaned files
+        are not part of the groups, they are removed (and counted in stats) if
+        remove_orphans is set.
+        """
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if HASH_RE.match(entry.name) and entry.is_dir(follow_symlinks=False):
+                    yield from self.iter_group(entry.name, remove_orphans, stats)
+
+        # Retina versions without a thumbnail directory.
+        for factor_dir in self.factor_dirs:
+            with os.scandir(factor_dir) as entries:
+                for entry in entries:
+                    if (
+                        HASH_RE.match(entry.name)
+                        and entry.is_dir(follow_symlinks=False)
+                        and not os.path.isdir(os.path.join(self.root, entry.name))
+                    ):
+                        yield from self.iter_group(entry.name, remove_orphans, stats)
+
+    def iter_group(self, name, remove_orphans=False, stats=None):
+        group = self.get_group(name, remove_orphans, stats)
+        if group.files:
+            yield group
+        elif remove_orphans:
+            # Only orphans were found, remove the empty directories.
+            self.remove_group(name)
+
+    def get_group(self, name, remove_orphans=False, stats=None):
+        last_access, size, files = 0, 0, 0
+
+        for path in self.get_group_dirs(name):
+            with os.scandir(path) as entries:
+                entries = [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+
+            filenames = set(entry.name for entry in entries)
+            for entry in entries:
+                if self.is_orphan(entry.name, filenames):
+                    if remove_orphans:
+                        stats['orphans'] += 1
+                        if not self.dry_run:
+                            os.remove(entry.path)
+                    continue
+
+                stat = entry.stat(follow_symlinks=False)
+                last_access = max(last_access, stat.st_atime, stat.st_mtime)
+                size += stat.st_size
+                files += 1
+
+        return ThumbnailGroup(last_access, name, size, files)
+
+    def is_orphan(self, filename, filenames):
+        """
+        Checks if the file is a base64 version without its thumbnail.
+        """
+        stem, extension = os.path.splitext(filename)
+        if extension != '.base64':
+            return False
+
+        return not any(
+            os.path.splitext(other)[0] == stem for other in filenames if other != filename
+        )
+
+    def remove_group(self, name):
+        """
+        Removes all files and directories of the thumbnail.
+        """
+        if self.dry_run:
+            return
+
+        for path in self.get_group_dirs(name):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        os.remove(entry.path)
+
+            try:
+                os.rmdir(path)
+            except OSError:
+                # Directory is not empty, e.g. the thumbnail was generated again.
+                pass
+
+
+def cleanup_thumbnails(max_size=None, max_files=None, dry_run=False):
+    """
+    Removes the least recently accessed thumbnails to fit into the budget,
+    see ThumbnailCleanup.
+    """
+    return ThumbnailCleanup(max_size=max_size, max_files=max_files, dry_run=dry_run).run()
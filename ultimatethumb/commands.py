@@ -1,8 +1,42 @@
-from command_executor import Command
+import asyncio
+import subprocess
+
+from command_executor import Command, CommandExecutionError
 from django.conf import settings
+from django.utils.encoding import force_str
+
+
+class AsyncCommandMixin(object):
+    """
+    Adds aexecute to commands, the async version of execute. The process is
+    started without a shell and waited for without blocking the event loop.
+    """
+
+    async def aexecute(self, ignore_output=None, fail_silently=None, stdin=None):
+        ignore_output = ignore_output if ignore_output is not None else self.ignore_output
+        fail_silently = fail_silently if fail_silently is not None else self.fail_silently
 
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.get_command(),
+                stdout=self.stdout,
+                stderr=self.stderr,
+                stdin=subprocess.PIPE,
+            )
+            stdout, stderr = await self.process.communicate(
+                input=stdin.encode() if stdin is not None else None
+            )
+        except OSError as exc:
+            raise CommandExecutionError(1, str(exc), self)
 
-class GraphicsmagickCommand(Command):
+        stderr = force_str(stderr or '')
+        if not fail_silently and (stderr or self.process.returncode != 0):
+            raise CommandExecutionError(self.process.returncode, stderr, self)
+
+        return True if ignore_output else self.handle_output(force_str(stdout or ''))
+
+
+class GraphicsmagickCommand(AsyncCommandMixin, Command):
     """
     Command to call gm (Graphicsmagick) to generate thumbnails.
     """
@@ -11,6 +45,8 @@ class GraphicsmagickCommand(Command):
 
     command = '{GM_BIN} convert "{infile}" {options} "{outfile}"'
 
+    batch_command = 'convert "{infile}" {options} "{outfile}"'
+
     def get_parameters(self):
         GM_BIN = getattr(settings, 'ULTIMATETHUMB_GRAPHICSMAGICK_BINARY', 'gm')
 
@@ -31,6 +67,41 @@ class GraphicsmagickCommand(Command):
             ),
         }
 
+    def get_batch_command(self):
+        """
+        Returns the convert command as line to pass to gm batch.
+        """
+        return self.batch_command.format(**self.get_parameters())
+
+
+class GraphicsmagickBatchCommand(AsyncCommandMixin, Command):
+    """
+    Command to call gm batch to run multiple gm convert commands in one process.
+    """
+
+    required_parameters = ['commands']
+
+    command = '{GM_BIN} batch -stop-on-error on -'
+
+    def get_parameters(self):
+        GM_BIN = getattr(settings, 'ULTIMATETHUMB_GRAPHICSMAGICK_BINARY', 'gm')
+
+        return {'GM_BIN': GM_BIN}
+
+    def get_stdin(self):
+        return ''.join(
+            '{0}\n'.format(command.get_batch_command())
+            for command in self.parameters['commands']
+        )
+
+    def execute(self, **kwargs):
+        kwargs.setdefault('stdin', self.get_stdin())
+        return super().execute(**kwargs)
+
+    async def aexecute(self, **kwargs):
+        kwargs.setdefault('stdin', self.get_stdin())
+        return await super().aexecute(**kwargs)
+
 
 class PngquantCommand(Command):
     """
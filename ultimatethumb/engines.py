@@ -0,0 +1,362 @@
+import os
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from PIL import Image as PILImage
+from PIL import features
+
+from .commands import GraphicsmagickBatchCommand, GraphicsmagickCommand
+from .metrics import metrics
+from .sources import get_source_path
+from .utils import run_in_thread
+
+# Offsets of the crop box per gravity, as fraction of the remaining space.
+GRAVITY_OFFSETS = {
+    'Center': (0.5, 0.5),
+    'North': (0.5, 0),
+    'NorthWest': (0, 0),
+    'NorthEast': (1, 0),
+    'West': (0, 0.5),
+    'East': (1, 0.5),
+    'South': (0.5, 1),
+    'SouthWest': (0, 1),
+    'SouthEast': (1, 1),
+}
+
+# Quantize methods, the values of PIL.Image.Quantize (Pillow 9.1 and newer).
+QUANTIZE_MEDIANCUT = 0
+QUANTIZE_FASTOCTREE = 2
+QUANTIZE_LIBIMAGEQUANT = 3
+
+
+def get_quantize_colors(quality):
+    """
+    Returns the palette size for a pngquant quality ("min-max" or "max", 0-100).
+    Pillow doesn't expose the quality targets of libimagequant, the size is derived
+    from the max quality: 100 uses all 256 colors, every 12.5 less halves them.
+    """
+    max_quality = int(str(quality).split('-')[-1] or 100)
+    return max(2, min(256, int(round(2 ** (8 * max_quality / 100.0)))))
+
+
+def get_pillow_format(image_format):
+    """
+    Returns the Pillow format name for a file extension (without the dot) or
+    None if Pillow can't write the format (no plugin or the encoder library is
+    missing).
+    """
+    pillow_format = PILImage.registered_extensions().get('.{0}'.format(image_format.lower()))
+    if pillow_format not in PILImage.SAVE:
+        return None
+
+    return pillow_format
+
+
+def get_engine():
+    """
+    Returns an instance of the engine configured in ULTIMATETHUMB_ENGINE.
+    """
+    return import_string(
+        getattr(settings, 'ULTIMATETHUMB_ENGINE', 'ultimatethumb.engines.GraphicsmagickEngine')
+    )()
+
+
+class BaseEngine(object):
+    """
+    Engines render the thumbnail image for a given thumbnail and factor to an
+    output file. The output format is derived from the output file extension.
+
+    Engines which quantize PNG thumbnails (the pngquant option) themselves set
+    quantize_png, pngquant is called for the other engines.
+
+    output_formats are the formats (file extensions) the engine can write, see
+    supports_format.
+    """
+
+    quantize_png = False
+    output_formats = ()
+
+    def supports_format(self, image_format):
+        """
+        Checks if the engine can write the given format (a file extension).
+        """
+        return image_format.lower() in self.output_formats
+
+    def generate(self, thumbnail, factor, outfile):
+        raise NotImplementedError
+
+    def generate_many(self, items):
+        """
+        Generates a list of (thumbnail, factor, outfile) tuples. Engines might
+        override this to share work between thumbnails of the same source.
+        """
+        for thumbnail, factor, outfile in items:
+            self.generate(thumbnail, factor, outfile)
+
+    async def agenerate_many(self, items):
+        """
+        Async version of generate_many, used by the AsyncThumbnailView. Runs
+        generate_many in a thread unless the engine has a native implementation.
+        """
+        await run_in_thread(self.generate_many, items)
+
+
+class GraphicsmagickEngine(BaseEngine):
+    """
+    Engine to generate the thumbnail using gm (Graphicsmagick).
+
+    Multiple thumbnails are generated using one gm batch process. Graphicsmagick
+    doesn't support cloning the decoded image like ImageMagick does, therefore
+    every convert command still decodes the source.
+
+    Graphicsmagick can't write AVIF, WebP requires gm built with libwebp.
+    """
+
+    output_formats = ('jpg', 'jpeg', 'png', 'gif', 'ico', 'webp')
+
+    def get_command(self, thumbnail, factor, outfile):
+        return GraphicsmagickCommand(
+            infile=get_source_path(thumbnail.source),
+            outfile=outfile,
+            options=thumbnail.get_gm_options(factor),
+        )
+
+    def get_resizer(self, items):
+        """
+        Returns the command to generate the (thumbnail, factor, outfile) items,
+        a gm batch command for multiple items.
+        """
+        if len(items) == 1:
+            return self.get_command(*items[0])
+
+        return GraphicsmagickBatchCommand(commands=[self.get_command(*item) for item in items])
+
+    def generate(self, thumbnail, factor, outfile):
+        resizer = self.get_command(thumbnail, factor, outfile)
+        assert resizer.execute(fail_silently=True)
+
+    def generate_many(self, items):
+        if len(items) < 2:
+            return super().generate_many(items)
+
+        assert self.get_resizer(items).execute(fail_silently=True)
+
+    async def agenerate_many(self, items):
+        """
+        Runs gm as subprocess of the event loop. Building the commands might
+        fetch remote sources and runs in a thread.
+        """
+        if not items:
+            return
+
+        resizer = await run_in_thread(self.get_resizer, items)
+        assert await resizer.aexecute(fail_silently=True)
+
+
+class PillowEngine(BaseEngine):
+    """
+    Engine to generate the thumbnail in-process using Pillow.
+
+    The results are equivalent to the gm based engine: resizing respects the "^"
+    (fill) and ">" (shrink only) modes, cropping uses the gravity and any
+    metadata like icc profiles is stripped. JPEG sources are decoded at a reduced
+    scale if possible and large downscales are reduced before resampling. PNG
+    thumbnails are quantized in-process (using libimagequant if available) unless
+    ULTIMATETHUMB_PNGQUANT_EXTERNAL is set.
+
+    Animated images are passed to the GraphicsmagickEngine.
+    """
+
+    fallback_engine_class = GraphicsmagickEngine
+
+    def supports_format(self, image_format):
+        """
+        Checks if Pillow has an encoder for the format, e.g. AVIF requires
+        Pillow 11.2 or newer built with libavif.
+        """
+        return get_pillow_format(image_format) is not None
+
+    @property
+    def quantize_png(self):
+        return not getattr(settings, 'ULTIMATETHUMB_PNGQUANT_EXTERNAL', False)
+
+    def generate(self, thumbnail, factor, outfile):
+        self.generate_many([(thumbnail, factor, outfile)])
+
+    def generate_many(self, items):
+        """
+        Generates the thumbnails, every source is only decoded once.
+        """
+        items_by_source = {}
+        for item in items:
+            items_by_source.setdefault(item[0].source, []).append(item)
+
+        for source, source_items in items_by_source.items():
+            self.generate_source(source, source_items)
+
+    def generate_source(self, source, items):
+        """
+        Decodes the source once and generates all thumbnails from it.
+        """
+        with PILImage.open(get_source_path(source)) as image:
+            if getattr(image, 'is_animated', False):
+                return self.fallback_engine_class().generate_many(items)
+
+            resize_sizes = []
+            for thumbnail, factor, outfile in items:
+                options = thumbnail.get_resize_options(factor)
+                resize_sizes.append(
+                    self.get_resize_size(image.size, options['size'], options['mode'])
+                )
+
+            # Decode the image at the smallest scale which is large enough for all sizes.
+            draft_size = (max(s[0] for s in resize_sizes), max(s[1] for s in resize_sizes))
+            if draft_size[0] < image.size[0] and draft_size[1] < image.size[1]:
+                image.draft(image.mode, draft_size)
+
+            with metrics.timer('ultimatethumb_stage_seconds', stage='decode'):
+                image = self.prepare(image)
+
+        for (thumbnail, factor, outfile), resize_size in zip(items, resize_sizes):
+            options = thumbnail.get_resize_options(factor)
+            with metrics.timer('ultimatethumb_stage_seconds', stage='resize'):
+                thumbnail_image = self.resize(image, resize_size)
+
+                if options['gravity']:
+                    thumbnail_image = self.crop(
+                        thumbnail_image, options['size'], options['gravity']
+                    )
+
+            if (
+                self.quantize_png
+                and thumbnail.options['pngquant']
+                and os.path.splitext(outfile)[1].lower() == '.png'
+            ):
+                with metrics.timer('ultimatethumb_stage_seconds', stage='optimize'):
+                    thumbnail_image = self.quantize(
+                        thumbnail_image, thumbnail.options['pngquant']
+                    )
+
+            with metrics.timer('ultimatethumb_stage_seconds', stage='encode'):
+                self.save(
+                    thumbnail_image,
+                    outfile,
+                    options['quality'],
+                    thumbnail.get_encoder_options(),
+                )
+
+    def get_resize_size(self, source_size, size, mode):
+        """
+        Calculates the image size after resizing, size might contain 0 to
+        calculate the dimension based on the aspect ratio.
+        """
+        width_scale = float(size[0]) / source_size[0]
+        height_scale = float(size[1]) / source_size[1]
+
+        if not size[0] or not size[1]:
+            scale = width_scale or height_scale
+        elif mode == '^':
+            scale = max(width_scale, height_scale)
+        else:
+            scale = min(width_scale, height_scale)
+
+        if not scale or (mode == '>' and scale >= 1):
+            return source_size
+
+        return (
+            max(1, int(round(source_size[0] * scale))),
+            max(1, int(round(source_size[1] * scale))),
+        )
+
+    def prepare(self, image):
+        """
+        Loads the image and converts it to a mode which supports resampling.
+        """
+        image.load()
+
+        if image.mode in ('1', 'P', 'I', 'I;16', 'F'):
+            has_alpha = image.mode == 'P' and 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+
+        # Drop any metadata (icc profiles, exif, ...) from the resulting image.
+        image.info = {}
+        return image
+
+    def resize(self, image, size):
+        """
+        Resizes the image, reduces the image by an integer factor first if the
+        image is much larger than the requested size.
+        """
+        if image.size == size:
+            return image
+
+        reduce_factor = int(min(image.size[0] / size[0], image.size[1] / size[1]) / 2)
+        if reduce_factor >= 2:
+            image = image.reduce(reduce_factor)
+
+        return image.resize(size, PILImage.LANCZOS)
+
+    def crop(self, image, size, gravity):
+        """
+        Crops the image to the requested size using the gravity.
+        """
+        width = min(size[0] or image.size[0], image.size[0])
+        height = min(size[1] or image.size[1], image.size[1])
+        if (width, height) == image.size:
+            return image
+
+        offset_x, offset_y = GRAVITY_OFFSETS[gravity]
+        left = int(round((image.size[0] - width) * offset_x))
+        top = int(round((image.size[1] - height) * offset_y))
+
+        return image.crop((left, top, left + width, top + height))
+
+    def quantize(self, image, quality):
+        """
+        Reduces the image to a palette like pngquant does, quality is the value of
+        the pngquant option. Images which are not RGB(A) are returned unchanged.
+        """
+        if image.mode not in ('RGB', 'RGBA'):
+            return image
+
+        if features.check_feature('libimagequant'):
+            method = QUANTIZE_LIBIMAGEQUANT
+        elif image.mode == 'RGBA':
+            # Median cut doesn't support alpha channels.
+            method = QUANTIZE_FASTOCTREE
+        else:
+            method = QUANTIZE_MEDIANCUT
+
+        return image.quantize(colors=get_quantize_colors(quality), method=method)
+
+    def save(self, image, outfile, quality, encoder_options=None):
+        """
+        Saves the image, the format is based on the file extension. The encoder
+        options are the settings of the encoder profile, metadata is always
+        stripped (see prepare).
+        """
+        extension = os.path.splitext(outfile)[1].lower()
+        image_format = get_pillow_format(extension[1:])
+        if image_format is None:
+            raise ValueError('Pillow has no encoder for {0} files'.format(extension))
+        encoder_options = encoder_options or {}
+
+        save_options = {}
+        if image_format == 'JPEG':
+            if image.mode not in ('RGB', 'L', 'CMYK'):
+                image = image.convert('RGB')
+            save_options['quality'] = quality
+            save_options['progressive'] = encoder_options.get('progressive', False)
+            save_options['optimize'] = encoder_options.get('optimize', False)
+            if encoder_options.get('subsampling'):
+                save_options['subsampling'] = encoder_options['subsampling']
+        elif image_format == 'PNG':
+            # Graphicsmagick uses the tens of the quality as zlib compression level.
+            save_options['compress_level'] = min(9, quality // 10)
+            save_options['optimize'] = encoder_options.get('optimize', False)
+        elif image_format == 'ICO':
+            save_options['sizes'] = [image.size]
+        elif image_format in ('WEBP', 'AVIF'):
+            save_options['quality'] = quality
+
+        image.save(outfile, image_format, **save_options)
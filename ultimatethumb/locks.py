@@ -0,0 +1,472 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+from .storage import is_local_storage, thumbnail_storage
+from .utils import get_cache_key, run_in_thread
+
+logger = logging.getLogger(__name__)
+
+# Semaphores of the running event loops, see get_generation_semaphore.
+generation_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_generation_lock(thumb_name):
+    """
+    Returns an instance of the lock configured in ULTIMATETHUMB_GENERATION_LOCK
+    for the given thumbnail storage name. Defaults to the FileLock for local
+    storages and the CacheLock for remote storages.
+    """
+    lock_class = getattr(settings, 'ULTIMATETHUMB_GENERATION_LOCK', None)
+    if lock_class is None:
+        lock_class = (
+            'ultimatethumb.locks.FileLock'
+            if is_local_storage()
+            else 'ultimatethumb.locks.CacheLock'
+        )
+
+    return import_string(lock_class)(
+        thumb_name, timeout=getattr(settings, 'ULTIMATETHUMB_GENERATION_LOCK_TIMEOUT', 30)
+    )
+
+
+def lock_file(fd, blocking=True):
+    """
+    Locks the file exclusively, returns False if the lock is held by someone
+    else and blocking is False. Uses flock directly, the return value of
+    django.core.files.locks.lock differs between Django versions.
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def unlock_file(fd):
+    """
+    Releases the lock of the file.
+    """
+    fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def get_cgroup_cpu_quota(root='/sys/fs/cgroup'):
+    """
+    Returns the CPU quota of the cgroup (e.g. 1.5 CPUs in a container), None if
+    the CPU usage isn't limited. Supports cgroup v2 and v1.
+    """
+    try:
+        with open(os.path.join(root, 'cpu.max')) as cpu_max:
+            quota, period = cpu_max.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open(os.path.join(root, 'cpu', 'cpu.cfs_quota_us')) as quota_file, open(
+                os.path.join(root, 'cpu', 'cpu.cfs_period_us')
+            ) as period_file:
+                quota, period = quota_file.read().strip(), period_file.read().strip()
+        except OSError:
+            return None
+
+    if quota in ('max', '-1'):
+        return None
+
+    try:
+        return int(quota) / int(period)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def get_available_cpus():
+    """
+    Returns the number of CPUs the process can use, respecting the CPU affinity
+    and the CPU quota of the cgroup (see get_cgroup_cpu_quota).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = get_cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+
+    return max(1, cpus)
+
+
+def get_generation_limiter():
+    """
+    Returns the GenerationLimiter for the view. Admission control is disabled
+    (the limiter admits every generation) unless ULTIMATETHUMB_ADMISSION_CONTROL
+    is enabled.
+    """
+    if not getattr(settings, 'ULTIMATETHUMB_ADMISSION_CONTROL', False):
+        return GenerationLimiter(slots=None)
+
+    slots = getattr(settings, 'ULTIMATETHUMB_GENERATION_SLOTS', None) or get_available_cpus()
+    return GenerationLimiter(
+        slots=slots,
+        global_slots=getattr(settings, 'ULTIMATETHUMB_GLOBAL_GENERATION_SLOTS', None),
+        queue_size=getattr(settings, 'ULTIMATETHUMB_GENERATION_QUEUE_SIZE', slots),
+        queue_timeout=getattr(settings, 'ULTIMATETHUMB_GENERATION_QUEUE_TIMEOUT', 5),
+        lease_timeout=getattr(settings, 'ULTIMATETHUMB_GENERATION_LOCK_TIMEOUT', 30),
+    )
+
+
+def get_slots_root():
+    """
+    Returns the directory of the generation slots (see SlotLock). Defaults to a
+    directory per project (thumbnail root) and user in the temporary directory
+    of the host.
+    """
+    root = getattr(settings, 'ULTIMATETHUMB_GENERATION_SLOTS_ROOT', None)
+    if root is None:
+        project = '{0}:{1}'.format(os.getuid(), getattr(settings, 'ULTIMATETHUMB_ROOT', ''))
+        root = os.path.join(
+            tempfile.gettempdir(),
+            'ultimatethumb-slots-{0}'.format(hashlib.sha1(project.encode()).hexdigest()[:12]),
+        )
+
+    return root
+
+
+def get_generation_semaphore():
+    """
+    Returns the semaphore limiting the concurrent generations of the async view
+    in the running event loop to ULTIMATETHUMB_ASYNC_GENERATION_CONCURRENCY,
+    defaults to the number of available CPUs.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = generation_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(
+            getattr(settings, 'ULTIMATETHUMB_ASYNC_GENERATION_CONCURRENCY', None)
+            or get_available_cpus()
+        )
+        generation_semaphores[loop] = semaphore
+
+    return semaphore
+
+
+class BaseLock(object):
+    """
+    Locks make sure only one process generates a thumbnail at a time. Blocking
+    acquires poll the lock until it is free or the timeout is reached.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, thumb_name, timeout=30):
+        self.thumb_name = thumb_name
+        self.timeout = timeout
+        self.locked = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self, blocking=True):
+        """
+        Acquires the lock, returns False if the lock is held by someone else
+        (after waiting up to timeout seconds if blocking).
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self.locked = self.try_acquire()
+            if self.locked or not blocking or time.monotonic() >= deadline:
+                return self.locked
+
+            time.sleep(self.poll_interval)
+
+    async def aacquire(self, blocking=True):
+        """
+        Async version of acquire, waiting doesn't block the event loop.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self.locked = await run_in_thread(self.try_acquire)
+            if self.locked or not blocking or time.monotonic() >= deadline:
+                return self.locked
+
+            await asyncio.sleep(self.poll_interval)
+
+    def release(self):
+        """
+        Releases the lock if it was acquired.
+        """
+        if self.locked:
+            self.do_release()
+            self.locked = False
+
+    async def arelease(self):
+        """
+        Async version of release.
+        """
+        await run_in_thread(self.release)
+
+    def try_acquire(self):
+        raise NotImplementedError
+
+    def do_release(self):
+        raise NotImplementedError
+
+
+class DummyLock(BaseLock):
+    """
+    Lock which is always acquired, disables single-flight generation.
+    """
+
+    def try_acquire(self):
+        return True
+
+    def do_release(self):
+        pass
+
+
+class FileLock(BaseLock):
+    """
+    Lock using a lock file next to the thumbnail in the (local) thumbnail
+    storage. Works across processes on one host (or on a shared file system
+    supporting locks). Locks are released by the os if the process dies.
+
+    The lock file is removed on release. A lock acquired on a file which was
+    removed in the meantime doesn't count, the file is opened again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fd = None
+
+    def get_lock_path(self):
+        dirname, filename = os.path.split(thumbnail_storage.path(self.thumb_name))
+        return os.path.join(dirname, '.{0}.lock'.format(filename))
+
+    def try_acquire(self):
+        lock_path = self.get_lock_path()
+        while True:
+            if self.fd is None:
+                os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+                self.fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            if not lock_file(self.fd, blocking=False):
+                return False
+
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(self.fd).st_ino:
+                    return True
+            except FileNotFoundError:
+                pass
+
+            # The previous holder removed the file, lock the new one.
+            unlock_file(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def do_release(self):
+        try:
+            os.remove(self.get_lock_path())
+        except FileNotFoundError:
+            pass
+        unlock_file(self.fd)
+
+    def release(self):
+        super().release()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CacheLock(BaseLock):
+    """
+    Lock using a lease in the Django cache (cache.add), works across hosts if
+    the cache is shared. The lease expires after the timeout if the holder dies.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_key = get_cache_key('lock:{0}'.format(self.thumb_name))
+        self.token = uuid.uuid4().hex
+
+    def try_acquire(self):
+        return cache.add(self.cache_key, self.token, self.timeout)
+
+    def do_release(self):
+        # Don't remove the lease of someone else if ours expired already.
+        if cache.get(self.cache_key) == self.token:
+            cache.delete(self.cache_key)
+
+
+class SlotLock(FileLock):
+    """
+    Lock file in ULTIMATETHUMB_GENERATION_SLOTS_ROOT, used for the generation
+    slots of the host (see GenerationLimiter). Slots which can't be opened count
+    as taken.
+    """
+
+    def get_lock_path(self):
+        return os.path.join(get_slots_root(), '{0}.lock'.format(self.thumb_name))
+
+    def try_acquire(self):
+        try:
+            return super().try_acquire()
+        except OSError:
+            logger.warning('Unable to open generation slot %s', self.thumb_name, exc_info=True)
+            return False
+
+
+class GenerationRejected(Exception):
+    """
+    Raised if a GenerationLimiter has no free slot for a generation.
+    """
+
+
+class GenerationLimiter(object):
+    """
+    Admission control for generating thumbnails in the view. A generation needs
+    one of the slots of the host (lock files, see SlotLock) and, if global_slots
+    is set, one of the global slots (leases in the shared cache, see CacheLock).
+
+    If all slots are taken, up to queue_size requests per host wait up to
+    queue_timeout seconds for a free slot, other requests are rejected. The
+    limiter admits every generation if slots is None.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(
+        self, slots, global_slots=None, queue_size=0, queue_timeout=5, lease_timeout=30
+    ):
+        self.slots = slots
+        self.global_slots = global_slots
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.lease_timeout = lease_timeout
+        self.locks = []
+
+    def acquire(self):
+        """
+        Acquires the slots, returns False if the generation is rejected.
+        """
+        if self.slots is None:
+            return True
+
+        if self.try_acquire():
+            metrics.increment('ultimatethumb_admissions_total', result='admitted')
+            return True
+
+        queue_lock = self.acquire_any(SlotLock, 'queue', self.queue_size)
+        if queue_lock is None:
+            metrics.increment('ultimatethumb_admissions_total', result='rejected')
+            return False
+
+        try:
+            with metrics.timer('ultimatethumb_stage_seconds', stage='queue'):
+                deadline = time.monotonic() + self.queue_timeout
+                while time.monotonic() < deadline:
+                    time.sleep(self.poll_interval)
+                    if self.try_acquire():
+                        break
+        finally:
+            queue_lock.release()
+
+        return self.admit_queued()
+
+    async def aacquire(self):
+        """
+        Async version of acquire, waiting doesn't block the event loop.
+        """
+        if self.slots is None:
+            return True
+
+        if await run_in_thread(self.try_acquire):
+            metrics.increment('ultimatethumb_admissions_total', result='admitted')
+            return True
+
+        queue_lock = await run_in_thread(self.acquire_any, SlotLock, 'queue', self.queue_size)
+        if queue_lock is None:
+            metrics.increment('ultimatethumb_admissions_total', result='rejected')
+            return False
+
+        try:
+            with metrics.timer('ultimatethumb_stage_seconds', stage='queue'):
+                deadline = time.monotonic() + self.queue_timeout
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(self.poll_interval)
+                    if await run_in_thread(self.try_acquire):
+                        break
+        finally:
+            await run_in_thread(queue_lock.release)
+
+        return self.admit_queued()
+
+    def admit_queued(self):
+        """
+        Counts the result of waiting in the queue.
+        """
+        admitted = bool(self.locks)
+        metrics.increment(
+            'ultimatethumb_admissions_total', result='queued' if admitted else 'timeout'
+        )
+        return admitted
+
+    def release(self):
+        """
+        Releases the acquired slots.
+        """
+        for lock in self.locks:
+            lock.release()
+        self.locks = []
+
+    async def arelease(self):
+        """
+        Async version of release.
+        """
+        if self.locks:
+            await run_in_thread(self.release)
+
+    def try_acquire(self):
+        """
+        Acquires a slot of the host and a global slot (if configured) without
+        waiting. Returns False if no slot is free.
+        """
+        slot = self.acquire_any(SlotLock, 'slot', self.slots)
+        if slot is None:
+            return False
+
+        if self.global_slots:
+            global_slot = self.acquire_any(CacheLock, 'global-slot', self.global_slots)
+            if global_slot is None:
+                slot.release()
+                return False
+            self.locks.append(global_slot)
+
+        self.locks.append(slot)
+        return True
+
+    def acquire_any(self, lock_class, name, count):
+        """
+        Acquires the first free of count locks, returns None if all are taken.
+        """
+        for index in range(count or 0):
+            lock = lock_class('{0}-{1}'.format(name, index), timeout=self.lease_timeout)
+            if lock.acquire(blocking=False):
+                return lock
+
+            # Closes the lock file.
+            lock.release()
+
+        return None
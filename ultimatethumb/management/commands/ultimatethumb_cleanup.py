@@ -0,0 +1,74 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
+
+from ...cleanup import ThumbnailCleanup
+
+SIZE_RE = re.compile(r'^(\d+)([kmgt]?)b?$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
+
+def parse_size(value):
+    """
+    Parses a size in bytes, understands suffixes like "500M" or "10G".
+    """
+    match = SIZE_RE.match(value.strip())
+    if not match:
+        raise ValueError('{0} is not a valid size'.format(value))
+
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).lower()]
+
+
+class Command(BaseCommand):
+    help = (
+        'Removes the least recently accessed thumbnails until the thumbnails fit '
+        'into the size and file budget. Orphaned base64 files are removed too.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-size',
+            help='Size budget, e.g. "10G". Defaults to ULTIMATETHUMB_CLEANUP_MAX_SIZE.',
+        )
+        parser.add_argument(
+            '--max-files',
+            type=int,
+            help='File budget. Defaults to ULTIMATETHUMB_CLEANUP_MAX_FILES.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Only report what would be removed.',
+        )
+
+    def handle(self, *args, **options):
+        max_size = options['max_size']
+        if max_size is not None:
+            try:
+                max_size = parse_size(max_size)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        stats = ThumbnailCleanup(
+            max_size=max_size, max_files=options['max_files'], dry_run=options['dry_run']
+        ).run()
+
+        self.stdout.write(
+            'Found {thumbnails} thumbnails ({files} files, {size}).'.format(
+                thumbnails=stats['thumbnails'],
+                files=stats['files'],
+                size=filesizeformat(stats['size']),
+            )
+        )
+        self.stdout.write(
+            '{action} {removed_thumbnails} thumbnails ({removed_files} files, '
+            '{removed_size}) and {orphans} orphaned files.'.format(
+                action='Would remove' if options['dry_run'] else 'Removed',
+                removed_thumbnails=stats['removed_thumbnails'],
+                removed_files=stats['removed_files'],
+                removed_size=filesizeformat(stats['removed_size']),
+                orphans=stats['orphans'],
+            )
+        )
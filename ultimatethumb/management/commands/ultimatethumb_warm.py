@@ -0,0 +1,254 @@
+import glob
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from fnmatch import fnmatch
+
+from django.contrib.staticfiles.finders import get_finders
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ...templatetags.ultimatethumb_tags import VALID_IMAGE_FILE_EXTENSIONS
+from ...thumbnail import ThumbnailSet, generate_thumbnails
+from ...utils import build_thumbnail_options, parse_sizes, parse_source
+
+
+def init_worker():
+    """
+    Makes sure Django is set up in worker processes which are not forked.
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def warm_source(source, sizes, options):
+    """
+    Generates the missing thumbnails of a source, returns a tuple with the
+    number of generated and existing thumbnails.
+    """
+    thumbnail_set = ThumbnailSet(source, sizes, options)
+    total = sum(len(thumbnail.get_factors()) for thumbnail in thumbnail_set.thumbnails)
+
+    items = thumbnail_set.get_missing()
+    if items:
+        generate_thumbnails(items)
+
+    return len(items), total - len(items)
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates the thumbnails (including the retina versions) for the given '
+        'sources. Sources are media names, absolute paths or static names prefixed '
+        'with "static:", all of them may contain glob patterns.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='*', help='Sources or glob patterns.')
+        parser.add_argument(
+            '--file-list', help='File containing one source (or pattern) per line.'
+        )
+        parser.add_argument(
+            '--sizes', required=True, help='Sizes to generate, e.g. "100x0,200x0".'
+        )
+        parser.add_argument('--upscale', action='store_true', default=False)
+        parser.add_argument('--crop', nargs='?', const=True, default=None)
+        parser.add_argument('--no-retina', action='store_false', dest='retina', default=True)
+        parser.add_argument('--quality', type=int, default=None)
+        parser.add_argument(
+            '--pngquant', default=None, help='pngquant quality, e.g. "80" or "60-80".'
+        )
+        parser.add_argument('--profile', default=None, help='Encoder profile, e.g. "web".')
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of worker processes, 1 generates in the current process.',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='File to record finished sources to, sources listed are skipped.',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+
+        try:
+            parse_sizes(options['sizes'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        self.sizes = options['sizes']
+        self.thumbnail_options = build_thumbnail_options(
+            upscale=options['upscale'],
+            crop=options['crop'],
+            retina=options['retina'],
+            quality=options['quality'],
+            pngquant=options['pngquant'],
+            profile=options['profile'],
+        )
+
+        patterns = list(options['sources'])
+        if options['file_list']:
+            with open(options['file_list']) as file_list:
+                patterns.extend(line.strip() for line in file_list if line.strip())
+
+        if not patterns:
+            raise CommandError('No sources given.')
+
+        done = self.read_checkpoint(options['checkpoint'])
+        sources = [source for source in self.get_sources(patterns) if source not in done]
+
+        checkpoint = open(options['checkpoint'], 'a') if options['checkpoint'] else None
+        if checkpoint and not done:
+            checkpoint.write('# {0}\n'.format(self.get_checkpoint_key()))
+
+        self.stats = {'sources': 0, 'generated': 0, 'existing': 0, 'errors': 0}
+        self.total = len(sources)
+        self.start = time.monotonic()
+
+        try:
+            for source, result, error in self.warm(sources, options['processes']):
+                self.handle_result(source, result, error)
+                if checkpoint and not error:
+                    checkpoint.write('{0}\n'.format(source))
+                    checkpoint.flush()
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+        duration = time.monotonic() - self.start
+        self.stdout.write(
+            'Warmed {sources} sources in {duration:.1f}s: {generated} generated, '
+            '{existing} existing, {errors} errors ({rate:.1f} thumbnails/s)'.format(
+                duration=duration,
+                rate=self.stats['generated'] / duration if duration else 0,
+                **self.stats
+            )
+        )
+
+    def get_checkpoint_key(self):
+        return json.dumps([self.sizes, self.thumbnail_options], sort_keys=True)
+
+    def read_checkpoint(self, path):
+        """
+        Returns the set of sources finished in a previous run.
+        """
+        if not path or not os.path.exists(path):
+            return set()
+
+        with open(path) as checkpoint:
+            lines = checkpoint.read().splitlines()
+
+        if lines and lines[0] != '# {0}'.format(self.get_checkpoint_key()):
+            raise CommandError(
+                'Checkpoint {0} was written using other sizes or options.'.format(path)
+            )
+
+        return set(lines[1:])
+
+    def get_sources(self, patterns):
+        """
+        Resolves the patterns to a sorted list of source paths of supported images.
+        """
+        sources = set()
+        for pattern in patterns:
+            if pattern.startswith('static:'):
+                sources.update(
+                    parse_source('static:{0}'.format(path))
+                    for path in self.find_static(pattern[7:])
+                )
+            else:
+                if not pattern.startswith('/'):
+                    pattern = default_storage.path(pattern)
+                sources.update(glob.glob(pattern, recursive=True))
+
+        return sorted(
+            source
+            for source in sources
+            if os.path.splitext(source)[1].lower().lstrip('.') in VALID_IMAGE_FILE_EXTENSIONS
+            and os.path.isfile(source)
+        )
+
+    def find_static(self, pattern):
+        paths = set()
+        for finder in get_finders():
+            for path, storage in finder.list([]):
+                if fnmatch(path, pattern):
+                    paths.add(path)
+
+        return sorted(paths)
+
+    def warm(self, sources, processes):
+        """
+        Warms the sources, yields (source, result, error) tuples once finished.
+        """
+        if processes <= 1:
+            for source in sources:
+                yield self.warm_source(source)
+            return
+
+        # Forked workers must not share the database connections of this process.
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker) as executor:
+            sources = iter(sources)
+            pending = {}
+            while True:
+                # Keep a bounded number of sources in flight.
+                for source in sources:
+                    future = executor.submit(
+                        warm_source, source, self.sizes, self.thumbnail_options
+                    )
+                    pending[future] = source
+                    if len(pending) >= processes * 2:
+                        break
+
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    source = pending.pop(future)
+                    try:
+                        yield source, future.result(), None
+                    except Exception as exc:
+                        yield source, None, exc
+
+    def warm_source(self, source):
+        try:
+            return source, warm_source(source, self.sizes, self.thumbnail_options), None
+        except Exception as exc:
+            return source, None, exc
+
+    def handle_result(self, source, result, error):
+        self.stats['sources'] += 1
+
+        if error:
+            self.stats['errors'] += 1
+            self.stderr.write('Failed to warm {0}: {1!r}'.format(source, error))
+            return
+
+        self.stats['generated'] += result[0]
+        self.stats['existing'] += result[1]
+
+        if self.verbosity >= 2:
+            self.stdout.write(
+                '[{0}/{1}] {2}: {3} generated, {4} existing'.format(
+                    self.stats['sources'], self.total, source, *result
+                )
+            )
+        elif self.verbosity >= 1 and self.stats['sources'] % 100 == 0:
+            duration = time.monotonic() - self.start
+            self.stdout.write(
+                '[{0}/{1}] {2:.1f} thumbnails/s'.format(
+                    self.stats['sources'],
+                    self.total,
+                    self.stats['generated'] / duration if duration else 0,
+                )
+            )
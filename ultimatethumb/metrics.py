@@ -0,0 +1,175 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.functional import LazyObject
+from django.utils.module_loading import import_string
+
+# Durations of the stages timed in the current request, see collect_timings.
+current_timings = contextvars.ContextVar('ultimatethumb_timings', default=None)
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects the durations of all stages timed (using a timer with a stage label)
+    in the block, independent of the metrics backend. Yields a list of (stage,
+    duration in seconds) tuples in the order the stages finished.
+    """
+    timings = []
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+def format_labels(labels):
+    """
+    Formats the labels (a tuple of name and value pairs) for the text exposition
+    format, e.g. '{stage="engine"}'.
+    """
+    if not labels:
+        return ''
+
+    return '{{{0}}}'.format(
+        ','.join(
+            '{0}="{1}"'.format(
+                name,
+                str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+            )
+            for name, value in labels
+        )
+    )
+
+
+class NullMetrics(object):
+    """
+    Metrics backends record counters and observations (durations in seconds or
+    sizes in bytes), labels are passed as keyword arguments.
+
+    This backend discards all metrics, subclass it to forward the metrics to
+    e.g. statsd or a Prometheus client.
+    """
+
+    @property
+    def enabled(self):
+        """
+        Checks if the metrics are recorded, every subclass counts as enabled.
+        Allows skipping work which is only needed for metrics.
+        """
+        return type(self) is not NullMetrics
+
+    def increment(self, name, value=1, **labels):
+        """
+        Increments the counter with the given name and labels.
+        """
+        pass
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value (e.g. a duration) for the summary with the given name and labels.
+        """
+        pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the duration of the block in seconds, failures are timed too.
+        Stages (the stage label) are also added to the collected timings.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(name, duration, **labels)
+
+            timings = current_timings.get()
+            if timings is not None and 'stage' in labels:
+                timings.append((labels['stage'], duration))
+
+
+class MemoryMetrics(NullMetrics):
+    """
+    Aggregates the metrics in-process: counters are summed up, observations are
+    kept as count and sum. The metrics are rendered in the Prometheus text
+    exposition format, see ultimatethumb.views.MetricsView.
+
+    Every process has its own metrics, scrape every process or aggregate them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.summaries = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total = self.summaries.get(key, (0, 0))
+            self.summaries[key] = (count + 1, total + value)
+
+    def get_counter(self, name, **labels):
+        """
+        Returns the value of a counter, 0 if nothing was recorded.
+        """
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_summary(self, name, **labels):
+        """
+        Returns the count and sum of a summary, (0, 0) if nothing was recorded.
+        """
+        return self.summaries.get((name, tuple(sorted(labels.items()))), (0, 0))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.summaries.clear()
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            summaries = sorted(self.summaries.items())
+
+        lines = []
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append('# TYPE {0} counter'.format(name))
+                last_name = name
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+
+        for (name, labels), (count, total) in summaries:
+            if name != last_name:
+                lines.append('# TYPE {0} summary'.format(name))
+                last_name = name
+            lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), count))
+            lines.append('{0}_sum{1} {2!r}'.format(name, format_labels(labels), float(total)))
+
+        return ''.join('{0}\n'.format(line) for line in lines)
+
+
+class Metrics(LazyObject):
+    """
+    Lazy class to defer the initialization of the metrics backend to give
+    settings a chance to override the used backend.
+    """
+
+    def _setup(self):
+        self._wrapped = import_string(
+            getattr(settings, 'ULTIMATETHUMB_METRICS', 'ultimatethumb.metrics.NullMetrics')
+        )()
+
+
+metrics = Metrics()
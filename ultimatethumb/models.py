@@ -0,0 +1,19 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class ThumbnailSpec(models.Model):
+    """
+    Persisted source and options of a thumbnail, used by the DatabaseRegistry.
+    """
+
+    name = models.CharField(_('Name'), max_length=255, unique=True)
+    data = models.TextField(_('Data'))
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Thumbnail spec')
+        verbose_name_plural = _('Thumbnail specs')
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,216 @@
+import re
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
+from django.utils.http import http_date
+from django.utils.module_loading import import_string
+
+from .storage import thumbnail_storage
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+OFFLOAD_ALIASES = {
+    'accel': 'ultimatethumb.offload.AccelRedirectOffload',
+    'sendfile': 'ultimatethumb.offload.SendfileOffload',
+    'litespeed': 'ultimatethumb.offload.LiteSpeedOffload',
+    'redirect': 'ultimatethumb.offload.RedirectOffload',
+    'inline': 'ultimatethumb.offload.InlineOffload',
+}
+
+
+def get_offload():
+    """
+    Returns an instance of the offload strategy configured in ULTIMATETHUMB_OFFLOAD.
+    The setting accepts the name of a builtin strategy or the path to a class.
+
+    If not set, X-Accel-Redirect is used if ULTIMATETHUMB_USE_X_ACCEL_REDIRECT is
+    enabled (the default if DEBUG is False), the file is served inline otherwise.
+    """
+    offload = getattr(settings, 'ULTIMATETHUMB_OFFLOAD', None)
+    if offload is None:
+        offload = (
+            'accel'
+            if getattr(settings, 'ULTIMATETHUMB_USE_X_ACCEL_REDIRECT', not settings.DEBUG)
+            else 'inline'
+        )
+
+    return import_string(OFFLOAD_ALIASES.get(offload, offload))()
+
+
+def get_byte_range(value, size):
+    """
+    Parses the value of a Range header for a file of the given size. Returns a
+    tuple with the first and last byte position or None if the header is not a
+    single valid byte range. Raises ValueError if the range is not satisfiable.
+    """
+    match = RANGE_RE.match(value.strip()) if value else None
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # Suffix range, the last n bytes.
+        length = int(end)
+        if not length:
+            raise ValueError('Range not satisfiable')
+        return max(0, size - length), size - 1
+
+    start = int(start)
+    if end and int(end) < start:
+        return None
+
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+
+    end = int(end) if end else size - 1
+
+    return start, min(end, size - 1)
+
+
+class FileRange(object):
+    """
+    File like object to stream a part of a file.
+    """
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class BaseOffload(object):
+    """
+    Offload strategies build the response for an existing thumbnail. Most of
+    them hand the file over to the web server or another host to keep the
+    bytes out of the Django workers.
+    """
+
+    def render(self, request, thumbnail, factor, file_stat, mimetype, etag=None):
+        """
+        Returns the response for the thumbnail file, file_stat is the FileStat
+        of the file in the thumbnail storage (the path is None for remote storages).
+        The etag is the ETag the view adds to the response.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class AccelRedirectOffload(BaseOffload):
+    """
+    Lets Nginx serve the thumbnail using the X-Accel-Redirect header. The header
+    contains the path of the thumbnail url, the location has to be internal.
+    """
+
+    header = 'X-Accel-Redirect'
+
+    def render(self, request, thumbnail, factor, file_stat, mimetype, etag=None):
+        response = HttpResponse(content_type=mimetype)
+        response[self.header] = urlparse(thumbnail.get_storage_url(factor)).path
+        response['Content-Length'] = file_stat.size
+        return response
+
+
+class LiteSpeedOffload(AccelRedirectOffload):
+    """
+    Lets LiteSpeed serve the thumbnail using the X-LiteSpeed-Location header.
+    """
+
+    header = 'X-LiteSpeed-Location'
+
+
+class SendfileOffload(BaseOffload):
+    """
+    Lets Apache (mod_xsendfile) and Lighttpd serve the thumbnail using the
+    X-Sendfile header. The header contains the path of the file, therefore
+    only local storages are supported.
+    """
+
+    def render(self, request, thumbnail, factor, file_stat, mimetype, etag=None):
+        if file_stat.path is None:
+            raise ImproperlyConfigured('X-Sendfile requires a local thumbnail storage.')
+
+        response = HttpResponse(content_type=mimetype)
+        response['X-Sendfile'] = file_stat.path
+        return response
+
+
+class RedirectOffload(BaseOffload):
+    """
+    Redirects to the url of the thumbnail in the thumbnail storage, e.g. if
+    the storage is served by a CDN. The thumbnail is generated before.
+    """
+
+    def render(self, request, thumbnail, factor, file_stat, mimetype, etag=None):
+        return HttpResponseRedirect(thumbnail.get_storage_url(factor))
+
+
+class InlineOffload(BaseOffload):
+    """
+    Streams the file (or the requested byte range) from the Django worker.
+    HEAD requests don't open the file at all.
+    """
+
+    def render(self, request, thumbnail, factor, file_stat, mimetype, etag=None):
+        size = file_stat.size
+        last_modified = (
+            http_date(file_stat.modified_time) if file_stat.modified_time is not None else None
+        )
+
+        # A Range header is ignored if the If-Range date (or ETag) doesn't match.
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range in (last_modified, etag):
+            try:
+                byte_range = get_byte_range(request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                response = HttpResponse(status=416, content_type=mimetype)
+                response['Content-Range'] = 'bytes */{0}'.format(size)
+                response['Content-Length'] = 0
+                return response
+
+        content_length = size
+        if byte_range:
+            content_length = byte_range[1] - byte_range[0] + 1
+
+        if request.method == 'HEAD':
+            response = HttpResponse(content_type=mimetype)
+        elif byte_range:
+            response = FileResponse(
+                FileRange(self.open(file_stat), byte_range[0], content_length),
+                content_type=mimetype,
+            )
+        else:
+            response = FileResponse(self.open(file_stat), content_type=mimetype)
+            # Newer Django versions add the filename, thumbnails are served inline.
+            if 'Content-Disposition' in response:
+                del response['Content-Disposition']
+
+        response['Accept-Ranges'] = 'bytes'
+        response['Content-Length'] = content_length
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                byte_range[0], byte_range[1], size
+            )
+
+        return response
+
+    def open(self, file_stat):
+        """
+        Opens the file, remote files are read from the storage.
+        """
+        if file_stat.path is None:
+            return thumbnail_storage.open(file_stat.name, 'rb')
+        return open(file_stat.path, 'rb')
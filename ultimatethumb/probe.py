@@ -0,0 +1,130 @@
+import os
+import struct
+
+# Most headers are tiny, JPEG files might carry some EXIF data in front of the
+# SOF marker. If the SOF marker is not within this range, we give up.
+HEADER_SIZE = 16 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+GIF_SIGNATURES = (b'GIF87a', b'GIF89a')
+
+# All SOFn markers, excluding DHT (0xC4), JPG (0xC8) and DAC (0xCC).
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Markers without a length field.
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
+def read_header(path, length=HEADER_SIZE):
+    """
+    Reads the first bytes of the given file using a single pread call.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, length, 0)
+    finally:
+        os.close(fd)
+
+
+def get_png_size(data):
+    """
+    Reads the size from the IHDR chunk, which is always the first chunk.
+    """
+    if len(data) < 24 or data[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def get_gif_size(data):
+    """
+    Reads the size from the logical screen descriptor.
+    """
+    if len(data) < 10:
+        return None
+    return struct.unpack('<HH', data[6:10])
+
+
+def get_ico_size(data):
+    """
+    Reads the size of the largest icon from the icon directory.
+    Returns None if the largest size is ambiguous, Pillow knows how to deal with it.
+    """
+    if len(data) < 6:
+        return None
+
+    count = struct.unpack('<H', data[4:6])[0]
+    if not count or len(data) < 6 + count * 16:
+        return None
+
+    sizes = set()
+    for offset in range(6, 6 + count * 16, 16):
+        sizes.add((data[offset] or 256, data[offset + 1] or 256))
+
+    largest = max(width * height for width, height in sizes)
+    candidates = [size for size in sizes if size[0] * size[1] == largest]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def get_jpeg_size(data):
+    """
+    Walks the JPEG markers until the first SOFn marker and reads the size from it.
+    """
+    position = 2
+    length = len(data)
+
+    while position < length:
+        if data[position] != 0xFF:
+            return None
+
+        # Skip optional fill bytes.
+        while position < length and data[position] == 0xFF:
+            position += 1
+
+        if position >= length:
+            return None
+
+        marker = data[position]
+        position += 1
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+
+        if marker == 0xDA or position + 2 > length:
+            # Start of scan before any frame header, give up.
+            return None
+
+        segment_length = struct.unpack('>H', data[position : position + 2])[0]
+
+        if marker in JPEG_SOF_MARKERS:
+            if position + 7 > length:
+                return None
+            height, width = struct.unpack('>HH', data[position + 3 : position + 7])
+            return (width, height) if width and height else None
+
+        position += segment_length
+
+    return None
+
+
+def probe_image_size(path):
+    """
+    Returns the image size for the given path by parsing the file header of
+    JPEG, PNG, GIF and ICO files. Returns None if the format is unknown or the
+    header is unusual, callers should fall back to Pillow in this case.
+    """
+    data = read_header(path)
+
+    if data[:8] == PNG_SIGNATURE:
+        return get_png_size(data)
+
+    if data[:6] in GIF_SIGNATURES:
+        return get_gif_size(data)
+
+    if data[:3] == b'\xff\xd8\xff':
+        return get_jpeg_size(data)
+
+    if data[:4] == b'\x00\x00\x01\x00':
+        return get_ico_size(data)
+
+    return None
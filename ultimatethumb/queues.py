@@ -0,0 +1,112 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.utils.functional import LazyObject
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+from .signals import thumbnail_generation_failed
+from .thumbnail import Thumbnail
+
+logger = logging.getLogger(__name__)
+
+
+class BaseQueue(object):
+    """
+    Queues generate the missing thumbnails of a ThumbnailSet in the background,
+    before the browser requests them. Subclasses implement `enqueue` to hand the
+    work to a worker, e.g. a thread pool or a task queue.
+    """
+
+    def enqueue(self, thumbnail_set):
+        """
+        Enqueues the thumbnail set, returns False if the set was not queued.
+        """
+        raise NotImplementedError
+
+    def generate(self, thumbnail_set):
+        """
+        Generates all missing thumbnails of the set. Errors are logged and
+        reported (if generate didn't report them already), the view will try
+        again when the thumbnail is requested.
+        """
+        try:
+            thumbnail_set.generate()
+        except Exception as exc:
+            logger.exception('Generating the thumbnails of %s failed', thumbnail_set.source)
+            if not getattr(exc, 'ultimatethumb_reported', False):
+                metrics.increment('ultimatethumb_generation_failures_total')
+                thumbnail_generation_failed.send(sender=Thumbnail, items=[], exception=exc)
+        finally:
+            # Don't leak database connections opened in worker threads.
+            connections.close_all()
+
+
+class SyncQueue(BaseQueue):
+    """
+    Queue which generates the thumbnails immediately, mostly useful for testing.
+    """
+
+    def enqueue(self, thumbnail_set):
+        thumbnail_set.generate()
+        return True
+
+
+class ThreadPoolQueue(BaseQueue):
+    """
+    Queue using a pool of worker threads inside the application process.
+
+    The number of queued sets is limited by ULTIMATETHUMB_QUEUE_SIZE, sets are
+    dropped if the queue is full or the same set is queued already.
+    """
+
+    def __init__(self):
+        self.max_pending = getattr(settings, 'ULTIMATETHUMB_QUEUE_SIZE', 100)
+        self.executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ULTIMATETHUMB_QUEUE_WORKERS', 2),
+            thread_name_prefix='ultimatethumb',
+        )
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def enqueue(self, thumbnail_set):
+        key = tuple(thumbnail.get_name() for thumbnail in thumbnail_set.thumbnails)
+        if not key:
+            return False
+
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.max_pending:
+                return False
+            self.pending.add(key)
+
+        self.executor.submit(self.run, key, thumbnail_set)
+        return True
+
+    def run(self, key, thumbnail_set):
+        try:
+            self.generate(thumbnail_set)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+class ThumbnailQueue(LazyObject):
+    """
+    Lazy class to defer the initialization of the thumbnail_queue to give
+    settings a chance to override the used queue backend.
+    """
+
+    def _setup(self):
+        self._wrapped = import_string(
+            getattr(
+                settings,
+                'ULTIMATETHUMB_QUEUE',
+                'ultimatethumb.queues.ThreadPoolQueue',
+            )
+        )()
+
+
+thumbnail_queue = ThumbnailQueue()
@@ -0,0 +1,202 @@
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.utils.functional import LazyObject
+from django.utils.module_loading import import_string
+
+from .metrics import metrics
+from .storage import thumbnail_storage
+from .utils import get_cache_key
+
+
+def get_group_cache_key(thumb_name):
+    """
+    Generates the cache key to store the group of a thumbnail name.
+    """
+    return get_cache_key('group:{0}'.format(thumb_name))
+
+
+class CacheRegistry(object):
+    """
+    The registry stores the serialized source and options for a thumbnail name.
+
+    This registry only uses the Django cache. Subclasses implement `load` and
+    `store` to persist the data in a durable backend, the cache is then used as
+    read-through cache in front of the backend. Data is written once and never
+    updated because the thumbnail name is derived from the data.
+    """
+
+    def get(self, thumb_name):
+        """
+        Returns the serialized data for the given name or None if unknown.
+        """
+        cache_key = get_cache_key(thumb_name)
+        with metrics.timer('ultimatethumb_stage_seconds', stage='lookup'):
+            serialized_data = cache.get(cache_key)
+            result = 'cache'
+
+            if not serialized_data:
+                serialized_data = self.load(thumb_name)
+                result = 'backend'
+                if serialized_data:
+                    cache.set(cache_key, serialized_data)
+                else:
+                    result = 'miss'
+
+        metrics.increment('ultimatethumb_registry_lookups_total', result=result)
+        return serialized_data
+
+    def get_many(self, thumb_names):
+        """
+        Returns a dict of the serialized data for all known names.
+        """
+        cache_keys = dict((get_cache_key(thumb_name), thumb_name) for thumb_name in thumb_names)
+        cached = cache.get_many(list(cache_keys.keys()))
+
+        thumb_data = dict((cache_keys[cache_key], data) for cache_key, data in cached.items())
+        for thumb_name in thumb_names:
+            if thumb_name not in thumb_data:
+                serialized_data = self.load(thumb_name)
+                if serialized_data:
+                    cache.set(get_cache_key(thumb_name), serialized_data)
+                    thumb_data[thumb_name] = serialized_data
+
+        return thumb_data
+
+    def get_group(self, thumb_name):
+        """
+        Returns the names registered together with the given name, e.g. all
+        thumbnails of a ThumbnailSet. Groups are only kept in the cache.
+        """
+        return cache.get(get_group_cache_key(thumb_name)) or []
+
+    def register(self, thumb_name, serialized_data):
+        """
+        Stores the serialized data for a single thumbnail name if not yet known.
+        """
+        cache_key = get_cache_key(thumb_name)
+        if cache_key not in cache:
+            self.store({thumb_name: serialized_data})
+            cache.set(cache_key, serialized_data)
+
+    def register_many(self, thumb_data):
+        """
+        Stores the serialized data for a dict of thumbnail names if not yet known.
+        Costs one get_many and at most one set_many cache call. The names are
+        stored as group to find the other thumbnails of the group by name.
+        """
+        if not thumb_data:
+            return
+
+        cache_keys = dict((get_cache_key(thumb_name), thumb_name) for thumb_name in thumb_data)
+        existing = cache.get_many(list(cache_keys.keys()))
+
+        missing = dict(
+            (thumb_name, thumb_data[thumb_name])
+            for cache_key, thumb_name in cache_keys.items()
+            if cache_key not in existing
+        )
+        if missing:
+            self.store(missing)
+
+            cache_data = dict(
+                (get_cache_key(thumb_name), data) for thumb_name, data in missing.items()
+            )
+            if len(thumb_data) > 1:
+                group = list(thumb_data.keys())
+                for thumb_name in missing:
+                    cache_data[get_group_cache_key(thumb_name)] = group
+
+            cache.set_many(cache_data)
+
+    def load(self, thumb_name):
+        """
+        Loads the serialized data from the durable backend, None if not found.
+        """
+        return None
+
+    def store(self, thumb_data):
+        """
+        Stores a dict of thumbnail names and serialized data to the durable backend.
+        """
+        pass
+
+
+class DatabaseRegistry(CacheRegistry):
+    """
+    Registry which persists the thumbnail data in the database.
+    """
+
+    def load(self, thumb_name):
+        from .models import ThumbnailSpec
+
+        spec = ThumbnailSpec.objects.filter(name=thumb_name).only('data').first()
+        return spec.data if spec else None
+
+    def store(self, thumb_data):
+        from .models import ThumbnailSpec
+
+        ThumbnailSpec.objects.bulk_create(
+            [
+                ThumbnailSpec(name=thumb_name, data=serialized_data)
+                for thumb_name, serialized_data in thumb_data.items()
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class SidecarRegistry(CacheRegistry):
+    """
+    Registry which persists the thumbnail data in a small json file next to the
+    thumbnail directory in the thumbnail storage.
+    """
+
+    def get_sidecar_name(self, thumb_name):
+        return '{0}.json'.format(thumb_name.split('/')[0])
+
+    def load(self, thumb_name):
+        sidecar_name = self.get_sidecar_name(thumb_name)
+
+        try:
+            with thumbnail_storage.open(sidecar_name, 'rb') as sidecar_file:
+                sidecar = json.loads(sidecar_file.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+        # The hash is only part of the name, make sure the file name matches too.
+        if sidecar.get('name') != thumb_name:
+            return None
+
+        return sidecar.get('data')
+
+    def store(self, thumb_data):
+        for thumb_name, serialized_data in thumb_data.items():
+            sidecar_name = self.get_sidecar_name(thumb_name)
+            if thumbnail_storage.exists(sidecar_name):
+                continue
+
+            thumbnail_storage.save(
+                sidecar_name,
+                ContentFile(json.dumps({'name': thumb_name, 'data': serialized_data})),
+            )
+
+
+class ThumbnailRegistry(LazyObject):
+    """
+    Lazy class to defer the initialization of the thumbnail_registry to give
+    settings a chance to override the used registry backend.
+    """
+
+    def _setup(self):
+        self._wrapped = import_string(
+            getattr(
+                settings,
+                'ULTIMATETHUMB_REGISTRY',
+                'ultimatethumb.registry.CacheRegistry',
+            )
+        )()
+
+
+thumbnail_registry = ThumbnailRegistry()
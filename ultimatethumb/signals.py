@@ -0,0 +1,11 @@
+from django.dispatch import Signal
+
+# Sent for every generated and stored thumbnail, the sender is the Thumbnail
+# class. Arguments: thumbnail, factor, size (bytes of the thumbnail file).
+thumbnail_generated = Signal()
+
+# Sent if generating thumbnails failed, the exception is raised afterwards. The
+# sender is the Thumbnail class. Arguments: items (list of (thumbnail, factor)
+# tuples, empty if the failure happened before the missing thumbnails were
+# known), exception.
+thumbnail_generation_failed = Signal()
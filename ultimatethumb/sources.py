@@ -0,0 +1,197 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.utils.encoding import force_bytes
+
+from .locks import FileLock
+from .utils import get_cache_key
+
+STORAGE_PREFIX = 'storage:'
+
+
+def get_source_path(source):
+    """
+    Returns the local file system path for a source. Sources in a remote storage
+    (prefixed with "storage:") are fetched to the local source cache.
+    """
+    if source.startswith(STORAGE_PREFIX):
+        return SourceCache().get_path(source[len(STORAGE_PREFIX) :])
+
+    return source
+
+
+class SourceLock(FileLock):
+    """
+    Lock file next to a cached source (given as path), used to fetch a source
+    only once and to not remove a source while it's fetched. The lock file is
+    removed on release, see FileLock.
+    """
+
+    def get_lock_path(self):
+        return '{0}.lock'.format(self.thumb_name)
+
+
+class SourceCache(object):
+    """
+    Bounded local read-through cache for source images in a remote storage.
+
+    Sources are stored using their storage name and modification time as key,
+    a changed source is fetched again. Concurrent fetches of the same source
+    wait for the first one (using a lock file). If the cache grows above
+    ULTIMATETHUMB_SOURCE_CACHE_SIZE bytes, the least recently used sources are
+    removed. Sources used within the last ULTIMATETHUMB_SOURCE_CACHE_GRACE_PERIOD
+    seconds are kept, they might be read right now.
+    """
+
+    def __init__(self, root=None, max_size=None, storage=None, grace_period=None):
+        if root is None:
+            root = getattr(
+                settings,
+                'ULTIMATETHUMB_SOURCE_CACHE_ROOT',
+                os.path.join(tempfile.gettempdir(), 'ultimatethumb-sources'),
+            )
+        if max_size is None:
+            max_size = getattr(settings, 'ULTIMATETHUMB_SOURCE_CACHE_SIZE', 256 * 1024**2)
+        if grace_period is None:
+            grace_period = getattr(settings, 'ULTIMATETHUMB_SOURCE_CACHE_GRACE_PERIOD', 60)
+
+        self.root = root
+        self.max_size = max_size
+        self.grace_period = grace_period
+        self.storage = storage or default_storage
+
+    def get_path(self, name):
+        """
+        Returns the path of the local copy of the source, fetches the source if
+        it is not cached yet.
+        """
+        path = os.path.join(self.root, self.get_key(name))
+
+        if self.touch(path):
+            return path
+
+        # If waiting for someone else times out, fetch the source anyway.
+        with self.get_lock(path):
+            # Someone else might have fetched the source while we waited.
+            if not self.touch(path):
+                self.fetch(name, path)
+                self.evict(keep=path)
+
+        return path
+
+    def get_key(self, name):
+        """
+        Returns the file name in the cache, based on the name and modification time.
+        """
+        return '{0}{1}'.format(
+            hashlib.sha1(
+                force_bytes('{0}:{1}'.format(name, self.get_modified_time(name)))
+            ).hexdigest(),
+            os.path.splitext(name)[1].lower(),
+        )
+
+    def get_modified_time(self, name):
+        """
+        Returns the modification time of the source in the storage. The value is
+        cached for ULTIMATETHUMB_SOURCE_CACHE_TIMEOUT seconds to not ask the
+        storage for every probe.
+        """
+        cache_key = get_cache_key('source:{0}'.format(name))
+        modified_time = cache.get(cache_key)
+        if modified_time is None:
+            try:
+                modified_time = self.storage.get_modified_time(name).timestamp()
+            except NotImplementedError:
+                modified_time = 0
+
+            cache.set(
+                cache_key,
+                modified_time,
+                getattr(settings, 'ULTIMATETHUMB_SOURCE_CACHE_TIMEOUT', 60),
+            )
+
+        return modified_time
+
+    def get_lock(self, path):
+        """
+        Returns the lock of the cached source, see SourceLock.
+        """
+        return SourceLock(
+            path, timeout=getattr(settings, 'ULTIMATETHUMB_GENERATION_LOCK_TIMEOUT', 30)
+        )
+
+    def touch(self, path):
+        """
+        Marks the cached source as recently used, returns False if it's missing.
+        """
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def fetch(self, name, path):
+        """
+        Downloads the source in chunks, the file is moved in place once complete.
+        """
+        tmpfile = tempfile.NamedTemporaryFile(dir=self.root, suffix='.tmp', delete=False)
+        try:
+            with self.storage.open(name, 'rb') as source_file:
+                shutil.copyfileobj(source_file, tmpfile)
+            tmpfile.close()
+            os.replace(tmpfile.name, path)
+        except Exception:
+            tmpfile.close()
+            os.remove(tmpfile.name)
+            raise
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used sources until the cache fits into max_size.
+        Sources used within the grace period are kept.
+        """
+        entries = []
+        total_size = 0
+        with os.scandir(self.root) as scan:
+            for entry in scan:
+                if entry.name.endswith(('.lock', '.tmp')) or not entry.is_file():
+                    continue
+
+                entry_stat = entry.stat()
+                entries.append((entry_stat.st_mtime, entry.path, entry_stat.st_size))
+                total_size += entry_stat.st_size
+
+        unused_since = time.time() - self.grace_period
+        for modified_time, path, size in sorted(entries):
+            if total_size <= self.max_size or modified_time > unused_since:
+                break
+
+            if path != keep and self.remove(path, unused_since):
+                total_size -= size
+
+    def remove(self, path, unused_since):
+        """
+        Removes the cached source while holding its lock. Returns False if the
+        source is locked or was used after unused_since.
+        """
+        lock = self.get_lock(path)
+        try:
+            if not lock.acquire(blocking=False):
+                return False
+
+            try:
+                if os.stat(path).st_mtime > unused_since:
+                    return False
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        finally:
+            lock.release()
+
+        return True
@@ -1,10 +1,17 @@
+import os
+from collections import namedtuple
+
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 from django.utils.functional import LazyObject
 from django.utils.module_loading import import_string
 
-from .utils import get_domain_url
+from .utils import get_cache_key, get_domain_url
+
+FileStat = namedtuple('FileStat', ('name', 'path', 'size', 'modified_time'))
 
 
 class ThumbnailFileSystemStorage(FileSystemStorage):
@@ -49,3 +56,78 @@ class ThumbnailStorage(LazyObject):
 
 
 thumbnail_storage = ThumbnailStorage()
+
+
+def get_local_path(name):
+    """
+    Returns the filesystem path of a file in the thumbnail storage or None if
+    the storage is not a local storage (e.g. an object store).
+    """
+    try:
+        return thumbnail_storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def is_local_storage():
+    """
+    Checks if the thumbnail storage stores the files in the local filesystem.
+    """
+    return get_local_path('') is not None
+
+
+def get_file_stat(name):
+    """
+    Returns a FileStat (path, size and modification time) for a file in the
+    thumbnail storage or None if the file does not exist.
+
+    Local files are checked using one os.stat call. For remote storages, the
+    result of the existence check is cached in the Django cache, thumbnail
+    names never change their content. The modification time is None if the
+    storage doesn't support it.
+    """
+    path = get_local_path(name)
+    if path is not None:
+        try:
+            path_stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return FileStat(name, path, path_stat.st_size, path_stat.st_mtime)
+
+    cache_key = get_cache_key('stat:{0}'.format(name))
+    file_stat = cache.get(cache_key)
+    if file_stat is None:
+        # Missing files are not cached, they are generated right away.
+        if not thumbnail_storage.exists(name):
+            return None
+
+        try:
+            modified_time = thumbnail_storage.get_modified_time(name).timestamp()
+        except NotImplementedError:
+            modified_time = None
+
+        file_stat = (thumbnail_storage.size(name), modified_time)
+        cache.set(
+            cache_key,
+            file_stat,
+            getattr(settings, 'ULTIMATETHUMB_STORAGE_CACHE_TIMEOUT', 60 * 60 * 24),
+        )
+
+    return FileStat(name, None, *file_stat)
+
+
+def save_file(name, tmpfile):
+    """
+    Saves a MoveableNamedTemporaryFile to the thumbnail storage. Local storages
+    move the file, remote storages get an open file to stream it in chunks
+    instead of loading it into memory.
+    """
+    if is_local_storage():
+        return thumbnail_storage.save(name, tmpfile)
+
+    tmpfile.close()
+    try:
+        with open(tmpfile.temporary_file_path(), 'rb') as upload_file:
+            return thumbnail_storage.save(name, File(upload_file, name=name))
+    finally:
+        os.remove(tmpfile.temporary_file_path())
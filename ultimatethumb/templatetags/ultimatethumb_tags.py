@@ -1,9 +1,11 @@
 import os
 
+from django.conf import settings
 from django.template import Library
 
+from ..queues import thumbnail_queue
 from ..thumbnail import ThumbnailSet
-from ..utils import parse_source
+from ..utils import build_thumbnail_options, parse_formats, parse_source
 
 VALID_IMAGE_FILE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'ico')
 
@@ -21,11 +23,14 @@ def ultimatethumb(
     retina=True,
     quality=None,
     pngquant=None,
+    pregenerate=None,
+    formats=None,
+    profile=None,
 ):
     """
     Main template tag to generate thumbnail sourcesets.
     """
-    source = parse_source(source)
+    source_name, source = source, parse_source(source)
 
     if not source:
         context[as_var] = None
@@ -36,16 +41,29 @@ def ultimatethumb(
         context[as_var] = None
         return ''
 
-    thumbnail_options = {'upscale': upscale, 'factor2x': retina}
+    thumbnail_options = build_thumbnail_options(
+        upscale=upscale,
+        crop=crop,
+        retina=retina,
+        quality=quality,
+        pngquant=pngquant,
+        profile=profile,
+    )
 
-    if crop is not None:
-        thumbnail_options['crop'] = crop
+    formats = parse_formats(formats)
+    # Animated images keep their format.
+    if source_extension == 'gif':
+        formats = []
 
-    if quality is not None:
-        thumbnail_options['quality'] = quality
+    thumbnail_set = ThumbnailSet(
+        source, sizes, thumbnail_options, formats=formats, source_name=source_name
+    )
 
-    if pngquant is not None:
-        thumbnail_options['pngquant'] = pngquant
+    if pregenerate is None:
+        pregenerate = getattr(settings, 'ULTIMATETHUMB_PREGENERATE', False)
 
-    context[as_var] = ThumbnailSet(source, sizes, thumbnail_options).thumbnails
+    if pregenerate:
+        thumbnail_queue.enqueue(thumbnail_set)
+
+    context[as_var] = thumbnail_set.thumbnails
     return ''
@@ -1,23 +1,52 @@
-import base64
+import copy
 import os
 from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from mimetypes import guess_type
 
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import force_str
 from django.utils.functional import cached_property
-
-from .commands import GraphicsmagickCommand, PngquantCommand
-from .storage import thumbnail_storage
+from PIL import Image as PILImage
+
+from .commands import PngquantCommand
+from .engines import get_engine
+from .locks import GenerationRejected, get_generation_lock, get_generation_semaphore
+from .metrics import metrics
+from .signals import thumbnail_generated, thumbnail_generation_failed
+from .sources import get_source_path
+from .storage import get_file_stat, save_file, thumbnail_storage
 from .utils import (
+    FORMAT_MIMETYPES,
     MoveableNamedTemporaryFile,
+    base64_cache,
+    build_thumb_name,
     build_url,
-    factor_size,
+    encode_base64,
+    get_cache_key,
+    get_encoder_profile,
     get_size_for_path,
+    get_source_name,
     get_thumb_data,
+    get_thumb_group,
     get_thumb_name,
+    get_thumb_names,
+    get_thumb_token,
+    get_token_data,
     parse_sizes,
+    parse_source,
+    run_in_thread,
+    run_sync,
 )
 
+# Graphicsmagick sampling factors per chroma subsampling.
+GM_SAMPLING_FACTORS = {
+    '4:4:4': '1x1',
+    '4:2:2': '2x1',
+    '4:2:0': '2x2',
+}
+
 CROP_GRAVITY = {
     True: 'Center',
     1: 'Center',
@@ -45,18 +74,222 @@ CROP_GRAVITY = {
 Size = namedtuple('Size', ('width', 'height'))
 
 
+def generate_thumbnails(items, limiter=None):
+    """
+    Generates a list of (thumbnail, factor) tuples using one call to the engine,
+    this allows the engine to decode every source only once.
+
+    Generation is guarded by a lock per thumbnail. The call waits for the lock of
+    the first thumbnail, the other thumbnails are skipped if someone else is
+    generating them. Thumbnails which exist once the lock is acquired are skipped.
+
+    If a limiter (see GenerationLimiter) is given, a generation slot is acquired
+    once the locks are won and held while the thumbnails are generated. Raises
+    GenerationRejected if no slot is free.
+    """
+    generation_locks = []
+    try:
+        pending = []
+        for index, (thumbnail, factor) in enumerate(items):
+            lock = get_generation_lock(thumbnail.get_storage_name(factor))
+            generation_locks.append(lock)
+
+            # If waiting for the first thumbnail times out, generate it anyway.
+            with metrics.timer('ultimatethumb_stage_seconds', stage='lock'):
+                acquired = lock.acquire(blocking=index == 0)
+            if not acquired and index > 0:
+                continue
+
+            if not thumbnail.exists(factor):
+                pending.append((thumbnail, factor))
+
+        if pending:
+            if limiter is not None and not limiter.acquire():
+                raise GenerationRejected
+
+            try:
+                _generate_thumbnails(pending)
+            finally:
+                if limiter is not None:
+                    limiter.release()
+    finally:
+        for lock in generation_locks:
+            lock.release()
+
+
+async def agenerate_thumbnails(items, limiter=None):
+    """
+    Async version of generate_thumbnails. Waiting for the locks doesn't block the
+    event loop, storage access runs in threads and the engine runs concurrently
+    with other generations up to the limit of get_generation_semaphore.
+    """
+    generation_locks = []
+    try:
+        pending = []
+        for index, (thumbnail, factor) in enumerate(items):
+            lock = get_generation_lock(thumbnail.get_storage_name(factor))
+            generation_locks.append(lock)
+
+            with metrics.timer('ultimatethumb_stage_seconds', stage='lock'):
+                acquired = await lock.aacquire(blocking=index == 0)
+            if not acquired and index > 0:
+                continue
+
+            if not await run_in_thread(thumbnail.exists, factor):
+                pending.append((thumbnail, factor))
+
+        if pending:
+            if limiter is not None and not await limiter.aacquire():
+                raise GenerationRejected
+
+            try:
+                await _agenerate_thumbnails(pending)
+            finally:
+                if limiter is not None:
+                    await limiter.arelease()
+    finally:
+        for lock in generation_locks:
+            await lock.arelease()
+
+
+@contextmanager
+def report_failures(items):
+    """
+    Counts failed generations and sends the thumbnail_generation_failed signal,
+    the exception is raised again. The exception is marked as reported to not
+    report it twice (see BaseQueue.generate).
+    """
+    try:
+        yield
+    except Exception as exc:
+        metrics.increment('ultimatethumb_generation_failures_total', len(items))
+        thumbnail_generation_failed.send(sender=Thumbnail, items=items, exception=exc)
+        exc.ultimatethumb_reported = True
+        raise
+
+
+def get_engine_items(items, tmpfiles):
+    """
+    Returns the (thumbnail, factor, outfile) items to pass to the engine.
+    """
+    return [
+        (thumbnail, factor, tmpfile.temporary_file_path())
+        for (thumbnail, factor), tmpfile in zip(items, tmpfiles)
+    ]
+
+
+def get_source_sizes(items):
+    """
+    Returns the file sizes of the sources of the items by source, only if the
+    metrics are enabled (otherwise the dict is empty).
+    """
+    source_sizes = {}
+    if metrics.enabled:
+        for thumbnail, factor in items:
+            if thumbnail.source not in source_sizes:
+                source_sizes[thumbnail.source] = os.path.getsize(
+                    get_source_path(thumbnail.source)
+                )
+
+    return source_sizes
+
+
+def _generate_thumbnails(items):
+    """
+    Generates the thumbnails and stores them. The stages are timed using the
+    metrics backend, the signals are sent for every thumbnail and on failures.
+    """
+    tmpfiles = [
+        MoveableNamedTemporaryFile(thumbnail.get_storage_name(factor))
+        for thumbnail, factor in items
+    ]
+
+    engine = get_engine()
+    with report_failures(items):
+        source_sizes = get_source_sizes(items)
+        with metrics.timer('ultimatethumb_stage_seconds', stage='engine'):
+            engine.generate_many(get_engine_items(items, tmpfiles))
+
+        _store_thumbnails(engine, items, tmpfiles, source_sizes)
+
+
+async def _agenerate_thumbnails(items):
+    """
+    Async version of _generate_thumbnails. The time spent waiting for a free
+    generation slot is timed as queue stage.
+    """
+    tmpfiles = [
+        MoveableNamedTemporaryFile(thumbnail.get_storage_name(factor))
+        for thumbnail, factor in items
+    ]
+
+    engine = get_engine()
+    semaphore = get_generation_semaphore()
+    with report_failures(items):
+        source_sizes = await run_in_thread(get_source_sizes, items)
+        with metrics.timer('ultimatethumb_stage_seconds', stage='queue'):
+            await semaphore.acquire()
+        try:
+            with metrics.timer('ultimatethumb_stage_seconds', stage='engine'):
+                await engine.agenerate_many(get_engine_items(items, tmpfiles))
+        finally:
+            semaphore.release()
+
+        await run_in_thread(_store_thumbnails, engine, items, tmpfiles, source_sizes)
+
+
+def _store_thumbnails(engine, items, tmpfiles, source_sizes):
+    """
+    Optimizes (using pngquant if the engine doesn't quantize PNG thumbnails) and
+    stores the generated thumbnails. The source_sizes (see get_source_sizes) are
+    counted for the metrics.
+    """
+    for (thumbnail, factor), tmpfile in zip(items, tmpfiles):
+        if (
+            thumbnail.options['pngquant']
+            and not engine.quantize_png
+            and os.path.splitext(tmpfile.name)[1] == '.png'
+        ):
+            optimizer = PngquantCommand(
+                pngfile=tmpfile.temporary_file_path(), quality=thumbnail.options['pngquant']
+            )
+            with metrics.timer('ultimatethumb_stage_seconds', stage='optimize'):
+                assert optimizer.execute()
+
+        size = os.path.getsize(tmpfile.temporary_file_path())
+        with metrics.timer('ultimatethumb_stage_seconds', stage='save'):
+            save_file(tmpfile.name, tmpfile)
+
+        output_format = thumbnail.get_output_format()
+        metrics.increment('ultimatethumb_generated_total', format=output_format)
+        metrics.increment('ultimatethumb_output_bytes_total', size, format=output_format)
+        if thumbnail.source in source_sizes:
+            metrics.increment(
+                'ultimatethumb_source_bytes_total', source_sizes[thumbnail.source]
+            )
+        thumbnail_generated.send(
+            sender=Thumbnail, thumbnail=thumbnail, factor=factor, size=size
+        )
+
+
 class ThumbnailSet(object):
     """
     A ThumbnailSet holds the source configuration and a number of thumbnails as requested.
     """
 
-    def __init__(self, source, sizes, options):
+    def __init__(self, source, sizes, options, formats=None, source_name=None):
         """
         Takes a valid source and a list of requested sizes together with additional options.
+        The thumbnails provide variants in the given additional output formats.
+
+        The source_name is the source before parse_source (e.g. a media or a
+        "static:" name), it is used in signed urls instead of the path.
         """
         self.source = source
+        self.source_name = source_name
         self.sizes = sizes
         self.options = options
+        self.formats = formats or []
 
     @cached_property
     def thumbnails(self):
@@ -73,7 +306,7 @@ class ThumbnailSet(object):
         it is. We do this to ensure that we have "retina" images which effectively
         are doubled in size. Doing this, we never have to upscale the image.
         """
-        source_size = get_size_for_path(self.source)
+        source_size = get_size_for_path(get_source_path(self.source))
         if self.options.get('factor2x', True):
             source_size = int(source_size[0] / 2), int(source_size[1] / 2)
 
@@ -127,13 +360,48 @@ class ThumbnailSet(object):
                 options['viewport'] = size[2:4]
 
             options.update(self.options)
-            thumbnails.append(Thumbnail(self.source, options))
+            thumbnail = Thumbnail(self.source, options)
+            thumbnail.source_name = self.source_name
+            thumbnail.formats = self.formats
+            thumbnails.append(thumbnail)
 
             if oversize:
                 break
 
+        # Signed urls don't need the cache, otherwise register all names at
+        # once to save cache round trips.
+        if not getattr(settings, 'ULTIMATETHUMB_SIGNED_URLS', False):
+            names = get_thumb_names(
+                [(thumbnail.source, thumbnail.get_name_options()) for thumbnail in thumbnails]
+            )
+            for thumbnail, name in zip(thumbnails, names):
+                thumbnail.name = name
+
         return thumbnails
 
+    def get_missing(self):
+        """
+        Returns a list of (thumbnail, factor) tuples of all thumbnails of the set
+        (including the retina versions and format variants) which don't exist yet.
+        """
+        return [
+            (variant, factor)
+            for thumbnail in self.thumbnails
+            for variant in [thumbnail] + thumbnail.variants
+            for factor in variant.get_factors()
+            if not variant.exists(factor)
+        ]
+
+    def generate(self):
+        """
+        Generates all missing thumbnails of the set at once.
+        """
+        items = self.get_missing()
+        if items:
+            generate_thumbnails(items)
+
+        return True
+
 
 class Thumbnail(object):
     """
@@ -146,6 +414,9 @@ class Thumbnail(object):
         Some validation on the provided options are done.
         """
         self.source = source
+        self.source_name = None
+        self.format = None
+        self.formats = []
 
         if 'size' not in opts:
             raise ValueError('`size` is required but missing in thumbnail options')
@@ -157,7 +428,14 @@ class Thumbnail(object):
             'quality': getattr(settings, 'ULTIMATETHUMB_GRAPHICSMAGICK_QUALITY', 90),
             'pngquant': getattr(settings, 'ULTIMATETHUMB_PNGQUANT_QUALITY', None),
         }
+
+        # Only set if configured, the option is part of the thumbnail name.
+        profile = getattr(settings, 'ULTIMATETHUMB_ENCODER_PROFILE', None)
+        if profile is not None:
+            self.options['profile'] = profile
+
         self.options.update(opts)
+        get_encoder_profile(self.options.get('profile'))
 
     def __repr__(self):
         return '<Thumbnail: {0} {1}>'.format(
@@ -172,19 +450,76 @@ class Thumbnail(object):
         The name is actually a cache key which is used by get_thumb_data to fetch the
         original thumbnail configuration.
         """
-        return Thumbnail(*get_thumb_data(name))
+        thumbnail = Thumbnail(*get_thumb_data(name))
+        thumbnail.name = name
+        return thumbnail
+
+    @classmethod
+    def from_token(cls, token):
+        """
+        Using a signed token, reconstruct a thumbnail object without any cache lookup.
+        Raises django.core.signing.BadSignature if the token is invalid.
+
+        The token contains the source name, it is resolved using parse_source.
+        """
+        source_name, options = get_token_data(token)
+        thumbnail = Thumbnail(parse_source(source_name), options)
+        thumbnail.source_name = source_name
+        thumbnail.name = build_thumb_name(thumbnail.source, **thumbnail.get_name_options())[0]
+        return thumbnail
+
+    @cached_property
+    def name(self):
+        """
+        The name property returns the thumbnail name, it is only generated once.
+        If signed urls are enabled, the name is not stored to cache.
+        """
+        if getattr(settings, 'ULTIMATETHUMB_SIGNED_URLS', False):
+            return build_thumb_name(self.source, **self.get_name_options())[0]
+
+        return get_thumb_name(self.source, **self.get_name_options())
 
     def get_name(self):
         """
         Generate the thumbnail name for the current thumbnail configuration.
         """
-        return get_thumb_name(
-            self.source,
-            **dict(
-                (option, value)
-                for option, value in self.options.items()
-                if option not in ('viewport',)
-            )
+        return self.name
+
+    def get_format_name(self):
+        """
+        Returns the name including the output format of a variant, e.g.
+        "<hash>/image.png.webp". Returns the name for other thumbnails.
+        """
+        if self.format:
+            return '{0}.{1}'.format(self.get_name(), self.format)
+        return self.get_name()
+
+    def get_variant(self, image_format):
+        """
+        Returns a copy of the thumbnail using another output format (e.g. "webp").
+        The variant is stored next to the thumbnail, name and options are the same.
+        """
+        variant = copy.copy(self)
+        variant.format = image_format
+        variant.formats = []
+        return variant
+
+    @property
+    def variants(self):
+        """
+        Returns the variants of the thumbnail in the requested additional output
+        formats, e.g. to build a picture tag with a source per format.
+        """
+        return [self.get_variant(image_format) for image_format in self.formats]
+
+    def get_name_options(self):
+        """
+        Returns the options which are part of the thumbnail name.
+        """
+        return dict(
+            (option, value)
+            for option, value in self.options.items()
+            if option not in ('viewport',)
         )
 
     @cached_property
@@ -211,25 +546,50 @@ class Thumbnail(object):
             int(viewport[1]) if viewport[1] != '0' else None,
         )
 
+    @cached_property
+    def token(self):
+        """
+        Returns the signed token for signed urls if enabled, otherwise None.
+        """
+        if not getattr(settings, 'ULTIMATETHUMB_SIGNED_URLS', False):
+            return None
+
+        return get_thumb_token(self.get_source_name(), **self.get_name_options())
+
+    def get_source_name(self):
+        """
+        Returns the source name for signed tokens. Tokens are readable by
+        everyone and must not contain file system paths.
+        """
+        return self.source_name or get_source_name(self.source)
+
     @property
     def url(self):
         """
         The url property is responsible for returning the acutal thumbnail url.
         """
-        return build_url(self.get_name())
+        return build_url(self.get_format_name(), token=self.token)
 
     @property
     def url_2x(self):
         """
         Returns the retina url for the thumbnail if retina is enabled.
         """
-        return build_url(self.get_name(), 2) if self.options['factor2x'] else None
+        return (
+            build_url(self.get_format_name(), 2, token=self.token)
+            if self.options['factor2x']
+            else None
+        )
 
     @property
     def base64(self):
         """
         Returns the base64 representation of the thumbnail to use in a src attribute.
+        Variants return the base64 representation of the thumbnail.
         """
+        if self.format:
+            return self.get_variant(None).base64
+
         return 'data:{0};base64,{1}'.format(self.get_mimetype(), self.get_base64_content())
 
     @property
@@ -239,17 +599,55 @@ class Thumbnail(object):
         """
         return Size(*self.options['size'])
 
+    def get_factors(self):
+        """
+        Returns the factors to generate for this thumbnail.
+        """
+        return (1, 2) if self.options['factor2x'] else (1,)
+
+    def get_group(self):
+        """
+        Returns the thumbnails which were requested together with this thumbnail
+        (e.g. by the template tag), starting with this thumbnail.
+        """
+        name = self.get_name()
+        group = [self]
+        for thumb_name, thumb_data in sorted(get_thumb_group(name).items()):
+            if thumb_name != name:
+                thumbnail = Thumbnail(*thumb_data)
+                thumbnail.name = thumb_name
+                thumbnail.format = self.format
+                group.append(thumbnail)
+
+        return group
+
     def exists(self, factor=1):
         """
         Checks if the thumbnail already exists.
         """
-        return os.path.exists(self.get_storage_path(factor, generate=False))
+        return self.get_storage_stat(factor, generate=False) is not None
+
+    def get_output_format(self):
+        """
+        Returns the output format of the thumbnail based on the file name, e.g. "jpg".
+        """
+        return os.path.splitext(self.get_format_name())[1][1:].lower()
+
+    def get_encoder_options(self):
+        """
+        Returns the settings of the encoder profile of the thumbnail, see
+        ultimatethumb.utils.get_encoder_profile.
+        """
+        return get_encoder_profile(self.options.get('profile'))
 
     def get_mimetype(self):
         """
         Returns the mime type of the thumbnail based on the thumbnail file name.
         """
-        mimetype, encoding = guess_type(self.get_name())
+        if self.format in FORMAT_MIMETYPES:
+            return FORMAT_MIMETYPES[self.format]
+
+        mimetype, encoding = guess_type(self.get_format_name())
         return mimetype or 'application/octet-stream'
 
     def get_storage_url(self, factor=1):
@@ -258,9 +656,28 @@ class Thumbnail(object):
         """
         return thumbnail_storage.url(self.get_storage_name(factor))
 
+    def get_storage_stat(self, factor=1, generate=True):
+        """
+        Returns the FileStat of the thumbnail file in the storage, works with
+        local and remote storages. Returns None if the thumbnail is missing
+        and generate is False.
+        """
+        name = self.get_storage_name(factor)
+        with metrics.timer('ultimatethumb_stage_seconds', stage='exists'):
+            file_stat = get_file_stat(name)
+        metrics.increment(
+            'ultimatethumb_exists_checks_total', result='miss' if file_stat is None else 'hit'
+        )
+        if file_stat is None and generate:
+            self.generate(factor)
+            file_stat = get_file_stat(name)
+
+        return file_stat
+
     def get_storage_path(self, factor=1, generate=True):
         """
         Returns the storage path in filesystem of the thumbnail file.
+        Only supported by local storages.
         """
         if generate and not self.exists(factor):
             self.generate(factor)
@@ -271,14 +688,19 @@ class Thumbnail(object):
         """
         Returns the actual generated thumbnail image size.
         """
-        return Size(*get_size_for_path(self.get_storage_path(factor)))
+        file_stat = self.get_storage_stat(factor)
+        if file_stat.path:
+            return Size(*get_size_for_path(file_stat.path))
+
+        with thumbnail_storage.open(file_stat.name, 'rb') as thumb_image:
+            return Size(*PILImage.open(thumb_image).size)
 
     def get_estimated_size(self):
         """
         Calculates the estimated thumbnail image dimensions based on the source size
         and the options provided.
         """
-        source_size = get_size_for_path(self.source)
+        source_size = get_size_for_path(get_source_path(self.source))
         thumb_size = (self.options['size'][0], self.options['size'][1])
         source_width, source_height = source_size
 
@@ -328,91 +750,185 @@ class Thumbnail(object):
         """
         Returns the name to use when storing the thumbnail to disk.
         """
-        name = self.get_name()
+        name = self.get_name() if suffix else self.get_format_name()
         if factor != 1:
             name = os.path.join('{0}x'.format(factor), name)
         if suffix:
             name = '{0}.{1}'.format(os.path.splitext(name)[0], suffix)
         return name
 
-    def generate(self, factor=1):
+    def generate(self, factor=1, limiter=None):
         """
-        Genrate the thumbnail using Graphicsmagick and Pngquant (if enabled and
-        source image is a png file.
+        Genrate the thumbnail using the configured engine and Pngquant (if enabled
+        and source image is a png file.
         """
-        thumb_name = self.get_storage_name(factor)
+        generate_thumbnails([(self, factor)], limiter=limiter)
 
-        tmpfile = MoveableNamedTemporaryFile(thumb_name)
-        resizer = GraphicsmagickCommand(
-            infile=self.source,
-            outfile=tmpfile.temporary_file_path(),
-            options=self.get_gm_options(factor),
-        )
-        assert resizer.execute(fail_silently=True)
+        return True
 
-        if self.options['pngquant'] and os.path.splitext(thumb_name)[1] == '.png':
-            optimizer = PngquantCommand(
-                pngfile=tmpfile.temporary_file_path(), quality=self.options['pngquant']
-            )
-            assert optimizer.execute()
+    def generate_group(self, factor=1, limiter=None):
+        """
+        Generate the thumbnail together with all missing thumbnails (including the
+        retina versions) of the group to decode the source only once.
+        """
+        items = [(self, factor)]
+        for thumbnail in self.get_group():
+            for thumbnail_factor in thumbnail.get_factors():
+                if (thumbnail, thumbnail_factor) not in items and not thumbnail.exists(
+                    thumbnail_factor
+                ):
+                    items.append((thumbnail, thumbnail_factor))
 
-        thumbnail_storage.save(thumb_name, tmpfile)
+        generate_thumbnails(items, limiter=limiter)
 
         return True
 
-    def get_gm_options(self, factor=1):
+    async def agenerate(self, factor=1, limiter=None):
         """
-        Generates the option set dor Graphicsmagick to generate the thumbnail.
+        Async version of generate, see agenerate_thumbnails.
         """
-        gm_options = OrderedDict()
+        await agenerate_thumbnails([(self, factor)], limiter=limiter)
 
-        # Remove any icc profiles to avoid problems.
-        gm_options['+profile'] = '"*"'
+        return True
+
+    async def agenerate_group(self, factor=1, limiter=None):
+        """
+        Async version of generate_group. The group is fetched from the registry
+        using run_sync, the registry might use the database.
+        """
+        items = [(self, factor)]
+        for thumbnail in await run_sync(self.get_group):
+            for thumbnail_factor in thumbnail.get_factors():
+                if (thumbnail, thumbnail_factor) not in items and not await run_in_thread(
+                    thumbnail.exists, thumbnail_factor
+                ):
+                    items.append((thumbnail, thumbnail_factor))
+
+        await agenerate_thumbnails(items, limiter=limiter)
+
+        return True
+
+    def get_resize_options(self, factor=1):
+        """
+        Generates the engine independent options to generate the thumbnail.
 
+        The size is the factored target size (0 if calculated from the aspect
+        ratio), the mode is "^" to fill the target size, ">" to only shrink the
+        image or empty to fit the image into the target size. If gravity is set,
+        the image is cropped to the target size.
+        """
         size = self.get_estimated_size()
 
-        resize_attrs = ''
+        resize_mode = ''
         if self.options['upscale']:
             if self.options['crop']:
-                resize_attrs = '^'
+                resize_mode = '^'
         else:
             if self.options['crop']:
-                resize_attrs = '^'
+                resize_mode = '^'
             else:
-                resize_attrs = '>'
+                resize_mode = '>'
+
+        return {
+            'size': Size(size[0] * factor, size[1] * factor),
+            'mode': resize_mode,
+            'gravity': CROP_GRAVITY.get(self.options['crop'], None),
+            'quality': self.options['quality'],
+        }
+
+    def get_gm_options(self, factor=1):
+        """
+        Generates the option set dor Graphicsmagick to generate the thumbnail.
+        """
+        gm_options = OrderedDict()
+
+        # Remove any icc profiles to avoid problems.
+        gm_options['+profile'] = '"*"'
+
+        resize_options = self.get_resize_options(factor)
+        size = resize_options['size']
 
         gm_options['resize'] = '{0}x{1}{2}'.format(
-            factor_size(size[0], factor), factor_size(size[1], factor), resize_attrs
+            size.width or '', size.height or '', resize_options['mode']
         )
 
-        crop = CROP_GRAVITY.get(self.options['crop'], False)
-        if crop:
-            gm_options['gravity'] = crop
-            gm_options['crop'] = '{0}x{1}+0+0'.format(
-                factor_size(size[0], factor), factor_size(size[1], factor)
-            )
+        if resize_options['gravity']:
+            gm_options['gravity'] = resize_options['gravity']
+            gm_options['crop'] = '{0}x{1}+0+0'.format(size.width or '', size.height or '')
+
+        gm_options['quality'] = resize_options['quality']
 
-        gm_options['quality'] = self.options['quality']
+        encoder_options = self.get_encoder_options()
+        if encoder_options.get('strip'):
+            # Also removes comments and text chunks.
+            gm_options['strip'] = True
+
+        if self.get_output_format() in ('jpg', 'jpeg'):
+            if encoder_options.get('progressive'):
+                gm_options['interlace'] = 'Line'
+
+            if encoder_options.get('optimize'):
+                gm_options['define'] = 'jpeg:optimize-coding=true'
+
+            if encoder_options.get('subsampling'):
+                gm_options['sampling-factor'] = GM_SAMPLING_FACTORS[
+                    encoder_options['subsampling']
+                ]
 
         return gm_options
 
     def get_base64_content(self):
         """
-        Reads the base64 version of the thumbnail from disk and returns content.
+        Returns the base64 version of the thumbnail. The content is cached in-process
+        (and in the Django cache if ULTIMATETHUMB_SHARED_BASE64_CACHE is enabled)
+        using the thumbnail name, thumbnails don't change once generated.
+        """
+        thumb_name = self.get_storage_name(suffix='base64')
+        content = base64_cache.get(thumb_name)
+        if content is not None:
+            return content
+
+        shared_cache_key = None
+        if getattr(settings, 'ULTIMATETHUMB_SHARED_BASE64_CACHE', False):
+            shared_cache_key = get_cache_key('base64:{0}'.format(thumb_name))
+            content = cache.get(shared_cache_key)
+
+        if content is None:
+            content = self.read_base64_content()
+            if shared_cache_key:
+                cache.set(shared_cache_key, content)
+
+        base64_cache.set(thumb_name, content)
+        return content
+
+    def read_base64_content(self):
+        """
+        Reads the base64 version of the thumbnail from the storage, it is generated
+        if it does not exist. If ULTIMATETHUMB_BASE64_FILES is disabled, the thumbnail
+        is encoded without storing the base64 version.
         """
-        with open(self.get_base64_path(), 'r') as b64image:
-            return b64image.read()
+        if not getattr(settings, 'ULTIMATETHUMB_BASE64_FILES', True):
+            with thumbnail_storage.open(self.get_storage_stat().name, 'rb') as thumb_image:
+                return force_str(b''.join(encode_base64(thumb_image)))
+
+        thumb_name = self.get_storage_name(suffix='base64')
+        if get_file_stat(thumb_name) is None:
+            self.generate_base64()
+
+        with thumbnail_storage.open(thumb_name, 'rb') as b64image:
+            return force_str(b64image.read())
 
     def get_base64_path(self, generate=True):
         """
         Calculates the path of the base64 image version.
         If path does not exist, base64 version is generated.
+        Only supported by local storages.
         """
-        path = thumbnail_storage.path(self.get_storage_name(suffix='base64'))
-        if generate and not os.path.exists(path):
+        thumb_name = self.get_storage_name(suffix='base64')
+        if generate and get_file_stat(thumb_name) is None:
             self.generate_base64()
 
-        return path
+        return thumbnail_storage.path(thumb_name)
 
     def generate_base64(self):
         """
@@ -422,9 +938,10 @@ class Thumbnail(object):
 
         tmpfile = MoveableNamedTemporaryFile(thumb_name)
 
-        with open(self.get_storage_path(), 'rb') as thumb_image:
-            tmpfile.file.write(base64.b64encode(thumb_image.read()))
+        with thumbnail_storage.open(self.get_storage_stat().name, 'rb') as thumb_image:
+            for chunk in encode_base64(thumb_image):
+                tmpfile.file.write(chunk)
             tmpfile.file.flush()
 
-        thumbnail_storage.save(thumb_name, tmpfile)
+        save_file(thumb_name, tmpfile)
         return True
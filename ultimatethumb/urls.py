@@ -1,17 +1,36 @@
+from django.conf import settings
 from django.urls import re_path
 
-from .views import ThumbnailView
+from .views import AsyncThumbnailView, ThumbnailView
+
+# Use the AsyncThumbnailView if the project is served using ASGI.
+view = (
+    AsyncThumbnailView
+    if getattr(settings, 'ULTIMATETHUMB_ASYNC_VIEW', False)
+    else ThumbnailView
+).as_view()
 
 urlpatterns = [
     re_path(
         r'^(?P<name>[\w\-]{40}/[\w\-\_\.]+\.\w{3,4})$',
-        ThumbnailView.as_view(),
+        view,
         name='thumbnail',
     ),
     # Prepared to support other factors, currently only 2x.
     re_path(
         r'^(?P<factor>[2])x/(?P<name>[\w\-]{40}/[\w\-\_\.]+\.\w{3,4})$',
-        ThumbnailView.as_view(),
+        view,
         name='thumbnail-factor',
     ),
+    # Signed urls contain the source and options, no cache lookup required.
+    re_path(
+        r'^t/(?P<token>[\w\-\.:]+)/(?P<filename>[\w\-\_\.]+\.\w{3,4})$',
+        view,
+        name='thumbnail-signed',
+    ),
+    re_path(
+        r'^(?P<factor>[2])x/t/(?P<token>[\w\-\.:]+)/(?P<filename>[\w\-\_\.]+\.\w{3,4})$',
+        view,
+        name='thumbnail-signed-factor',
+    ),
 ]
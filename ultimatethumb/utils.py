@@ -1,23 +1,70 @@
+import base64
 import hashlib
 import json
 import os
 import re
 import stat
 import tempfile
+import threading
+import zlib
 from collections import OrderedDict
 from urllib.parse import urljoin, urlparse
 
 from django.conf import settings
 from django.contrib.staticfiles.finders import find
 from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import signing
 from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import default_storage
 from django.urls import reverse
 from django.utils.encoding import force_bytes
 from PIL import Image as PILImage
 
+from .metrics import metrics
+from .probe import probe_image_size
+
 SIZE_RE = re.compile(r'^(\d+%?)(?:x(\d+%?))?(?:\:(\d+)(?:x(\d+))?)?$')
 
+SIGNING_SALT = 'ultimatethumb'
+
+FORMAT_MIMETYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+
+ENCODER_PROFILES = {
+    'default': {},
+    'web': {'progressive': True, 'optimize': True, 'subsampling': '4:2:0', 'strip': True},
+}
+
+JPEG_SUBSAMPLINGS = ('4:4:4', '4:2:2', '4:2:0')
+
+# Multiple of 3 bytes, encoded chunks don't need padding.
+BASE64_CHUNK_SIZE = 3 * 2**14
+
+
+def run_in_thread(func, *args, **kwargs):
+    """
+    Runs the blocking function (e.g. storage access or generation) in a thread of
+    the executor and returns an awaitable for the result. Unlike sync_to_async,
+    the calls don't wait for each other, don't use it for database queries.
+    """
+    # asgiref is only installed with Django 3.0 or newer, import it when used.
+    from asgiref.sync import sync_to_async
+
+    return sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Runs the blocking function using sync_to_async (in the thread of the request
+    context), use it for code which might query the database.
+    """
+    from asgiref.sync import sync_to_async
+
+    return sync_to_async(func)(*args, **kwargs)
+
 
 def get_cache_key(key):
     """
@@ -26,10 +73,10 @@ def get_cache_key(key):
     return 'ultimatethumb:{0}'.format(key)
 
 
-def get_thumb_name(source, **options):
+def build_thumb_name(source, **options):
     """
-    Builds the thumbnail name and uses the name to store the source and options
-    to cache.
+    Builds the thumbnail name and the serialized source and options without
+    touching the cache.
     """
     source_name, source_ext = os.path.splitext(os.path.basename(source))
     data = OrderedDict()
@@ -41,19 +88,50 @@ def get_thumb_name(source, **options):
 
     thumb_name = '{0}/{1}{2}'.format(hashed_data, source_name, source_ext)
 
-    cache_key = get_cache_key(thumb_name)
-    if cache_key not in cache:
-        cache.set(cache_key, serialized_data)
+    return thumb_name, serialized_data
+
+
+def get_thumb_name(source, **options):
+    """
+    Builds the thumbnail name and uses the name to store the source and options
+    to the thumbnail registry.
+    """
+    # Imported here to avoid circular imports, the registry depends on utils.
+    from .registry import thumbnail_registry
+
+    thumb_name, serialized_data = build_thumb_name(source, **options)
+    thumbnail_registry.register(thumb_name, serialized_data)
 
     return thumb_name
 
 
+def get_thumb_names(specs):
+    """
+    Builds the thumbnail names for a list of (source, options) tuples and stores
+    the source and options of all names to the thumbnail registry at once.
+    """
+    from .registry import thumbnail_registry
+
+    thumb_names = []
+    thumb_data = OrderedDict()
+    for source, options in specs:
+        thumb_name, serialized_data = build_thumb_name(source, **options)
+        thumb_names.append(thumb_name)
+        thumb_data[thumb_name] = serialized_data
+
+    thumbnail_registry.register_many(thumb_data)
+
+    return thumb_names
+
+
 def get_thumb_data(thumb_name):
     """
-    Uses the thumbail name and fetches the source and options from cache.
+    Uses the thumbail name and fetches the source and options from the thumbnail
+    registry.
     """
-    cache_key = get_cache_key(thumb_name)
-    serialized_data = cache.get(cache_key)
+    from .registry import thumbnail_registry
+
+    serialized_data = thumbnail_registry.get(thumb_name)
     if not serialized_data:
         raise KeyError('Invalid thumb_name')
 
@@ -61,12 +139,91 @@ def get_thumb_data(thumb_name):
     return (data['source'], data['opts'])
 
 
+def get_thumb_group(thumb_name):
+    """
+    Returns a dict with the source and options of all thumbnails registered
+    together with the given thumbnail name, including the thumbnail itself.
+    """
+    from .registry import thumbnail_registry
+
+    group = thumbnail_registry.get_group(thumb_name)
+    if not group:
+        return {}
+
+    thumb_group = {}
+    for name, serialized_data in thumbnail_registry.get_many(group).items():
+        data = json.loads(serialized_data)
+        thumb_group[name] = (data['source'], data['opts'])
+
+    return thumb_group
+
+
+def get_thumb_token(source, **options):
+    """
+    Serializes the source and options to a compact, signed token which can be
+    used in urls. Unlike django.core.signing.dumps, the token doesn't contain a
+    timestamp and is therefore stable for the same source and options.
+    """
+    data = force_bytes(
+        json.dumps(
+            [source, OrderedDict(sorted(options.items(), key=lambda i: i[0]))],
+            separators=(',', ':'),
+        )
+    )
+
+    compressed = zlib.compress(data)
+    if len(compressed) < len(data) - 1:
+        payload = '.{0}'.format(signing.b64_encode(compressed).decode())
+    else:
+        payload = signing.b64_encode(data).decode()
+
+    return signing.Signer(salt=SIGNING_SALT).sign(payload)
+
+
+def get_token_data(token):
+    """
+    Validates the signed token and returns the source and options.
+    Raises django.core.signing.BadSignature if the token was tampered with.
+    """
+    payload = signing.Signer(salt=SIGNING_SALT).unsign(token)
+
+    if payload[0] == '.':
+        data = zlib.decompress(signing.b64_decode(force_bytes(payload[1:])))
+    else:
+        data = signing.b64_decode(force_bytes(payload))
+
+    source, options = json.loads(data)
+    return (source, options)
+
+
+def get_source_name(source):
+    """
+    Returns the media name of a source path in the default storage, other
+    sources are returned unchanged.
+    """
+    if not source.startswith('/'):
+        return source
+
+    try:
+        location = os.path.join(default_storage.path(''), '')
+    except NotImplementedError:
+        return source
+
+    return source[len(location) :] if source.startswith(location) else source
+
+
 def parse_source(source):
     """
     Parse and lookup the file system path for a given source.
     The function understands both media names and static names
     (if prefixed with "static:")
+
+    Media names in a remote storage without file system paths are returned
+    prefixed with "storage:", they are fetched when needed (see get_source_path).
     """
+    if source.startswith('storage:'):
+        return source
+
     if source.startswith('static:'):
         source = source[7:]
 
@@ -85,11 +242,38 @@ def parse_source(source):
             source = find(source)
     else:
         if not source.startswith('/'):
-            source = default_storage.path(source)
+            try:
+                source = default_storage.path(source)
+            except NotImplementedError:
+                source = 'storage:{0}'.format(source)
 
     return source
 
 
+def build_thumbnail_options(
+    upscale=False, crop=None, retina=True, quality=None, pngquant=None, profile=None
+):
+    """
+    Builds the options for a ThumbnailSet as the template tag does. Options not
+    set are left out to keep the thumbnail names stable.
+    """
+    options = {'upscale': upscale, 'factor2x': retina}
+
+    if crop is not None:
+        options['crop'] = crop
+
+    if quality is not None:
+        options['quality'] = quality
+
+    if pngquant is not None:
+        options['pngquant'] = pngquant
+
+    if profile is not None:
+        options['profile'] = profile
+
+    return options
+
+
 def parse_sizes(value):
     """
     Parses and returns a list of thumbnail sizes.
@@ -112,6 +296,140 @@ def parse_sizes(value):
     return parsed_sizes
 
 
+def get_configured_formats():
+    """
+    Returns the output formats enabled in ULTIMATETHUMB_FORMATS.
+    """
+    return [
+        image_format.lower() for image_format in getattr(settings, 'ULTIMATETHUMB_FORMATS', ())
+    ]
+
+
+def get_formats():
+    """
+    Returns the output formats available for thumbnail variants, in order of
+    preference. Formats the engine can't write are left out.
+    """
+    from .engines import get_engine
+
+    engine = get_engine()
+    return [
+        image_format
+        for image_format in get_configured_formats()
+        if engine.supports_format(image_format)
+    ]
+
+
+def parse_formats(value):
+    """
+    Parses a comma separated string (or a list) of output formats. Raises
+    ValueError if a format is not enabled in ULTIMATETHUMB_FORMATS and
+    ImproperlyConfigured if the engine can't write an enabled format.
+    """
+    if not value:
+        return []
+
+    if isinstance(value, str):
+        value = value.split(',')
+
+    from .engines import get_engine
+
+    formats = [image_format.strip().lower() for image_format in value if image_format.strip()]
+    configured = get_configured_formats()
+    engine = get_engine()
+    for image_format in formats:
+        if image_format not in configured:
+            raise ValueError(
+                'Format {0} is not enabled in ULTIMATETHUMB_FORMATS'.format(image_format)
+            )
+
+        if not engine.supports_format(image_format):
+            raise ImproperlyConfigured(
+                'Format {0} is enabled in ULTIMATETHUMB_FORMATS but {1} can\'t write it'.format(
+                    image_format, type(engine).__name__
+                )
+            )
+
+    return formats
+
+
+def split_format(name):
+    """
+    Splits the format from the name of a thumbnail variant, e.g.
+    "<hash>/image.png.webp" returns ("<hash>/image.png", "webp"). Returns the
+    name and None for other names.
+    """
+    base, extension = os.path.splitext(name)
+    extension = extension[1:].lower()
+    if extension in get_formats() and os.path.splitext(base)[1]:
+        return base, extension
+
+    return name, None
+
+
+def get_accepted_format(accept, exclude=None):
+    """
+    Returns the available output format with the highest quality value in the
+    given Accept header (the order of ULTIMATETHUMB_FORMATS breaks ties) or None
+    if no format is accepted. Wildcards are ignored, browsers send them even if
+    they don't support the format.
+    """
+    accepted = {}
+    for media_range in (accept or '').split(','):
+        params = media_range.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        accepted[params[0].strip().lower()] = quality
+
+    best_format, best_quality = None, 0
+    for image_format in get_formats():
+        quality = accepted.get(FORMAT_MIMETYPES.get(image_format, 'image/' + image_format), 0)
+        if image_format != exclude and quality > best_quality:
+            best_format, best_quality = image_format, quality
+
+    return best_format
+
+
+def get_encoder_profile(name):
+    """
+    Returns the encoder settings of the given profile. Profiles are defined in
+    ENCODER_PROFILES and ULTIMATETHUMB_ENCODER_PROFILES, the settings are:
+
+    * progressive: Write progressive (interlaced) JPEGs
+    * optimize: Optimize the Huffman tables of JPEGs (and the compression of PNGs)
+    * subsampling: Chroma subsampling of JPEGs, "4:4:4", "4:2:2" or "4:2:0"
+    * strip: Remove all metadata, including comments and text chunks
+
+    Raises ValueError if the profile or one of its settings is unknown.
+    """
+    if name is None:
+        return {}
+
+    profiles = dict(ENCODER_PROFILES, **getattr(settings, 'ULTIMATETHUMB_ENCODER_PROFILES', {}))
+    if name not in profiles:
+        raise ValueError('{0} is not a valid encoder profile'.format(name))
+
+    profile = profiles[name]
+    unknown = set(profile) - set(ENCODER_PROFILES['web'])
+    if unknown:
+        raise ValueError(
+            'Unknown encoder settings in profile {0}: {1}'.format(
+                name, ', '.join(sorted(unknown))
+            )
+        )
+
+    if profile.get('subsampling') not in (None,) + JPEG_SUBSAMPLINGS:
+        raise ValueError('{0} is not a valid chroma subsampling'.format(profile['subsampling']))
+
+    return profile
+
+
 def factor_size(value, factor):
     """
     Factors the given thumbnail size. Understands both absolute dimensions
@@ -129,11 +447,131 @@ def factor_size(value, factor):
     return str(size) if size else ''
 
 
+class LRUCache(object):
+    """
+    Small thread-safe in-process LRU cache. The maximum size is read from the
+    given setting on every write, a size of 0 disables the cache.
+
+    The size is the number of entries, or the sum of sizeof(value) if sizeof is
+    given (e.g. len for bytes). Values larger than the maximum size are not cached.
+    """
+
+    def __init__(self, setting, default_size, sizeof=None):
+        self.setting = setting
+        self.default_size = default_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def maxsize(self):
+        return getattr(settings, self.setting, self.default_size)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        maxsize = self.maxsize
+        value_size = self.sizeof(value)
+        with self.lock:
+            if key in self.data:
+                self.size -= self.sizeof(self.data.pop(key))
+
+            if value_size > maxsize:
+                return
+
+            self.data[key] = value
+            self.size += value_size
+            while self.size > maxsize:
+                self.size -= self.sizeof(self.data.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+
+size_cache = LRUCache('ULTIMATETHUMB_SIZE_CACHE_SIZE', 1000)
+
+base64_cache = LRUCache('ULTIMATETHUMB_BASE64_CACHE_SIZE', 1024**2, sizeof=len)
+
+
+def encode_base64(file, chunk_size=BASE64_CHUNK_SIZE):
+    """
+    Reads the file in chunks and yields the base64 encoded chunks, the chunks can be
+    concatenated. Short reads are buffered to keep the chunks a multiple of 3 bytes.
+    """
+    remainder = b''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+
+        data = remainder + chunk
+        length = len(data) - len(data) % 3
+        remainder = data[length:]
+        if length:
+            yield base64.b64encode(data[:length])
+
+    if remainder:
+        yield base64.b64encode(remainder)
+
+
 def get_size_for_path(path):
     """
     Gets the image size for a given path. If the path does not exist, the call
     will fail loud with e.g. OSError exception.
+
+    Sizes are cached in-process (and in the Django cache if
+    ULTIMATETHUMB_SHARED_SIZE_CACHE is enabled) using the path, modification time
+    and file size as key. A changed file is therefore probed again.
     """
+    path_stat = os.stat(path)
+    key = '{0}:{1}:{2}'.format(path, path_stat.st_mtime_ns, path_stat.st_size)
+
+    size = size_cache.get(key)
+    if size is not None:
+        return size
+
+    shared_cache_key = None
+    if getattr(settings, 'ULTIMATETHUMB_SHARED_SIZE_CACHE', False):
+        shared_cache_key = get_cache_key(
+            'size:{0}'.format(hashlib.sha1(force_bytes(key)).hexdigest())
+        )
+        size = cache.get(shared_cache_key)
+
+    if size is None:
+        with metrics.timer('ultimatethumb_stage_seconds', stage='probe'):
+            size = probe_size_for_path(path)
+        if shared_cache_key:
+            cache.set(shared_cache_key, size)
+
+    size = tuple(size)
+    size_cache.set(key, size)
+    return size
+
+
+def probe_size_for_path(path):
+    """
+    Reads the image size for a given path from the image file, bypassing any cache.
+
+    If ULTIMATETHUMB_SIZE_PROBE is set to "header", the size is parsed from the
+    file header directly. Pillow is used for all other cases and as fallback.
+    """
+    if getattr(settings, 'ULTIMATETHUMB_SIZE_PROBE', 'pillow') == 'header':
+        size = probe_image_size(path)
+        if size:
+            return size
+
     with open(path, 'rb') as image_file:
         image = PILImage.open(image_file)
         size = image.size
@@ -156,11 +594,18 @@ def get_domain_url(url):
     return urljoin(domain, url)
 
 
-def build_url(name, factor=1):
+def build_url(name, factor=1, token=None):
     """
-    Build the actual url for a given name and factor.
+    Build the actual url for a given name and factor. If a signed token is passed,
+    the url contains the token instead of the name.
     """
-    if factor > 1:
+    if token:
+        kwargs = {'token': token, 'filename': os.path.basename(name)}
+        if factor > 1:
+            url = reverse('thumbnail-signed-factor', kwargs=dict(kwargs, factor=factor))
+        else:
+            url = reverse('thumbnail-signed', kwargs=kwargs)
+    elif factor > 1:
         url = reverse('thumbnail-factor', kwargs={'factor': factor, 'name': name})
     else:
         url = reverse('thumbnail', kwargs={'name': name})
@@ -1,13 +1,66 @@
 import os
-from urllib.parse import urlparse
+import time
+from contextlib import nullcontext
 
 from django.conf import settings
+from django.core.signing import BadSignature
 from django.http import Http404, HttpResponse, HttpResponseNotModified
-from django.utils.http import http_date
+from django.utils.cache import (
+    add_never_cache_headers,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.http import http_date, parse_etags
 from django.views.generic import View
 from django.views.static import was_modified_since
 
+from .locks import GenerationRejected, get_generation_limiter
+from .metrics import collect_timings, metrics
+from .offload import get_offload
 from .thumbnail import Thumbnail
+from .utils import get_accepted_format, run_in_thread, run_sync, split_format
+
+
+def get_etag(thumb_name, factor=1, image_format=None):
+    """
+    Returns the strong ETag for a thumbnail. The name contains the hash of the
+    source and options, the content of a name never changes.
+    """
+    etag = thumb_name.split('/')[0]
+    if factor != 1:
+        etag = '{0}-{1}x'.format(etag, factor)
+    if image_format:
+        etag = '{0}-{1}'.format(etag, image_format)
+    return '"{0}"'.format(etag)
+
+
+def get_server_timing(timings, total):
+    """
+    Returns the Server-Timing header value for the collected (stage, duration)
+    timings, durations of repeated stages are summed up. Durations are given in
+    milliseconds, the total duration comes last.
+    """
+    durations = {}
+    for stage, duration in timings:
+        durations[stage] = durations.get(stage, 0) + duration
+    durations['total'] = total
+
+    return ', '.join(
+        '{0};dur={1:.2f}'.format(stage, duration * 1000)
+        for stage, duration in durations.items()
+    )
+
+
+def etag_matches(value, etag):
+    """
+    Checks if the If-None-Match header value matches the ETag.
+    """
+    if not value:
+        return False
+
+    etags = parse_etags(value)
+    # If-None-Match uses the weak comparison.
+    return '*' in etags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in etags]
 
 
 class ThumbnailView(View):
@@ -17,27 +70,177 @@ class ThumbnailView(View):
     We don't use a serve static view because we need to check if the requested
     thumbnail is available - and if not: generate one.
 
-    The view supports the X-Accel-Redirect header supported by Nginx to no really
-    serve the binary (enabled by default if DEBUG is False).
+    The response for existing thumbnails is built by the offload strategy
+    configured in ULTIMATETHUMB_OFFLOAD, e.g. to let the web server serve
+    the binary (X-Accel-Redirect is used by default if DEBUG is False).
+
+    Variants in other output formats are served using their own url or, if
+    ULTIMATETHUMB_NEGOTIATE_FORMATS is enabled, based on the Accept header.
+
+    If ULTIMATETHUMB_ADMISSION_CONTROL is enabled, the number of concurrent
+    generations is limited (see GenerationLimiter), requests exceeding the limit
+    and the wait queue get a 503 response with a Retry-After header.
+
+    If ULTIMATETHUMB_SERVER_TIMING is enabled, the responses report the timed
+    stages in a Server-Timing header and whether the thumbnail was generated
+    in a X-Ultimatethumb-Generated header (hit or miss).
     """
 
+    # Set by render_thumbnail: True if the thumbnail had to be generated.
+    generated = None
+
+    # Set by get: the ETag of the response, passed to the offload strategy.
+    etag = None
+
+    def dispatch(self, *args, **kwargs):
+        """
+        Times the response and counts the responses per status code.
+        """
+        start = time.perf_counter()
+        with self.collect_timings() as timings:
+            with metrics.timer('ultimatethumb_view_seconds'):
+                response = super().dispatch(*args, **kwargs)
+
+        return self.finalize_response(response, timings, start)
+
+    def collect_timings(self):
+        """
+        Returns the context manager collecting the timings of the stages if
+        ULTIMATETHUMB_SERVER_TIMING is enabled.
+        """
+        if getattr(settings, 'ULTIMATETHUMB_SERVER_TIMING', False):
+            return collect_timings()
+        return nullcontext()
+
+    def finalize_response(self, response, timings, start):
+        """
+        Counts the response and adds the Server-Timing and X-Ultimatethumb-Generated
+        headers if timings were collected.
+        """
+        metrics.increment('ultimatethumb_responses_total', status=response.status_code)
+
+        if timings is not None:
+            response['Server-Timing'] = get_server_timing(timings, time.perf_counter() - start)
+            if self.generated is not None:
+                response['X-Ultimatethumb-Generated'] = 'miss' if self.generated else 'hit'
+
+        return response
+
     def get(self, *args, **kwargs):
         """
         Fetch and return the thumbnail response.
+
+        The ETag is derived from the url, matching revalidations are answered
+        without touching the storage or the cache.
         """
-        return self.render_thumbnail(self.get_thumbnail(), self.get_factor())
+        factor = self.get_factor()
+        image_format = self.get_format()
+
+        # Signed urls are decoded without a cache lookup, other urls contain the name.
+        thumbnail = self.get_thumbnail() if 'token' in self.kwargs else None
+        etag = get_etag(
+            thumbnail.get_name() if thumbnail else self.kwargs['name'], factor, image_format
+        )
+        self.etag = etag
+
+        if etag_matches(self.request.META.get('HTTP_IF_NONE_MATCH'), etag):
+            return self.patch_response(HttpResponseNotModified(), etag)
+
+        if thumbnail is None:
+            thumbnail = self.get_thumbnail()
+
+        if image_format:
+            thumbnail = thumbnail.get_variant(image_format)
+
+        return self.patch_response(self.render_thumbnail(thumbnail, factor), etag)
+
+    def patch_response(self, response, etag):
+        """
+        Adds the ETag, the Vary header (if the format is negotiated) and (if
+        configured) the Cache-Control header.
+        """
+        if self.negotiates_format():
+            patch_vary_headers(response, ('Accept',))
+
+        # Redirects (and errors) don't carry the thumbnail.
+        if response.status_code not in (200, 206, 304):
+            return response
+
+        response['ETag'] = etag
+
+        max_age = getattr(settings, 'ULTIMATETHUMB_CACHE_CONTROL_MAX_AGE', None)
+        if max_age is not None:
+            patch_cache_control(response, public=True, max_age=max_age, immutable=True)
+
+        return response
+
+    def generate_thumbnail(self, thumbnail, factor):
+        """
+        Generate the missing thumbnail. If batch generation is enabled (the
+        default), all missing thumbnails of the same group are generated too.
+
+        The engine runs in a slot of the admission control, raises
+        GenerationRejected if no slot is free.
+        """
+        limiter = get_generation_limiter()
+        if getattr(settings, 'ULTIMATETHUMB_BATCH_GENERATION', True):
+            thumbnail.generate_group(factor, limiter=limiter)
+        else:
+            thumbnail.generate(factor, limiter=limiter)
 
     def get_thumbnail(self):
         """
         Try to fetch the thumbnail based on the thumbnail name.
         Might fail if cache resets between generation of the thumbnail urls and
         fetching of the images.
+
+        Signed urls contain the source and options, no cache is involved.
         """
+        if 'token' in self.kwargs:
+            try:
+                thumbnail = Thumbnail.from_token(self.kwargs['token'])
+            except BadSignature:
+                raise Http404
+
+            # Only accept the filename we generate to have one url per thumbnail.
+            filename = split_format(self.kwargs['filename'])[0]
+            if os.path.basename(thumbnail.get_name()) != filename:
+                raise Http404
+
+            return thumbnail
+
         try:
-            return Thumbnail.from_name(self.kwargs['name'])
+            return Thumbnail.from_name(split_format(self.kwargs['name'])[0])
         except KeyError:
             raise Http404
 
+    def get_format(self):
+        """
+        Returns the output format of a variant or None for the thumbnail itself.
+        Urls of variants contain the format, otherwise the format is negotiated
+        using the Accept header (if enabled).
+        """
+        name, image_format = split_format(self.kwargs.get('name') or self.kwargs['filename'])
+        if image_format or not self.negotiates_format():
+            return image_format
+
+        return get_accepted_format(
+            self.request.META.get('HTTP_ACCEPT'),
+            exclude=os.path.splitext(name)[1][1:].lower(),
+        )
+
+    def negotiates_format(self):
+        """
+        Checks if the output format is negotiated using the Accept header, this
+        is the case for urls without a format if ULTIMATETHUMB_NEGOTIATE_FORMATS
+        is enabled. Animated images (gif) keep their format.
+        """
+        if not getattr(settings, 'ULTIMATETHUMB_NEGOTIATE_FORMATS', False):
+            return False
+
+        name, image_format = split_format(self.kwargs.get('name') or self.kwargs['filename'])
+        return image_format is None and not name.lower().endswith('.gif')
+
     def get_factor(self):
         """
         Get factor from url.
@@ -49,29 +252,139 @@ class ThumbnailView(View):
         Generate the http response for the requested thumbnail.
         The code is able response with 304 if the thumbnail was already requested.
 
-        Supports X-Accel-Redirect, enabled by default if DEBUG is False.
+        The response is built by the configured offload strategy, see get_offload.
+        """
+        file_stat = thumbnail.get_storage_stat(factor, generate=False)
+        self.generated = file_stat is None
+        if self.generated:
+            try:
+                self.generate_thumbnail(thumbnail, factor)
+            except GenerationRejected:
+                return self.get_overloaded_response()
+
+            file_stat = thumbnail.get_storage_stat(factor, generate=False)
+
+        return self.build_response(thumbnail, factor, file_stat)
+
+    def get_overloaded_response(self):
+        """
+        Returns the response if the generation was rejected by the admission
+        control, the client should retry after ULTIMATETHUMB_GENERATION_RETRY_AFTER
+        seconds.
         """
-        path = thumbnail.get_storage_path(factor)
+        response = HttpResponse(status=503)
+        response['Retry-After'] = str(
+            getattr(settings, 'ULTIMATETHUMB_GENERATION_RETRY_AFTER', 5)
+        )
+        add_never_cache_headers(response)
+        return response
 
-        thumbnail_stat = os.stat(path)
+    def build_response(self, thumbnail, factor, file_stat):
+        """
+        Returns the response for the existing thumbnail.
+        """
         mimetype = thumbnail.get_mimetype()
 
-        # Check for last modified.
-        if not was_modified_since(
-            self.request.META.get('HTTP_IF_MODIFIED_SINCE'),
-            thumbnail_stat.st_mtime,
+        # Check for last modified, If-None-Match takes precedence.
+        if (
+            file_stat.modified_time is not None
+            and 'HTTP_IF_NONE_MATCH' not in self.request.META
+            and not was_modified_since(
+                self.request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                file_stat.modified_time,
+            )
         ):
             return HttpResponseNotModified()
 
-        if getattr(settings, 'ULTIMATETHUMB_USE_X_ACCEL_REDIRECT', not settings.DEBUG):
-            response = HttpResponse(content_type=mimetype)
-            response['X-Accel-Redirect'] = urlparse(thumbnail.get_storage_url(factor)).path
-        else:
-            with open(path, 'rb') as file:
-                response = HttpResponse(file.read(), content_type=mimetype)
+        response = get_offload().render(
+            self.request, thumbnail, factor, file_stat, mimetype, etag=self.etag
+        )
 
         # Respect the If-Modified-Since header.
-        response['Last-Modified'] = http_date(thumbnail_stat.st_mtime)
-        response['Content-Length'] = thumbnail_stat.st_size
+        if file_stat.modified_time is not None and response.status_code in (200, 206):
+            response['Last-Modified'] = http_date(file_stat.modified_time)
 
         return response
+
+
+class AsyncThumbnailView(ThumbnailView):
+    """
+    Async version of the ThumbnailView for ASGI deployments, requires Django 4.1
+    or newer. Set ULTIMATETHUMB_ASYNC_VIEW to use it in the ultimatethumb urls.
+
+    Waiting for the generation doesn't block a thread: gm runs as subprocess of
+    the event loop (other engines run in a thread), storage access runs in
+    threads and generation locks are polled using asyncio. The number of
+    concurrent generations per event loop is limited, see
+    ULTIMATETHUMB_ASYNC_GENERATION_CONCURRENCY.
+    """
+
+    async def dispatch(self, *args, **kwargs):
+        start = time.perf_counter()
+        with self.collect_timings() as timings:
+            with metrics.timer('ultimatethumb_view_seconds'):
+                response = await View.dispatch(self, *args, **kwargs)
+
+        return self.finalize_response(response, timings, start)
+
+    async def get(self, *args, **kwargs):
+        factor = self.get_factor()
+        image_format = self.get_format()
+
+        # The registry might use the database, use run_sync for lookups.
+        thumbnail = await run_sync(self.get_thumbnail) if 'token' in self.kwargs else None
+        etag = get_etag(
+            thumbnail.get_name() if thumbnail else self.kwargs['name'], factor, image_format
+        )
+        self.etag = etag
+
+        if etag_matches(self.request.META.get('HTTP_IF_NONE_MATCH'), etag):
+            return self.patch_response(HttpResponseNotModified(), etag)
+
+        if thumbnail is None:
+            thumbnail = await run_sync(self.get_thumbnail)
+
+        if image_format:
+            thumbnail = thumbnail.get_variant(image_format)
+
+        return self.patch_response(await self.arender_thumbnail(thumbnail, factor), etag)
+
+    async def agenerate_thumbnail(self, thumbnail, factor):
+        """
+        Async version of generate_thumbnail.
+        """
+        limiter = get_generation_limiter()
+        if getattr(settings, 'ULTIMATETHUMB_BATCH_GENERATION', True):
+            await thumbnail.agenerate_group(factor, limiter=limiter)
+        else:
+            await thumbnail.agenerate(factor, limiter=limiter)
+
+    async def arender_thumbnail(self, thumbnail, factor):
+        """
+        Async version of render_thumbnail.
+        """
+        file_stat = await run_in_thread(thumbnail.get_storage_stat, factor, generate=False)
+        self.generated = file_stat is None
+        if self.generated:
+            try:
+                await self.agenerate_thumbnail(thumbnail, factor)
+            except GenerationRejected:
+                return self.get_overloaded_response()
+
+            file_stat = await run_in_thread(thumbnail.get_storage_stat, factor, generate=False)
+
+        return await run_in_thread(self.build_response, thumbnail, factor, file_stat)
+
+
+class MetricsView(View):
+    """
+    Returns the metrics of the current process in the Prometheus text exposition
+    format, requires the ultimatethumb.metrics.MemoryMetrics backend. The view is
+    not part of the ultimatethumb urls, add it to your urls and protect it.
+    """
+
+    def get(self, *args, **kwargs):
+        if not hasattr(metrics, 'render'):
+            raise Http404
+
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')